@@ -21,6 +21,7 @@ from alemibot.util import (
 
 from ..driver import DRIVER
 from ..util.getters import get_doc_username
+from ..util.compact import expand_message
 
 import logging
 logger = logging.getLogger(__name__)
@@ -64,12 +65,12 @@ async def dbstats_cmd(client:alemiBot, message:Message):
 		db_size = order_suffix((await DRIVER.db.command("dbstats"))["totalSize"])
 		medianumber = sep(len(os.listdir("plugins/statsbot/data")))
 		now = datetime.now()
-		msgs_per_s = DRIVER.counter['messages'] / (now - client.start_time).total_seconds()
-		service_per_h = DRIVER.counter['service'] / ((now - client.start_time).total_seconds() / 3600)
-		deletions_per_s = DRIVER.counter['deletions'] / (now - client.start_time).total_seconds()
-		members_per_h = DRIVER.counter['members'] / ((now - client.start_time).total_seconds() / 3600)
-		users_per_h = DRIVER.counter['users'] / ((now - client.start_time).total_seconds() / 3600)
-		chats_per_h = DRIVER.counter['chats'] / ((now - client.start_time).total_seconds() / 3600)
+		msgs_per_s = DRIVER.metrics['messages'] / (now - client.start_time).total_seconds()
+		service_per_h = DRIVER.metrics['service'] / ((now - client.start_time).total_seconds() / 3600)
+		deletions_per_s = DRIVER.metrics['deletions'] / (now - client.start_time).total_seconds()
+		members_per_h = DRIVER.metrics['members'] / ((now - client.start_time).total_seconds() / 3600)
+		users_per_h = DRIVER.metrics['users'] / ((now - client.start_time).total_seconds() / 3600)
+		chats_per_h = DRIVER.metrics['chats'] / ((now - client.start_time).total_seconds() / 3600)
 		proc = await asyncio.create_subprocess_exec( # This is not cross platform!
 			"du", "-b", "plugins/statsbot/data/",
 			stdout=asyncio.subprocess.PIPE,
@@ -80,81 +81,153 @@ async def dbstats_cmd(client:alemiBot, message:Message):
 		uptime = str(datetime.now() - client.start_time)
 		await edit_or_reply(message, f"<code>→ </code> <b>online for</b> <code>{uptime}</code>" +
 						f"\n<code>→ </code> <b>first event</b> <code>{oldest_msg['date']}</code>" +
-						f"\n<code> → </code> <b>{msg_count}</b> msgs logged (+{sep(DRIVER.counter['messages'])} new | <i>{msgs_per_s:.2f}/s</i> | <b>{msg_size}</b>)" +
-						f"\n<code> → </code> <b>{service_count}</b> events tracked (+{sep(DRIVER.counter['service'])} new | <i>{service_per_h:.2f}/h</i> | <b>{service_size}</b>)" +
-						f"\n<code> → </code> <b>{deletions_count}</b> deletions saved (+{sep(DRIVER.counter['deletions'])} new | <i>{deletions_per_s:.2f}/s</i> | <b>{deletions_size}</b>)" +
-						f"\n<code> → </code> <b>{members_count}</b> members updated (+{sep(DRIVER.counter['members'])} new | <i>{members_per_h:.2f}/h</i> | <b>{members_size}</b>)" +
-						f"\n<code> → </code> <b>{user_count}</b> users met (+{sep(DRIVER.counter['users'])} new | <i>{users_per_h:.2f}/h</i> | <b>{user_size}</b>)" +
-						f"\n<code> → </code> <b>{chat_count}</b> chats visited (+{sep(DRIVER.counter['chats'])} new | <i>{chats_per_h:.2f}/h</i> | <b>{chat_size}</b>)" +
+						f"\n<code> → </code> <b>{msg_count}</b> msgs logged (+{sep(DRIVER.metrics['messages'])} new | <i>{msgs_per_s:.2f}/s</i> | <b>{msg_size}</b>)" +
+						f"\n<code> → </code> <b>{service_count}</b> events tracked (+{sep(DRIVER.metrics['service'])} new | <i>{service_per_h:.2f}/h</i> | <b>{service_size}</b>)" +
+						f"\n<code> → </code> <b>{deletions_count}</b> deletions saved (+{sep(DRIVER.metrics['deletions'])} new | <i>{deletions_per_s:.2f}/s</i> | <b>{deletions_size}</b>)" +
+						f"\n<code> → </code> <b>{members_count}</b> members updated (+{sep(DRIVER.metrics['members'])} new | <i>{members_per_h:.2f}/h</i> | <b>{members_size}</b>)" +
+						f"\n<code> → </code> <b>{user_count}</b> users met (+{sep(DRIVER.metrics['users'])} new | <i>{users_per_h:.2f}/h</i> | <b>{user_size}</b>)" +
+						f"\n<code> → </code> <b>{chat_count}</b> chats visited (+{sep(DRIVER.metrics['chats'])} new | <i>{chats_per_h:.2f}/h</i> | <b>{chat_size}</b>)" +
 						f"\n<code> → </code> DB total size <b>{db_size}</b>" +
-						f"\n<code> → </code> <b>{medianumber}</b> documents archived (size <b>{mediasize}</b>)",
+						f"\n<code> → </code> <b>{medianumber}</b> documents archived (size <b>{mediasize}</b>)" +
+						(f"\n<code>  → </code> downloads <i>{DRIVER.media}</i>" if DRIVER.media is not None else "") +
+						(f"\n<code> → </code> batched ingest <i>{DRIVER.batch.stats}</i>" if DRIVER.batch is not None else "") +
+						(f"\n<code> → </code> <b>{sep(len(DRIVER.increments))}</b> pending counters <i>{DRIVER.increments.stats}</i>" if DRIVER.increments is not None else "") +
+						(f"\n<code> → </code> spool <i>{DRIVER.spool}</i>" if DRIVER.spool is not None else "") +
+						f"\n<code> → </code> cached users <i>{DRIVER.cache['users']}</i> | chats <i>{DRIVER.cache['chats']}</i>" +
+						f"\n<code> → </code> cached results <i>{DRIVER.results}</i>" +
+						(f"\n<code> → </code> ingest queue <i>{DRIVER.queue}</i>" if DRIVER.queue is not None else "") +
+						(f"\n<code> → </code> plot workers <i>{DRIVER.renderer}</i>" if DRIVER.renderer is not None else "") +
+						(f"\n<code> → </code> <b>{sep(len(DRIVER.statuses))}</b> pending statuses ({sep(DRIVER.statuses.skipped)} skipped) <i>{DRIVER.statuses.stats}</i>" if DRIVER.statuses is not None else ""),
 						parse_mode=ParseMode.HTML, disable_web_page_preview=True
 		)
 
-BACKFILL_STOP = False
-
+@HELP.add()
+@alemiBot.on_message(sudo & filterCommand(["metrics", "ingest"], flags=["-prom"]))
 @report_error(logger)
 @set_offline
-async def back_fill_messages(client, message, target_group, limit, offset, interval, silent=False):
-	global BACKFILL_STOP
-	count = 0
-	if not silent:
-		await edit_or_reply(message, f"<code> → </code> [ <b>0 / {sep(limit)}</b> ]", parse_mode=ParseMode.HTML)
-	async for msg in client.iter_history(target_group.id, limit=limit, offset=offset):
-		if BACKFILL_STOP:
-			BACKFILL_STOP = False
-			return await edit_or_reply(message, f"<code>[!] → </code> Stopped at [ <b>{sep(count)} / {sep(limit)}</b> ]", parse_mode=ParseMode.HTML)
-		if msg.service:
-			await DRIVER.parse_service_event(msg)
-		else:
-			await DRIVER.parse_message_event(msg)
-		count += 1
-		if not silent and count % interval == 0:
-			await edit_or_reply(message, f"<code> → </code> [ <b>{sep(count)} / {sep(limit)}</b> ]", parse_mode=ParseMode.HTML)
-	await edit_or_reply(message, f"<code> → </code> Done [ <b>{sep(count)} / {sep(limit)}</b> ]", parse_mode=ParseMode.HTML)
+@cancel_chat_action
+async def metrics_cmd(client:alemiBot, message:Message):
+	"""show ingest metrics
 
+	For each event hook, show events received, rates in last 1/5/15 minutes, errors and \
+	p50/p99 latencies, split between time spent serializing and time spent on db.
+	Add flag `-prom` to get all metrics in Prometheus text format instead.
+	"""
+	m = DRIVER.metrics
+	if message.command["-prom"]:
+		f = io.BytesIO(m.prometheus().encode("utf-8"))
+		f.name = "metrics.prom"
+		return await client.send_document(message.chat.id, f, reply_to_message_id=message.id, caption="` → Ingest metrics`")
+	out = f"<code>→ </code> <b>ingest metrics</b> since <code>{m.start}</code>\n"
+	for hook in m.hooks:
+		name = f"{hook}_events"
+		ser = m.latency[(hook, "serialize")]
+		db = m.latency[(hook, "db")]
+		out += f"<code> → </code> <b>{hook}</b> : {sep(m[name])} events" + \
+			(f" | <b>{sep(m.errors[hook])}</b> errors" if hook in m.errors else "") + \
+			f"\n<code>  → </code> <i>{m.rate(name, 60):.2f} | {m.rate(name, 300):.2f} | {m.rate(name, 900):.2f} /s</i> (1/5/15m)" + \
+			f"\n<code>  → </code> serialize p50 <code>{ser.quantile(0.5)*1000:g}ms</code> p99 <code>{ser.quantile(0.99)*1000:g}ms</code>" + \
+			f"\n<code>  → </code> db p50 <code>{db.quantile(0.5)*1000:g}ms</code> p99 <code>{db.quantile(0.99)*1000:g}ms</code>\n"
+	stored = [ k for k in ("messages", "service", "deletions", "edits", "members", "users", "chats") if k in m ]
+	if stored:
+		out += "<code>→ </code> <b>stored</b>\n"
+		for k in stored:
+			out += f"<code> → </code> {k} : {sep(m[k])} (<i>{m.rate(k, 60):.2f} | {m.rate(k, 300):.2f} | {m.rate(k, 900):.2f} /s</i>)\n"
+	await edit_or_reply(message, out, parse_mode=ParseMode.HTML)
 
-@HELP.add(cmd="<amount>")
+@HELP.add()
+@alemiBot.on_message(sudo & filterCommand(["indexes", "index"], flags=["-build"]))
+@report_error(logger)
+@set_offline
+@cancel_chat_action
+async def indexes_cmd(client:alemiBot, message:Message):
+	"""show index status
+
+	Check which indexes are present, missing, building or failed.
+	Add flag `-build` to retry building missing and failed indexes in background.
+	"""
+	await DRIVER.indexes.check(DRIVER.db)
+	if message.command["-build"]:
+		DRIVER.indexes.build_background(DRIVER.db)
+	out = f"<code>→ </code> <b>indexes</b> <i>{DRIVER.indexes}</i>\n"
+	for spec in DRIVER.indexes.manifest:
+		key = (spec.collection, spec.name)
+		out += f"<code> → </code> <b>{spec.collection}</b> <code>{spec.name}</code> : <i>{DRIVER.indexes.state[key]}</i>\n"
+		if key in DRIVER.indexes.errors:
+			out += f"<code>  → </code> {html.escape(DRIVER.indexes.errors[key])}\n"
+	await edit_or_reply(message, out, parse_mode=ParseMode.HTML)
+
+@HELP.add(cmd="[<amount>]")
 @alemiBot.on_message(sudo & filterCommand(["backfill"], options={
 	"group" : ["-g", "--group"],
 	"interval" : ["-i", "--interval"],
 	"offset" : ["-o", "--offset"],
-}, flags=["-silent", "-stop"]))
+}, flags=["-silent", "-stop", "-pause", "-resume", "-list"]))
 @report_error(logger)
 @set_offline
 async def back_fill_cmd(client:alemiBot, message:Message):
 	"""iter previous history to fill database
 
-	Call telegram iter_history to put in db messages sent before joining.
+	Start a background job fetching chat history to put in db messages sent before joining.
+	Jobs write in bulk and save their progress, so they can be paused and resumed (also across restarts).
 	Specify a group to backfill with `-g`.
-	Specify an offset to start backfilling from on with `-o`.
-	Specify an interval to update on with `-i`.
+	Specify a message id to start backfilling from (going back) with `-o`.
+	Specify an interval (in messages) to update progress on with `-i`.
 	Add flag `-silent` to not show progress.
-	Use flag `-stop` to interrupt an ongoing backfill.
+	Use flag `-pause` (or `-stop`) to pause backfill of the group, and `-resume` to continue it.
+	Use flag `-list` to show all backfill jobs.
 	"""
-	global BACKFILL_STOP
-	if message.command["-stop"]:
-		BACKFILL_STOP = True
-		return await edit_or_reply(message, "` → ` Stopping")
-	if len(message.command) < 1:
-		return await edit_or_reply(message, "`[!] → ` No input")
-	limit = int(message.command[0])
-	offset = int(message.command["offset"] or 0)
+	if message.command["-list"]:
+		jobs = await DRIVER.backfill.jobs(DRIVER.db)
+		if not jobs:
+			return await edit_or_reply(message, "<code>[!] → </code> No backfill jobs", parse_mode=ParseMode.HTML)
+		out = f"<code>→ </code> <b>backfill</b> <i>{DRIVER.backfill}</i>\n"
+		for job in jobs:
+			out += f"<code> → </code> {await safe_get_chat(client, job['chat'])} <i>{job['state']}</i> " + \
+				f"[ <b>{sep(job['done'])} / {sep(job['limit'])}</b> ] at <code>{job['last_id']}</code>\n"
+			if "error" in job:
+				out += f"<code>  → </code> {html.escape(job['error'])}\n"
+		return await edit_or_reply(message, out, parse_mode=ParseMode.HTML)
 	target_group = message.chat
+	if "group" in message.command:
+		target_group = await client.get_chat(int(message.command["group"])
+			if message.command["group"].lstrip("-").isnumeric() else message.command["group"])
+	if message.command["-pause"] or message.command["-stop"]:
+		if DRIVER.backfill.pause(target_group.id):
+			return await edit_or_reply(message, "` → ` Pausing")
+		return await edit_or_reply(message, "`[!] → ` No backfill running in this chat")
 	interval = int(message.command["interval"] or 500)
 	silent = bool(message.command["-silent"])
 	msg = message
-	if "group" in message.command:
-		target_group = await client.get_chat(int(message.command["group"])
-			if message.command["group"].isnumeric() else message.command["group"])
 	if not silent and not is_me(message):
 		msg = await edit_or_reply(message, f"<code>$</code>backfill {message.command.text}", parse_mode=ParseMode.HTML) # ugly but will do ehhh
-	asyncio.create_task(
-		back_fill_messages(
-			client, msg, target_group, limit, offset,
-			interval, silent=silent
-		)
-	)
+
+	last = [0]
+	async def progress(job:dict):
+		if silent:
+			return
+		if job["state"] == "running" and job["done"] - last[0] < interval:
+			return
+		last[0] = job["done"]
+		status = "Done" if job["state"] == "done" else "Paused at" if job["state"] == "paused" else \
+			"Failed at" if job["state"] == "failed" else ""
+		await edit_or_reply(msg, f"<code> → </code> {status} [ <b>{sep(job['done'])} / {sep(job['limit'])}</b> ]", parse_mode=ParseMode.HTML)
+
+	if message.command["-resume"]:
+		job = await DRIVER.backfill.resume(DRIVER.db, client, target_group.id, progress=progress)
+		if not job:
+			return await edit_or_reply(message, "`[!] → ` No backfill to resume in this chat")
+		last[0] = job["done"]
+		return await progress(job)
+	if len(message.command) < 1:
+		return await edit_or_reply(message, "`[!] → ` No input")
+	limit = int(message.command[0])
+	offset = int(message.command["offset"] or 0)
+	try:
+		job = await DRIVER.backfill.start(DRIVER.db, client, target_group.id, limit, offset_id=offset, progress=progress)
+	except ValueError as e:
+		return await edit_or_reply(message, f"`[!] → ` {str(e)}")
+	await progress(job)
 
 # Handy ugly util to get chat off database
 async def safe_get_chat(client, chat):
@@ -187,10 +260,12 @@ async def source_cmd(client:alemiBot, message:Message):
 	msg = await edit_or_reply(message, f"<code>→ </code> Chats mentioning <code>{message.command[0]}</code> (<i>>= {minmsgs} times</i>)", parse_mode=ParseMode.HTML, disable_web_page_preview=True)
 	results = []
 	with ProgressChatAction(client, message.chat.id, action="playing") as prog:
-		for chat in await DRIVER.db.messages.distinct("chat", {"text": {"$regex": message.command[0]}}):
-			count = await DRIVER.db.messages.count_documents({"chat":chat,"text":{"$regex":message.command[0]}})
-			if count >= minmsgs:
-				results.append((await safe_get_chat(client, chat), count))
+		async for doc in DRIVER.db.messages.aggregate([
+			{"$match": DRIVER.keyword_query(message.command[0])},
+			{"$group": {"_id": "$chat", "count": {"$sum": 1}}},
+			{"$match": {"count": {"$gte": minmsgs}}},
+		]):
+			results.append((await safe_get_chat(client, doc["_id"]), doc["count"]))
 	if len(results) < 1:
 		return await edit_or_reply(msg, "<code>[!] → </code> No results", parse_mode=ParseMode.HTML)
 	results.sort(key= lambda x: x[1], reverse=True)
@@ -336,7 +411,7 @@ async def hist_cmd(client:alemiBot, message:Message):
 		else:
 			c_id = (await client.get_chat(message.command["group"])).id
 	LINE = "` → ` {date} {author} {text}\n"
-	doc = await DRIVER.db.messages.find_one({"id": m_id, "chat": c_id}, sort=[("date", DESCENDING)])
+	doc = expand_message(await DRIVER.db.messages.find_one({"id": m_id, "chat": c_id}, sort=[("date", DESCENDING)]))
 	if doc:
 		author = get_username(await client.get_users(doc['user']))
 		out = LINE.format(
@@ -344,13 +419,22 @@ async def hist_cmd(client:alemiBot, message:Message):
 			author=f"**{author}** >" if show_author else "",
 			text=html.escape(doc["text"] if "text" in doc else ""),
 		)
-		if "edits" in doc:
-			for edit in doc["edits"]:
-				out += LINE.format(
-					date=f"[--{edit['date']}--]" if show_time else "",
-					text=edit["text"],
-					author="",
+		edits = doc["edits"] if "edits" in doc else []
+		if DRIVER.edits_collection and "edit_count" in doc: # text is latest edit, history is in `edits`
+			edits = [ expand_message(e) async for e in DRIVER.db.edits.find({"chat": doc["chat"], "id": doc["id"]}).sort("date", ASCENDING) ]
+			if edits and edits[0].get("original"):
+				out = LINE.format(
+					date=f"[--{edits[0]['date']}--]" if show_time else "",
+					author=f"**{author}** >" if show_author else "",
+					text=html.escape(edits[0]["text"] or ""),
 				)
+				edits = edits[1:]
+		for edit in edits:
+			out += LINE.format(
+				date=f"[--{edit['date']}--]" if show_time else "",
+				text=edit.get("text") or "",
+				author="",
+			)
 		await edit_or_reply(message, out)
 	else:
 		await edit_or_reply(message, "`[!] → ` Nothing found")
@@ -17,6 +17,7 @@ from alemibot.util import (
 )
 
 from ..driver import DRIVER
+from ..util.search import rewrite_text_filter
 
 import logging
 logger = logging.getLogger(__name__)
@@ -88,7 +89,7 @@ async def frequency_cmd(client:alemiBot, message:Message):
 	words = []             		
 	curr = 0               		
 	with ProgressChatAction(client, message.chat.id) as prog:
-		cursor = DRIVER.db.messages.find(query).sort("date", DESCENDING)
+		cursor = DRIVER.db.messages.find(rewrite_text_filter(query, DRIVER.text_index)).sort("date", DESCENDING)
 		if limit > 0:
 			cursor.limit(limit)
 		async for doc in cursor:
@@ -1,12 +1,8 @@
 import io
 from datetime import datetime, timedelta
-from typing import Dict, Any
+from typing import Dict, Tuple, Any, Optional
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-
-from pymongo import DESCENDING
 
 from alemibot import alemiBot
 
@@ -17,12 +13,27 @@ from alemibot.util import (
 )
 
 from ..driver import DRIVER
+from ..util.plots import render_density, render_heatmap, render_timeshift
 
 import logging
 logger = logging.getLogger(__name__)
 
 HELP = HelpCategory("GRAPHS")
 
+def _activity_source(query:Dict[str, Any], offset:timedelta) -> Tuple[str, Optional[str]]:
+	"""collection to count messages from (and field to sum): hourly rollups, unless filtering by keyword
+	or shifting by an offset which isn't whole hours (rollup buckets can't be split)"""
+	if DRIVER.rollups and "text" not in query and offset.total_seconds() % 3600 == 0:
+		return "activity", "count"
+	return "messages", None
+
+def _bucket_arrays(counts:Dict[datetime, int]) -> Tuple[np.ndarray, np.ndarray]:
+	"""bucket start dates (datetime64) and their counts, newest first, for vectorized binning"""
+	dates = np.array(list(counts.keys()), dtype="datetime64[s]")
+	values = np.fromiter(counts.values(), dtype=np.int32, count=len(counts))
+	order = np.argsort(dates)[::-1]
+	return dates[order], values[order]
+
 @HELP.add(cmd="[<len>]", sudo=False)
 @alemiBot.on_message(is_allowed & filterCommand(["density", "activity"], options={
 	"group" : ["-g", "--group"],
@@ -75,52 +86,33 @@ async def density_cmd(client:alemiBot, message:Message):
 	if target_user:
 		query["user"] = target_user.id
 	if "keyword" in message.command:
-		query["text"] = {"$regex":f"{message.command['keyword']}"}
-
-	vals = np.zeros(length, dtype=np.int32)
-	await prog.tick()
-	async for msg in DRIVER.db.messages.find(query).sort("date", DESCENDING):
+		query.update(DRIVER.keyword_query(message.command["keyword"]))
+
+	chat_id = target_group.id if target_group else None
+	key = ("density", chat_id, target_user.id if target_user else None, message.command["keyword"], time_offset, length, now)
+	watermark = DRIVER.watermark(chat_id)
+	vals = DRIVER.results.get(key, watermark)
+	if vals is None:
+		vals = np.zeros(length, dtype=np.int32)
 		await prog.tick()
-		delta = (now - (msg["date"] + time_offset).date())
-		if delta.days >= length: # discard extra near limits
-			continue
-		vals[delta.days] += 1
-
-	buf = io.BytesIO()
-	dates = [ now - timedelta(i) for i in range(length) ]
-
-	fig, ax = plt.subplots()
-
-	ax.plot(dates, vals)
-	# Major ticks every 7 days.
-	ax.xaxis.set_major_locator(mdates.WeekdayLocator(byweekday=(6) if message.command["--sunday"] else (0)))
-	# Minor ticks every month.
-	ax.xaxis.set_minor_locator(mdates.DayLocator())
-	# Set formatter for dates on X axis depending on length
-	if length <= 7:
-		ax.xaxis.set_minor_formatter(mdates.DateFormatter('%a'))
-		ax.xaxis.set_major_formatter(mdates.DateFormatter('%a %-d'))
-	elif length <= 20:
-		ax.xaxis.set_major_formatter(mdates.DateFormatter('%a %-d'))
-	elif length <= 90:
-		ax.xaxis.set_major_formatter(mdates.DateFormatter('%-d %h'))
-	else:
-		ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+		coll, total = _activity_source(query, time_offset)
+		days, counts = _bucket_arrays(await DRIVER.storage.bucket_counts(coll, query, timedelta(days=1), time_offset, total=total))
+		delta = (np.datetime64(now, "D") - days.astype("datetime64[D]")).astype(np.int64)
+		keep = (delta >= 0) & (delta < length) # discard extra near limits
+		np.add.at(vals, delta[keep], counts[keep])
+		DRIVER.results.put(key, watermark, vals)
 
 	plot_title = "Msgs per day" + \
 		(f" ({get_username(target_group, mention=False)})" if target_group else '') + \
 		(f" [from {get_username(target_user, mention=False)}]" if target_user else '') + \
 		(f" containing `{message.command['keyword']}`" if message.command["keyword"] else '') + \
 		f" | last {length} days"
-	ax.set_title(plot_title)
-	# Turn on grid
-	ax.grid(True)
-
-	fig.autofmt_xdate()
-
-	fig.savefig(buf, dpi=dpi)
-
-	buf.seek(0)
+	png_key = (*key, bool(message.command["--sunday"]), dpi)
+	png = DRIVER.results.get(png_key, watermark)
+	if png is None:
+		png = await DRIVER.renderer.render(render_density, vals, now, bool(message.command["--sunday"]), plot_title, dpi)
+		DRIVER.results.put(png_key, watermark, png)
+	buf = io.BytesIO(png)
 	buf.name = "plot.png"
 
 	prog = ProgressChatAction(client, message.chat.id, action="upload_document")
@@ -187,20 +179,25 @@ async def heatmap_cmd(client:alemiBot, message:Message):
 	if target_user:
 		query["user"] = target_user.id
 	if "keyword" in message.command:
-		query["text"] = {"$regex":message.command['keyword']}
-
-	# Create numpy holder
-	vals = np.zeros((7,7), dtype=np.int32)
-	await prog.tick()
-	async for msg in DRIVER.db.messages.find(query).sort("date", DESCENDING):
+		query.update(DRIVER.keyword_query(message.command["keyword"]))
+
+	chat_id = target_group.id if target_group else None
+	key = ("heatmap", chat_id, target_user.id if target_user else None, message.command["keyword"], time_offset, now)
+	watermark = DRIVER.watermark(chat_id)
+	vals = DRIVER.results.get(key, watermark)
+	if vals is None:
+		# Create numpy holder
+		vals = np.zeros((7,7), dtype=np.int32)
 		await prog.tick()
-		date_corrected = (msg["date"] + time_offset).date()
-		delta = now - date_corrected # Find timedelta from msg to last_sunday
-		if delta.days // 7 >= 7: # discard extra near limits
-			continue
-		vals[delta.days // 7][date_corrected.weekday()] += 1 # Access week (//7) and weekday
+		coll, total = _activity_source(query, time_offset)
+		days, counts = _bucket_arrays(await DRIVER.storage.bucket_counts(coll, query, timedelta(days=1), time_offset, total=total))
+		days = days.astype("datetime64[D]")
+		delta = (np.datetime64(now, "D") - days).astype(np.int64) # days from msg to last_sunday
+		weekday = (days.astype(np.int64) + 3) % 7 # 1970-01-01 was a Thursday
+		keep = (delta >= 0) & (delta // 7 < 7) # discard extra near limits
+		np.add.at(vals, (delta[keep] // 7, weekday[keep]), counts[keep]) # Access week (//7) and weekday
+		DRIVER.results.put(key, watermark, vals)
 
-	buf = io.BytesIO()
 	dates = [ ( now - timedelta((i*7)+6), now - timedelta(i*7) ) for i in range(7) ] # tuple with week bounds for labels
 
 	week_numbers = []
@@ -213,36 +210,16 @@ async def heatmap_cmd(client:alemiBot, message:Message):
 	if message.command["--sunday"]:
 		week_days = week_days[6:] + week_days[:6]
 
-	
-	fig, ax = plt.subplots()
-	im = ax.imshow(vals)
-	
-	# Add ticks to heatmap
-	ax.set_xticks(np.arange(7))
-	ax.set_yticks(np.arange(7))
-	ax.set_xticklabels(week_days)
-	ax.set_yticklabels(week_numbers)
-	
-	# Rotate the tick labels and set their alignment.
-	plt.setp(ax.get_xticklabels(), rotation=45, ha="right",
-	         rotation_mode="anchor")
-	
-	# Loop over data dimensions and create text annotations.
-	for i in range(len(week_numbers)):
-	    for j in range(len(week_days)):
-	        text = ax.text(j, i, vals[i, j],
-	                       ha="center", va="center", color="w")
-	
 	plot_title = "Msgs per weekday" + \
 		(f" ({get_username(target_group, mention=False)})" if target_group else '') + \
 		(f" [from {get_username(target_user, mention=False)}]" if target_user else '') + \
 		(f" containing `{message.command['keyword']}`" if message.command["keyword"] else '')
-	ax.set_title(plot_title)
-	fig.tight_layout()
-
-	fig.savefig(buf, dpi=dpi)
-
-	buf.seek(0)
+	png_key = (*key, bool(message.command["--sunday"]), dpi)
+	png = DRIVER.results.get(png_key, watermark)
+	if png is None:
+		png = await DRIVER.renderer.render(render_heatmap, vals, week_numbers, week_days, plot_title, dpi)
+		DRIVER.results.put(png_key, watermark, png)
+	buf = io.BytesIO(png)
 	buf.name = "plot.png"
 
 	prog = ProgressChatAction(client, message.chat.id, action="upload_document")
@@ -308,33 +285,39 @@ async def timeshift_cmd(client:alemiBot, message:Message):
 	if target_user:
 		query["user"] = target_user.id
 	if "keyword" in message.command:
-		query["text"] = {"$regex":f"{message.command['keyword']}"}
-
-	# Create numpy holder
-	vals = np.zeros(24, dtype=np.int32)
-	count = 0
-	await prog.tick()
-	async for msg in DRIVER.db.messages.find(query).sort("date", DESCENDING).limit(limit):
+		query.update(DRIVER.keyword_query(message.command["keyword"]))
+
+	chat_id = target_group.id if target_group else None
+	key = ("timeshift", chat_id, target_user.id if target_user else None, message.command["keyword"], time_offset, limit)
+	watermark = DRIVER.watermark(chat_id)
+	cached = DRIVER.results.get(key, watermark)
+	if cached is not None:
+		vals, count = cached
+	else:
+		# Create numpy holder
+		vals = np.zeros(24, dtype=np.int32)
 		await prog.tick()
-		h = int((msg['date'].time().hour + time_offset) % 24)
-		vals[h] += 1
-		count += 1
+		coll, total = _activity_source(query, timedelta(hours=time_offset))
+		counts = await DRIVER.storage.bucket_counts(coll, query, timedelta(hours=1), timedelta(hours=time_offset),
+			limit=None if total else limit, total=total)
+		hours, counts = _bucket_arrays(counts)
+		before = np.cumsum(counts) - counts # rollups can't be limited by message: take newest hours up to limit
+		counts = np.clip(limit - before, 0, counts).astype(np.int32)
+		np.add.at(vals, hours.astype("datetime64[h]").astype(np.int64) % 24, counts)
+		count = int(counts.sum())
+		DRIVER.results.put(key, watermark, (vals, count))
 
-	buf = io.BytesIO()
-	# labels = [ f"{i:02d}:00-{i+1:02d}:00" for i in range(24) ]
-	labels = [ f"{i:02d}" for i in range(24) ]
-
-	fig = plt.figure()
-	plt.bar(labels, vals)
 	plot_title = "Msgs at hour of day" + \
 		(f" ({get_username(target_group, mention=False)})" if target_group else '') + \
 		(f" [from {get_username(target_user, mention=False)}]" if target_user else '') + \
 		(f" containing `{message.command['keyword']}`" if message.command["keyword"] else '') + \
 		f" | last {sep(count)}"
-	plt.title(plot_title)
-	fig.savefig(buf, dpi=dpi)
-
-	buf.seek(0)
+	png_key = (*key, dpi)
+	png = DRIVER.results.get(png_key, watermark)
+	if png is None:
+		png = await DRIVER.renderer.render(render_timeshift, vals, plot_title, dpi)
+		DRIVER.results.put(png_key, watermark, png)
+	buf = io.BytesIO(png)
 	buf.name = "plot.png"
 
 	prog = ProgressChatAction(client, message.chat.id, action="upload_document")
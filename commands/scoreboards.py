@@ -71,27 +71,26 @@ async def stats_cmd(client:alemiBot, message:Message):
 	uid = user["id"]
 	total_messages = int(user["messages"] if "messages" in user else 0)
 	with ProgressChatAction(client, message.chat.id) as prog:
-		total_media = await DRIVER.db.messages.count_documents({"user":uid,"media":{"$exists":1}})
-		total_edits = await DRIVER.db.messages.count_documents({"user":uid,"edits":{"$exists":1}})
-		total_replies = await DRIVER.db.messages.count_documents({"user":uid,"reply":{"$exists":1}})
-		visited_chats = len(await DRIVER.db.service.distinct("chat", {"user":uid}))
-		partecipated_chats = len(await DRIVER.db.messages.distinct("chat", {"user":uid}))
-		scoreboard_all_users = await DRIVER.db.users.find({"flags.bot":False}, {"_id":0,"id":1,"messages":1}).to_list(None)
-		scoreboard_all_users = sorted([ (doc["id"], doc["messages"]) for doc in scoreboard_all_users if "messages" in doc ], key=lambda x: -x[1])
+		total_media = await DRIVER.storage.count("messages", {"user":uid,"media":{"$exists":1}})
+		total_edits = await DRIVER.storage.count("messages", {"user":uid, **DRIVER.edited_query})
+		total_replies = await DRIVER.storage.count("messages", {"user":uid,"reply":{"$exists":1}})
+		visited_chats = len(await DRIVER.storage.distinct("service", "chat", {"user":uid}))
+		partecipated_chats = len(await DRIVER.storage.distinct("messages", "chat", {"user":uid}))
+		scoreboard_all_users = [ (doc["id"], msgs) for doc, msgs in await DRIVER.storage.top("users", "messages", {"flags.bot":False}) ]
 		scoreboard_id_only = [x[0] for x in scoreboard_all_users]
 		position = (scoreboard_id_only.index(user["id"]) + 1) if user["id"] in scoreboard_id_only else len(scoreboard_id_only)
 		position = sep(position) + (f" {'☆'*(4-position)}" if position < 4 else "")
 		# Calculate msgs/minute sent today
 		today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) # Force start of day
 		minutes_passed_today = (datetime.utcnow() - today).total_seconds() / 60
-		msgs_today = await DRIVER.db.messages.count_documents({"user":uid,"date":{"$gte":today}})
+		msgs_today = await DRIVER.storage.count("messages", {"user":uid,"date":{"$gte":today}})
 		msgs_per_minute_today = msgs_today / minutes_passed_today
 		# Calculate oldest message
 		oldest = datetime.now()
-		oldest_message = await DRIVER.db.messages.find_one({"user":uid}, sort=[("date",ASCENDING)])
+		oldest_message = await DRIVER.storage.find_one("messages", {"user":uid}, sort=[("date",ASCENDING)])
 		if oldest_message:
 			oldest = oldest_message["date"]
-		oldest_event = await DRIVER.db.service.find_one({"user":uid}, sort=[("date",ASCENDING)])
+		oldest_event = await DRIVER.storage.find_one("service", {"user":uid}, sort=[("date",ASCENDING)])
 		if oldest_event:
 			oldest = min(oldest, oldest_event["date"])
 	points = (
@@ -137,31 +136,29 @@ async def group_stats_cmd(client:alemiBot, message:Message):
 	if group.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
 		return await edit_or_reply(message, "`[!] → ` Group stats available only in groups and supergroups")
 	with ProgressChatAction(client, message.chat.id) as prog:
-		group_doc = await DRIVER.db.chats.find_one({"id":group.id, "messages":{"$exists":1}}, {"_id":0, "id":1, "messages":1})
+		group_doc = await DRIVER.storage.find_one("chats", {"id":group.id, "messages":{"$exists":1}})
 		# total_messages = sum(group_doc["messages"][val] for val in group_doc["messages"]) if "messages" in group_doc else 0
 		total_messages = group_doc["messages"]["total"]
 		active_users = max(0, len(group_doc["messages"] if "messages" in group_doc else '') -1) # jank af don't judge me it works
 		total_users = await client.get_chat_members_count(group.id)
-		total_media = await DRIVER.db.messages.count_documents({"chat":group.id,"media":{"$exists":1}})
-		total_edits = await DRIVER.db.messages.count_documents({"chat":group.id,"edits":{"$exists":1}})
-		total_replies = await DRIVER.db.messages.count_documents({"chat":group.id,"reply":{"$exists":1}})
-		scoreboard_all_chats = await DRIVER.db.chats.find({}, {"_id":0,"id":1,"messages":1}).to_list(None)
-		# scoreboard_all_chats = sorted([ (doc["id"], sum(doc["messages"][val] for val in doc["messages"]) if "messages" in doc else 0) for doc in scoreboard_all_chats ], key=lambda x: -x[1])
-		scoreboard_all_chats = sorted([ (doc["id"], doc["messages"]["total"]) for doc in scoreboard_all_chats if "messages" in doc and "total" in doc["messages"] ], key=lambda x: -x[1])
+		total_media = await DRIVER.storage.count("messages", {"chat":group.id,"media":{"$exists":1}})
+		total_edits = await DRIVER.storage.count("messages", {"chat":group.id, **DRIVER.edited_query})
+		total_replies = await DRIVER.storage.count("messages", {"chat":group.id,"reply":{"$exists":1}})
+		scoreboard_all_chats = [ (doc["id"], msgs) for doc, msgs in await DRIVER.storage.top("chats", "messages.total") ]
 		scoreboard_id_only = [x[0] for x in scoreboard_all_chats]
 		position = (scoreboard_id_only.index(group.id) + 1) if group.id in scoreboard_id_only else len(scoreboard_id_only)
 		position = sep(position) + (f" {'☆'*(4-position)}" if position < 4 else "")
 		# Calculate msgs/minute sent today
 		today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) # Force start of day
 		minutes_passed_today = (datetime.utcnow() - today).total_seconds() / 60
-		msgs_today = await DRIVER.db.messages.count_documents({"chat":group.id,"date":{"$gte":today}})
+		msgs_today = await DRIVER.storage.count("messages", {"chat":group.id,"date":{"$gte":today}})
 		msgs_per_minute_today = msgs_today / minutes_passed_today
 		# Calculate oldest message
 		oldest = datetime.now()
-		oldest_message = await DRIVER.db.messages.find_one({"chat":group.id}, sort=[("date",ASCENDING)])
+		oldest_message = await DRIVER.storage.find_one("messages", {"chat":group.id}, sort=[("date",ASCENDING)])
 		if oldest_message:
 			oldest = oldest_message["date"]
-		oldest_event = await DRIVER.db.service.find_one({"chat":group.id}, sort=[("date",ASCENDING)])
+		oldest_event = await DRIVER.storage.find_one("service", {"chat":group.id}, sort=[("date",ASCENDING)])
 		if oldest_event:
 			oldest = min(oldest, oldest_event["date"])
 	welcome = random.choice(["Greetings", "Hello", "Good day"])
@@ -202,13 +199,8 @@ async def top_groups_cmd(client:alemiBot, message:Message):
 	res = []
 	out = ""
 	with ProgressChatAction(client, message.chat.id) as prog:
-		async for doc in DRIVER.db.chats.find({}, {"type":1, "messages.total":1, "title":1, "id":1, "username":1}):
-			if doc["type"] not in ("group", "supergroup"):
-				continue
-			# res.append((doc, sum(doc["messages"][val] for val in doc["messages"]) if "messages" in doc else 0))
-			if "messages" in doc and "total" in doc["messages"]:
-				res.append((doc, doc["messages"]["total"]))
-		res.sort(key=lambda x: -x[1])
+		res = await DRIVER.storage.top("chats", "messages.total", {"type":{"$in":["group", "supergroup"]}},
+			fields=("id", "type", "title", "username"))
 		if len(message.command) > 0 and len(res) > results:
 			target_group = await client.get_chat(int(message.command[0]) if message.command[0].isnumeric() else message.command[0])
 			offset += [ doc[0]["id"] for doc in res ].index(target_group.id) - (results // 2)
@@ -261,20 +253,25 @@ async def top_messages_cmd(client:alemiBot, message:Message):
 	out = "<code>→ </code> Messages sent <b>globally</b>\n" if global_search else f"<code>→ </code> Messages sent in <b>{get_username(target_chat)}</b>\n"
 	msg = await edit_or_reply(message, out, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
 	with ProgressChatAction(client, message.chat.id) as prog:
-		if global_search:
-			query : Dict[str, Any] = {"messages":{"$exists":1}}
-			if not message.command["-bots"]:
-				query["flags.bot"] = False
-			async for u in DRIVER.db.users.find(query, {"_id":0,"id":1,"messages":1}):
-				res.append((u['id'], u['messages']))
-		else:
-			doc = await DRIVER.db.chats.find_one({"id":target_chat.id}, {"_id":0, "messages":1})
-			if not doc or not doc["messages"]:
-				return await edit_or_reply(msg, "<code>[!] → </code> No data available")
-			res = [ (int(k), doc["messages"][k]) for k in doc["messages"].keys() if k.isnumeric() ]
+		chat_id = None if global_search else target_chat.id
+		key = ("topmsg", chat_id, bool(global_search and message.command["-bots"]))
+		watermark = DRIVER.watermark(chat_id)
+		res = DRIVER.results.get(key, watermark)
+		if res is None:
+			if global_search:
+				query : Dict[str, Any] = {"messages":{"$exists":1}}
+				if not message.command["-bots"]:
+					query["flags.bot"] = False
+				res = [ (u["id"], msgs) for u, msgs in await DRIVER.storage.top("users", "messages", query) ]
+			else:
+				doc = await DRIVER.storage.find_one("chats", {"id":target_chat.id})
+				if not doc or not doc["messages"]:
+					return await edit_or_reply(msg, "<code>[!] → </code> No data available")
+				res = [ (int(k), doc["messages"][k]) for k in doc["messages"].keys() if k.isnumeric() ]
+			res.sort(key=lambda x: -x[1])
+			DRIVER.results.put(key, watermark, res)
 		if len(res) < 1:
 			return await edit_or_reply(msg, "<code>[!] → </code> No results")
-		res.sort(key=lambda x: -x[1])
 		if len(message.command) > 0 and len(res) > results:
 			target_user = await client.get_users(int(message.command[0]) if message.command[0].isnumeric() else message.command[0])
 			offset += user_index(res, target_user.id) - (results // 2)
@@ -1,89 +1,82 @@
 import asyncio
 import functools
-import traceback
 
+from time import time
+from random import random
 from datetime import datetime
-from typing import Any, List, Callable, Dict
+from typing import Any, List, Callable, Awaitable, Dict, Optional, Set, Tuple
 
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from pymongo.errors import ServerSelectionTimeoutError, DuplicateKeyError
-from pymongo import ASCENDING, DESCENDING, MongoClient
+from pymongo.errors import ServerSelectionTimeoutError, DuplicateKeyError, BulkWriteError
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument, UpdateOne
 
 from pyrogram import Client
 from pyrogram.types import Message, User, ChatMemberUpdated
 from pyrogram.errors import PeerIdInvalid, ChannelPrivate
-from pyrogram.enums import ChatType
+from pyrogram.enums import ChatType, UserStatus
 
 from alemibot import alemiBot
 from alemibot.util.serialization import convert_to_dict
 
+from .util.accumulator import IncrementAccumulator, counter_filter
+from .util.batching import MessageBatch, LastOnlineTable
+from .util.cache import DocumentCache, ResultCache
+from .util.ingest import IngestQueue
+from .util.media import MediaDownloader
+from .util.spool import Spool
+from .util.indexes import IndexManager, INDEXES, TEXT_INDEX
+from .util.compact import compact_message
+from .util.storage import StorageBackend, MongoBackend
+from .util.backfill import BackfillManager
+from .util.archive import RawArchive
+from .util.errors import ExceptionAggregator
+from .util.rollups import ACTIVITY_KEYS, activity_key
+from .util.plots import PlotRenderer
+from .util.search import keyword_filter
+from .util.metrics import MetricsRegistry, SERIALIZE_TIME
 from .util.serializer import (
 	diff, extract_chat, extract_member_update, extract_message, extract_user, extract_delete, 
-	extract_service_message, extract_edit_message
+	extract_service_message, extract_edit_message, extract_message_key
 )
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-class Counter:
-	"""Auto-Increasing Counter. Has a dict of keys which start at 0. Every time an attr is accessed, a new function
-	   increasing value of key with same name is returned (inserted equal to 0 if missing). To get values,
-	   use hash [] access (__getitem__). Initialize this with a list of strings (not really necessary)
-	   Increase (and add new value if missing) just with
-	   		counter.something() """
-	def __init__(self, keys:list):
-		self.start = datetime.now()
-		self.storage = { k : 0 for k in keys }
-
-	def __getattr__(self, name:str) -> Callable[[], int]:
-		if name not in self.storage:
-			self.storage[name] = 0
-		def incr():
-			self.storage[name] += 1
-			return self.storage[name]
-		return incr
-
-	def __str__(self) -> str:
-		return str(self.storage)
-
-	def __contains__(self, name:str) -> bool:
-		return name in self.storage
-
-	def __getitem__(self, name:str) -> Any:
-		if name not in self.storage:
-			return 0
-		return self.storage[name]
-
-	def __setitem__(self, name:str, value:Any):
-		self.storage[name] = value
-
 def _log_error_event(func: Callable):
 	"""will log exceptions to db
 
 	If an error happens while parsing and serializing an event, this decorator
-	will catch it and log to a separate db the whole event with a stacktrace.
+	will catch it and count it in `exceptions`, grouped by fingerprint, with a few sample events.
 	"""
+	hook = func.__name__.replace("parse_", "").replace("log_", "").replace("_event", "")
 	@functools.wraps(func)
 	async def wrapper(self, event:Any, *args, **kwargs):
+		self.metrics.incr(f"{hook}_events")
+		token = SERIALIZE_TIME.set(0.0)
+		start = time()
 		try:
 			await func(self, event, *args, **kwargs)
 		except ServerSelectionTimeoutError as ex:
+			self.metrics.error(hook)
 			logger.error("Could not connect to MongoDB")
 			logger.info(str(event))
 		except DuplicateKeyError as e:
+			self.metrics.error(hook)
 			error_key = getattr(e, '_OperationFailure__details')["keyValue"]
 			logger.warning(f"Rejecting duplicate document\n\t{error_key}\n\t{str(event)}")
 		except Exception as ex:
-			logger.exception("Serialization error")
-			exc_data = {
-				"type" : repr(ex),
-				"text" : str(ex),
-				"traceback" : traceback.format_exc(),
-			}
-			doc = convert_to_dict(event)
-			doc["exception"] = exc_data
-			await self.db.exceptions.insert_one(doc)
+			self.metrics.error(hook)
+			fp = self.exceptions.record(ex, hook, event, convert_to_dict)
+			if self.exceptions.due(fp): # log and write once per interval, a broken type can fail every event
+				logger.exception("Serialization error [%s]", fp)
+				await self.exceptions.write(self.db, fp)
+		finally:
+			elapsed = time() - start
+			serialize = SERIALIZE_TIME.get()
+			SERIALIZE_TIME.reset(token)
+			self.metrics.observe(hook, "serialize", serialize)
+			self.metrics.observe(hook, "db", elapsed - serialize)
 	return wrapper
 
 async def insert_replace(db:AsyncIOMotorDatabase, collection:str, doc:dict) -> bool:
@@ -102,32 +95,165 @@ async def insert_replace(db:AsyncIOMotorDatabase, collection:str, doc:dict) -> b
 		)
 	return False
 
-def has_index(indexes, index):
-	for name in indexes:
-		if indexes[name]["key"] == index:
-			return True
-	return False
+UNIQUE_KEYS = { # fields of alemibot-unique-* indexes
+	"messages" : ("chat", "id", "date"),
+	"service" : ("chat", "id", "date"),
+	"deletions" : ("chat", "id", "date"),
+	"edits" : ("chat", "id", "date"),
+}
+
+COUNTER_KEYS = { # counters with compound keys, other counters are keyed by `id`
+	"activity" : ACTIVITY_KEYS,
+}
+
+async def upsert_replace(db:AsyncIOMotorDatabase, collection:str, doc:dict, audit:float = 0.0) -> bool:
+	"""Insert a document or replace its duplicate, in a single round trip
+
+	Documents are upserted against the collection unique key. A fraction `audit` of writes is done with
+	find_one_and_replace instead, so that if a duplicate was replaced it gets recorded in `replacements`.
+	"""
+	key = { k: doc.get(k) for k in UNIQUE_KEYS[collection] }
+	if audit and random() < audit:
+		prev = await db[collection].find_one_and_replace(key, doc, upsert=True)
+		if prev:
+			await db.replacements.insert_one({"coll": collection, "date": datetime.now(), "prev": prev, "new": doc})
+		return prev is None
+	res = await db[collection].replace_one(key, doc, upsert=True)
+	return res.upserted_id is not None
 
 class DatabaseDriver:
 	log_messages : bool
 	log_service : bool
 	log_media : bool
+	log_raw : bool
+	rollups : bool
+	compact : bool
+	edits_collection : bool
 
-	counter : Counter
+	metrics : MetricsRegistry
 	client: AsyncIOMotorClient
 	db : AsyncIOMotorDatabase
+	storage : StorageBackend
+	batch : Optional[MessageBatch]
+	increments : Optional[IncrementAccumulator]
+	cache : Dict[str, DocumentCache]
+	results : ResultCache
+	watermarks : Dict[Optional[int], int]
+	queue : Optional[IngestQueue]
+	statuses : Optional[LastOnlineTable]
+	media : Optional[MediaDownloader]
+	spool : Optional[Spool]
+	indexes : IndexManager
+	backfill : Optional[BackfillManager]
+	archive : Optional[RawArchive]
+	renderer : Optional[PlotRenderer]
+	exceptions : ExceptionAggregator
+	upsert : bool
+	audit_rate : float
 
 	def __init__(self):
 		self.log_messages = False
 		self.log_service = False
 		self.log_media = False
-
-		self.counter : Counter = Counter(["service", "messages", "deletions", "edits", "users", "chats"])
+		self.log_raw = False
+		self.rollups = False
+		self.compact = False
+		self.edits_collection = False
+
+		self.metrics = MetricsRegistry()
+		self.metrics_file = None
+		self.metrics_interval = 60.0
+		self.batch = None
+		self.increments = None
+		self.cache = { "users": DocumentCache(), "chats": DocumentCache() }
+		self.results = ResultCache()
+		self.watermarks = {}
+		self.queue = None
+		self.statuses = None
+		self.media = None
+		self.spool = None
+		self.spool_interval = 10.0
+		self.indexes = IndexManager()
+		self.backfill = None
+		self.archive = None
+		self.renderer = None
+		self.exceptions = ExceptionAggregator()
+		self.upsert = False
+		self.audit_rate = 0.0
+		self._tasks : List[asyncio.Task] = []
+		self._pending : Set[asyncio.Task] = set()
 
 	async def configure(self, app:alemiBot):
 		self.log_messages = app.config.getboolean("database", "log_messages", fallback=True)
 		self.log_service = app.config.getboolean("database", "log_service", fallback=True)
 		self.log_media = app.config.getboolean("database", "log_media", fallback=False)
+		self.log_raw = app.config.getboolean("database", "log_raw", fallback=False)
+		self.rollups = app.config.getboolean("database", "rollups", fallback=False)
+		self.compact = app.config.get("database", "schema", fallback="full") == "compact"
+		self.edits_collection = app.config.get("database", "edits", fallback="embedded") == "collection"
+		if self.log_media:
+			self.media = MediaDownloader(
+				app, self.attach_file,
+				workers=app.config.getint("database", "media_workers", fallback=2),
+				max_size=app.config.getint("database", "media_max_size", fallback=0),
+				directory=app.config.get("database", "media_dir", fallback="plugins/statsbot/data/"),
+			)
+		self.upsert = app.config.get("database", "duplicates", fallback="replace") == "upsert"
+		self.audit_rate = app.config.getfloat("database", "audit_rate", fallback=0.01)
+		if app.config.getboolean("database", "batch_ingest", fallback=False):
+			self.batch = MessageBatch(
+				size=app.config.getint("database", "batch_size", fallback=500),
+				interval=app.config.getfloat("database", "batch_interval", fallback=1.0),
+				upsert=self.upsert,
+			)
+		counter_interval = app.config.getfloat("database", "counter_interval", fallback=0.0)
+		if self.batch is not None and not counter_interval:
+			counter_interval = self.batch.interval # batched messages need batched counters too
+		if counter_interval > 0:
+			self.increments = IncrementAccumulator(interval=counter_interval, keys=COUNTER_KEYS)
+		status_interval = app.config.getfloat("database", "status_interval", fallback=0.0)
+		if status_interval > 0:
+			self.statuses = LastOnlineTable(
+				interval=status_interval,
+				granularity=app.config.getfloat("database", "status_granularity", fallback=0.0),
+			)
+		if app.config.getboolean("database", "spool", fallback=False):
+			self.spool = Spool(
+				path=app.config.get("database", "spool_path", fallback="plugins/statsbot/spool/spool.db"),
+				unique_keys=UNIQUE_KEYS,
+			)
+			self.spool_interval = app.config.getfloat("database", "spool_interval", fallback=10.0)
+		if app.config.get("database", "raw_storage", fallback="mongo") == "archive":
+			self.archive = RawArchive(
+				directory=app.config.get("database", "archive_dir", fallback="plugins/statsbot/archive/"),
+				interval=app.config.getfloat("database", "archive_interval", fallback=10.0),
+				size=app.config.getint("database", "archive_batch", fallback=5000),
+				max_bytes=app.config.getint("database", "archive_file_size", fallback=64 * 1024 * 1024),
+			)
+		self.renderer = PlotRenderer(workers=app.config.getint("database", "render_workers", fallback=2))
+		self.exceptions = ExceptionAggregator(
+			interval=app.config.getfloat("database", "exception_interval", fallback=60.0),
+			samples=app.config.getint("database", "exception_samples", fallback=10),
+		)
+		self.metrics_file = app.config.get("database", "metrics_file", fallback=None)
+		self.metrics_interval = app.config.getfloat("database", "metrics_interval", fallback=60.0)
+		cache_size = app.config.getint("database", "cache_size", fallback=10000)
+		cache_ttl = app.config.getfloat("database", "cache_ttl", fallback=0)
+		self.cache = { coll: DocumentCache(size=cache_size, ttl=cache_ttl) for coll in ("users", "chats") }
+		self.results = ResultCache(
+			budget=app.config.getint("database", "result_cache", fallback=32 * 1024 * 1024),
+			ttl=app.config.getfloat("database", "result_ttl", fallback=3600),
+		)
+		queue_size = app.config.getint("database", "ingest_queue", fallback=0)
+		if queue_size > 0:
+			self.queue = IngestQueue(
+				self._process,
+				size=queue_size,
+				workers=app.config.getint("database", "ingest_workers", fallback=4),
+				policy=app.config.get("database", "ingest_policy", fallback="block"),
+				spill_path=app.config.get("database", "ingest_spill", fallback="plugins/statsbot/spool/ingest.spill"),
+				client=app,
+			)
 
 		kwargs : Dict[str, Any] = {}
 		host = app.config.get("database", "host", fallback="localhost")
@@ -143,49 +269,211 @@ class DatabaseDriver:
 		self.client = AsyncIOMotorClient(host, port, **kwargs)
 
 		self.db = self.client[dbname]
+		self.storage = MongoBackend(self.db)
+
+		if app.config.getboolean("database", "text_index", fallback=False):
+			self.indexes = IndexManager(INDEXES + [TEXT_INDEX])
+		# Check (and create if missing) essential indexes, in background so that startup isn't held up
+		self._tasks.append(asyncio.create_task(self.indexes.ensure(self.db)))
+
+		if self.upsert and "replacements" not in await self.db.list_collection_names():
+			await self.db.create_collection("replacements", capped=True,
+				size=app.config.getint("database", "audit_size", fallback=16 * 1024 * 1024))
+
+		if self._buffers():
+			self._tasks.append(asyncio.create_task(self._flush_loop()))
+		if self.spool is not None:
+			self._tasks.append(asyncio.create_task(self._replay_loop()))
+		if self.metrics_file:
+			self._tasks.append(asyncio.create_task(self._metrics_loop()))
+		if self.queue is not None:
+			self.queue.start()
+		self.backfill = BackfillManager(
+			self.backfill_page,
+			concurrency=app.config.getint("database", "backfill_concurrency", fallback=2),
+			rate=app.config.getfloat("database", "backfill_rate", fallback=1.0),
+			burst=app.config.getint("database", "backfill_burst", fallback=5),
+		)
+		self._tasks.append(asyncio.create_task(self.backfill.resume_all(self.db, app)))
+
+	async def dispatch(self, method:str, event:Any, **kwargs):
+		"""hand an event to the parse method with given name, through the ingest queue if enabled"""
+		if self.queue is not None:
+			return await self.queue.put(method, event, kwargs)
+		await self._process(method, event, kwargs)
+
+	async def _process(self, method:str, event:Any, kwargs:Dict[str, Any]):
+		await getattr(self, method)(event, **kwargs)
+
+	async def stop(self):
+		"""stop background tasks and write any buffered event"""
+		if self.queue is not None:
+			await self.queue.stop()
+		if self.media is not None:
+			await self.media.stop()
+		if self.backfill is not None:
+			await self.backfill.stop()
+		if self.renderer is not None:
+			self.renderer.stop()
+		self.indexes.stop()
+		for task in self._tasks:
+			task.cancel()
+		self._tasks = []
+		if self._pending:
+			await asyncio.gather(*self._pending, return_exceptions=True)
+		for _buf, flush in self._buffers():
+			await flush()
+		if self.spool is not None:
+			self.spool.close()
+
+	def _buffers(self) -> List[Tuple[Any, Callable[[], Awaitable[None]]]]:
+		"""enabled write-behind buffers with their flush method, in the order they should be flushed"""
+		return [ (buf, flush) for buf, flush in (
+			(self.batch, self.flush_batch),
+			(self.increments, self.flush_increments),
+			(self.statuses, self.flush_statuses),
+			(self.archive, self.flush_archive),
+			(self.exceptions, self.flush_exceptions),
+		) if buf is not None ]
+
+	async def _flush_loop(self):
+		buffers = self._buffers()
+		interval = min(buf.interval for buf, _flush in buffers)
+		while True:
+			await asyncio.sleep(interval / 2)
+			for buf, flush in buffers:
+				if buf.expired:
+					await flush()
+
+	async def _metrics_loop(self):
+		while True:
+			await asyncio.sleep(self.metrics_interval)
+			try:
+				self.metrics.write_textfile(self.metrics_file)
+			except OSError:
+				logger.exception("Could not write metrics to %s", self.metrics_file)
+
+	async def _replay_loop(self):
+		while True:
+			await asyncio.sleep(self.spool_interval)
+			try:
+				while await self.spool.replay(self.db):
+					pass
+			except ServerSelectionTimeoutError:
+				pass # still down, try again later
+			except Exception:
+				logger.exception("Error while replaying spooled writes")
+
+	async def flush_batch(self):
+		"""write all buffered message events to db"""
+		try:
+			inserted, new_users, duplicates = await self.batch.flush(self.db, spool=self.spool)
+			self.metrics.incr("messages", inserted)
+			self.metrics.incr("users", new_users)
+			for doc in duplicates:
+				doc.pop("_id", None)
+				await self.insert("messages", doc)
+		except ServerSelectionTimeoutError:
+			logger.error("Could not connect to MongoDB, dropping buffered events")
+		except Exception:
+			logger.exception("Error while flushing buffered events")
+
+	async def flush_increments(self):
+		"""write all accumulated counter increments to db"""
+		try:
+			await self.increments.flush(self.db, spool=self.spool)
+		except Exception:
+			logger.exception("Error while flushing counters")
+
+	async def flush_statuses(self):
+		"""write all coalesced last online dates to db"""
+		try:
+			await self.statuses.flush(self.db, spool=self.spool)
+		except Exception:
+			logger.exception("Error while flushing user statuses")
 
-		# Check (and create if missing) essential indexes
-		logger.info("Checking index (may take a while first time...)")
-
-		# Build dates indexes first
-		if not has_index(await self.db.messages.index_information(), [("date",-1)]):
-			await self.db.messages.create_index([("date",-1)], name="alemibot-chronological")
-		if not has_index(await self.db.service.index_information(), [("date",-1)]):
-			await self.db.service.create_index([("date",-1)], name="alemibot-chronological")
-		if not has_index(await self.db.deletions.index_information(), [("date",-1)]):
-			await self.db.deletions.create_index([("date",-1)], name="alemibot-chronological")
-		if not has_index(await self.db.members.index_information(), [("date",-1)]):
-			await self.db.members.create_index([("date",-1)], name="alemibot-chronological")
-		# This is not unique but still speeds up a ton
-		if not has_index(await self.db.members.index_information(), [("chat",1),("user",1),("date",1)]):
-			await self.db.members.create_index([("chat",1),("user",1),("date",1)], name="alemibot-member-history")
-		# This is very useful for counting messages for each member
-		if not has_index(await self.db.messages.index_information(), [("user",1)]):
-			await self.db.messages.create_index([("user",1)], name="alemibot-per-user")
-		if not has_index(await self.db.service.index_information(), [("user",1)]):
-			await self.db.service.create_index([("user",1)], name="alemibot-per-user")
-		# Building these may fail, run datafix script with duplicates option
+	async def flush_archive(self):
+		"""compress and append buffered raw events to the archive, off the event loop"""
 		try:
-			if not has_index(await self.db.messages.index_information(), [("chat",1),("id",1),("date",-1)]):
-				await self.db.messages.create_index([("chat",1),("id",1),("date",-1)],
-												name="alemibot-unique-messages", unique=True)
-			if not has_index(await self.db.service.index_information(), [("chat",1),("id",1),("date",-1)]):
-				await self.db.service.create_index([("chat",1),("id",1),("date",-1)],
-												name="alemibot-unique-service", unique=True)
-			if not has_index(await self.db.deletions.index_information(), [("chat",1),("id",1),("date",-1)]):
-				await self.db.deletions.create_index([("chat",1),("id",1),("date",-1)],
-												name="alemibot-unique-deletions", unique=True)
-		except:
-			logger.exception("Error while building unique indexes. Check util/datafix.py if there are duplicates")
-		# Then make user and chat indexes
+			written = await asyncio.get_running_loop().run_in_executor(None, self.archive.write, *self.archive.take())
+			self.metrics.incr("raw", written)
+		except Exception:
+			logger.exception("Error while writing raw events to archive")
+
+	async def flush_exceptions(self):
+		"""write counts and samples of exceptions seen since last write"""
+		await self.exceptions.flush(self.db)
+
+	async def increment(self, collection:str, key:Any, field:str, amount:int = 1):
+		"""increase a counter field on a users/chats document (or a rollup), accumulating it if enabled"""
+		if self.increments is not None:
+			return self._accumulate(collection, key, field, amount)
+		await self.update(collection, counter_filter(collection, key, COUNTER_KEYS), {"$inc": {field: amount}},
+			upsert=collection in COUNTER_KEYS, journal=True)
+		if collection in self.cache:
+			self.cache[collection].apply_inc(key, field, amount)
+
+	def _accumulate(self, collection:str, key:Any, field:str, amount:int = 1):
+		self.increments.increment(collection, key, field, amount)
+		if collection in self.cache:
+			self.cache[collection].apply_inc(key, field, amount)
+
+	async def insert(self, collection:str, doc:dict) -> bool:
+		"""insert a document, replacing any duplicate. Returns False if a duplicate was found"""
 		try:
-			if not has_index(await self.db.users.index_information(), [("id",1)]):
-				await self.db.users.create_index([("id",1)], name="alemibot-unique-users", unique=True)
-			if not has_index(await self.db.chats.index_information(), [("id",1)]):
-				await self.db.chats.create_index([("id",1)], name="alemibot-unique-chats", unique=True)
-		except:
-			logger.exception("Error while building users/chats indexes. Not having these indexes will affect performance!")
+			if self.upsert and collection in UNIQUE_KEYS:
+				return await upsert_replace(self.db, collection, doc, audit=self.audit_rate)
+			return await insert_replace(self.db, collection, doc)
+		except ServerSelectionTimeoutError:
+			if self.spool is None:
+				raise
+			self.spool.insert(collection, [doc])
+			return True
 
+	async def update(self, collection:str, flt:dict, update:dict, upsert:bool = False, many:bool = False, journal:bool = False):
+		"""run an update, spooling it if db can't be reached. Non idempotent updates should be journaled"""
+		try:
+			if many:
+				await self.db[collection].update_many(flt, update, upsert=upsert)
+			else:
+				await self.db[collection].update_one(flt, update, upsert=upsert)
+		except ServerSelectionTimeoutError:
+			if self.spool is None:
+				raise
+			self.spool.update(collection, [(flt, update)], upsert=upsert, many=many, journal=journal)
+
+	@property
+	def text_index(self) -> bool:
+		"""if the messages text index is built and can serve keyword filters"""
+		return self.indexes.state.get((TEXT_INDEX.collection, TEXT_INDEX.name)) == "ok"
+
+	def keyword_query(self, pattern:str) -> Dict[str, Any]:
+		"""filter on messages containing `pattern`, through the text index when possible"""
+		return keyword_filter(pattern, self.text_index)
+
+	def watermark(self, chat:Optional[int]) -> int:
+		"""messages logged, edited or deleted in `chat` (or anywhere, for None) since start, cached results are tagged with it"""
+		return self.watermarks.get(chat, 0)
+
+	def _advance_watermark(self, chat:int, amount:int = 1):
+		self.watermarks[chat] = self.watermarks.get(chat, 0) + amount
+		self.watermarks[None] = self.watermarks.get(None, 0) + amount
+
+	async def find_cached(self, collection:str, key:int) -> Optional[dict]:
+		"""find a users/chats document by id, looking in the document cache first"""
+		doc = self.cache[collection].get(key)
+		if doc is None:
+			doc = await self.db[collection].find_one({"id": key})
+			if doc:
+				self.cache[collection].put(key, dict(doc)) # callers may change what they get
+		return doc
+
+	async def set_cached(self, collection:str, key:int, fields:dict, created:bool = False):
+		"""upsert fields on a users/chats document, keeping the document cache current"""
+		await self.update(collection, {"id": key}, {"$set": fields}, upsert=True)
+		if created:
+			self.cache[collection].put(key, {})
+		self.cache[collection].apply_set(key, fields)
 
 	async def fetch_user(self, uid:int, client:Client = None) -> dict:
 		"""get a user from db or telegram
@@ -193,7 +481,7 @@ class DatabaseDriver:
 		Try to fetch an user from database and, if missing, fetch it from telegram and insert it.
 		Needs a client instance to fetch from telegram missing users.
 		"""
-		usr = await self.db.users.find_one({"id":uid})
+		usr = await self.find_cached("users", uid)
 		if not usr:
 			if not client:
 				return {"id":uid}
@@ -214,13 +502,13 @@ class DatabaseDriver:
 		Try to fetch a chat from database and, if missing, fetch it from telegram and insert it.
 		Needs a client instance to fetch from telegram missing chats.
 		"""
-		chat = await self.db.chats.find_one({"id":cid})
+		chat = await self.find_cached("chats", cid)
 		if not chat:
 			if not client:
 				return {"id":cid}
 			try:
 				chat = extract_chat(await client.get_chat(cid))
-				await self.db.users.insert_one(chat)
+				await self.db.chats.insert_one(chat)
 			except (PeerIdInvalid, ChannelPrivate) as e:
 				logger.warning("Could not fetch chat %d from db : %s", cid, str(e))
 				return {"id":cid}
@@ -231,100 +519,299 @@ class DatabaseDriver:
 
 	@_log_error_event
 	async def log_raw_event(self, event:Any):
-		await self.db.raw.insert_one(convert_to_dict(event))
+		if self.archive is None:
+			return await self.insert("raw", convert_to_dict(event))
+		self.archive.add(convert_to_dict(event))
+		if self.archive.full:
+			await self.flush_archive()
 
 	@_log_error_event
 	async def parse_message_event(self, message:Message, file_name=None):
-		msg = extract_message(message)
+		with self.metrics.serializing():
+			msg = extract_message(message)
+			if self.compact:
+				msg = compact_message(msg)
 		if file_name:
 			msg["file"] = file_name
 
-		if await insert_replace(self.db, 'messages', msg):
-			self.counter.messages()
+		self._advance_watermark(message.chat.id)
+		if self.batch is not None:
+			self._buffer_message_event(message, msg)
+		else:
+			await self._write_message_event(message, msg)
+
+	async def _write_message_event(self, message:Message, msg:dict):
+		if await self.insert("messages", msg):
+			self.metrics.incr("messages")
 
-		await self.db.chats.update_one({"id":message.chat.id}, {"$inc": {"messages.total":1}})
+		await self.increment("chats", message.chat.id, "messages.total")
 		if message.from_user:
-			await self.db.chats.update_one({"id":message.chat.id}, {"$inc": {f"messages.{message.from_user.id}":1}})
-			await self.db.users.update_one({"id":message.from_user.id}, {"$inc": {"messages":1}})
+			await self.increment("chats", message.chat.id, f"messages.{message.from_user.id}")
+			await self.increment("users", message.from_user.id, "messages")
+		if self.rollups:
+			await self.increment("activity", activity_key(msg), "count")
 
 		# Log users writing in dms so we have stats!
 		if message.chat.type == ChatType.PRIVATE:
 			usr = extract_user(message.from_user)
 			usr_id = usr["id"]
-			prev = await self.db.users.find_one({"id": usr_id})
+			prev = await self.find_cached("users", usr_id)
 			if prev:
 				usr = diff(prev, usr)
 			else:
-				self.counter.users()
+				self.metrics.incr("users")
 				usr["messages"] = 0
 			if usr: # don't insert if no diff!
-				await self.db.users.update_one({"id": usr_id}, {"$set": usr}, upsert=True)
+				await self.set_cached("users", usr_id, usr, created=not prev)
+
+	def _buffer_message_event(self, message:Message, msg:dict):
+		self.batch.add_message(msg)
+		self._accumulate("chats", message.chat.id, "messages.total")
+		if message.from_user:
+			self._accumulate("chats", message.chat.id, f"messages.{message.from_user.id}")
+			self._accumulate("users", message.from_user.id, "messages")
+		if self.rollups:
+			self._accumulate("activity", activity_key(msg), "count")
+		if message.chat.type == ChatType.PRIVATE:
+			usr = extract_user(message.from_user)
+			prev = self.cache["users"].get(usr["id"])
+			if prev is None: # not cached, let the upsert sort it out
+				self.batch.add_user(usr)
+			else:
+				changes = diff(prev, usr)
+				if changes: # don't write if no diff!
+					self.batch.add_user(usr)
+					self.cache["users"].apply_set(usr["id"], changes)
+		if self.batch.full:
+			task = asyncio.create_task(self.flush_batch())
+			self._pending.add(task)
+			task.add_done_callback(self._pending.discard)
+
+	async def attach_file(self, message:Message, path:str):
+		"""set `file` on a logged message once its media has been downloaded"""
+		if not self.log_messages:
+			return
+		key = extract_message_key(message)
+		if self.batch is not None:
+			for doc in self.batch.messages:
+				if all(doc.get(k) == v for k, v in key.items()):
+					doc["file"] = path
+					return
+		res = await self.db.messages.update_one(key, {"$set": {"file": path}})
+		if not res.matched_count and self.batch is not None: # may be in a flush right now, try again once it's done
+			await asyncio.sleep(self.batch.interval)
+			await self.db.messages.update_one(key, {"$set": {"file": path}})
+
+	async def backfill_page(self, messages:List[Message]) -> int:
+		"""write a page of chat history in bulk, returns how many messages were new
+
+		Messages already in db are left untouched, and only new ones are counted, so that a page can be
+		written again (a backfill resumed from its last checkpoint) without counting anything twice.
+		"""
+		docs : Dict[str, List[dict]] = {"messages": [], "service": []}
+		sources : Dict[str, List[Message]] = {"messages": [], "service": []}
+		with self.metrics.serializing():
+			for msg in messages:
+				coll = "service" if msg.service else "messages"
+				doc = extract_service_message(msg) if msg.service else extract_message(msg)
+				if self.compact and not msg.service:
+					doc = compact_message(doc)
+				docs[coll].append(doc)
+				sources[coll].append(msg)
+		colls = [ coll for coll in docs if docs[coll] ]
+		results = await asyncio.gather(*(
+			self.db[coll].bulk_write([
+				UpdateOne({ k: doc.get(k) for k in UNIQUE_KEYS[coll] }, {"$setOnInsert": doc}, upsert=True)
+				for doc in docs[coll]
+			], ordered=False) for coll in colls
+		))
+		new = 0
+		for coll, res in zip(colls, results):
+			self.metrics.incr(coll, res.upserted_count)
+			new += res.upserted_count
+			if coll != "messages":
+				continue
+			counts : Dict[Tuple[str, Any, str], int] = {}
+			for idx in res.upserted_ids:
+				msg = sources[coll][idx]
+				self._advance_watermark(msg.chat.id)
+				keys = [("chats", msg.chat.id, "messages.total")]
+				if msg.from_user:
+					keys += [("chats", msg.chat.id, f"messages.{msg.from_user.id}"), ("users", msg.from_user.id, "messages")]
+				if self.rollups:
+					keys.append(("activity", activity_key(docs[coll][idx]), "count"))
+				for k in keys:
+					counts[k] = counts.get(k, 0) + 1
+			for (target, key, field), amount in counts.items():
+				await self.increment(target, key, field, amount)
+		return new
 
 	@_log_error_event
 	async def parse_service_event(self, message:Message):
-		msg = extract_service_message(message)
-		await insert_replace(self.db, 'service', msg)
-		if message.chat:
-			chat = extract_chat(message.chat)
+		with self.metrics.serializing():
+			msg = extract_service_message(message)
+			chat = extract_chat(message.chat) if message.chat else None
+		if await self.insert("service", msg):
+			self.metrics.incr("service")
+		if chat:
 			chat_id = chat["id"]
-			prev = await self.db.chats.find_one({"id": chat_id})
+			prev = await self.find_cached("chats", chat_id)
 			if prev:
 				chat = diff(prev, chat)
 			else:
-				self.counter.chats()
+				self.metrics.incr("chats")
 				chat["messages.total"] = 0 if message._client.me.is_bot or message.chat.type not in ("supergroup", "channel") \
 						else await message._client.get_history_count(chat_id) # Accessing _client is a cheap fix
 			if chat: # don't insert if no diff!
-				await self.db.chats.update_one({"id": chat_id}, {"$set": chat}, upsert=True)
+				await self.set_cached("chats", chat_id, chat, created=not prev)
 
 	@_log_error_event
 	async def parse_member_event(self, update:ChatMemberUpdated):
-		doc = extract_member_update(update)
-		if await insert_replace(self.db, 'members', doc):
-			self.counter.members()
+		with self.metrics.serializing():
+			doc = extract_member_update(update)
+			usr = extract_user((update.new_chat_member or update.old_chat_member).user)
+		if await self.insert("members", doc):
+			self.metrics.incr("members")
 
-		usr = extract_user((update.new_chat_member or update.old_chat_member).user)
 		usr_id = usr["id"]
-		prev = await self.db.users.find_one({"id": usr_id})
+		prev = await self.find_cached("users", usr_id)
 		if prev:
 			usr = diff(prev, usr)
 		else:
-			self.counter.users()
+			self.metrics.incr("users")
 			usr["messages"] = 0
 		if usr: # don't insert if no diff!
-			await self.db.users.update_one({"id": usr_id}, {"$set": usr}, upsert=True)
+			await self.set_cached("users", usr_id, usr, created=not prev)
+
+	@property
+	def edited_query(self) -> Dict[str, Any]:
+		"""filter matching messages which have been edited, in either edits storage mode"""
+		return {"$or": [{"edit_count": {"$exists": 1}}, {"edits": {"$exists": 1}}]}
 
 	@_log_error_event
-	async def parse_edit_event(self, message:Message): # TODO replace `text` so that we always query most recent edit
-		self.counter.edits()
-		doc = extract_edit_message(message)
-		await self.db.messages.find_one_and_update(
-			{"id": message.id, "chat": message.chat.id},
-			{"$push": {"edits":	doc} }, sort=[("date",-1)]
-		)
+	async def parse_edit_event(self, message:Message):
+		self.metrics.incr("edits")
+		with self.metrics.serializing():
+			doc = extract_edit_message(message)
+			if self.compact:
+				doc = compact_message(doc)
+		self._advance_watermark(message.chat.id) # edited text changes keyword counts
+		if self.edits_collection:
+			return await self._store_edit(message, doc)
+		try:
+			await self.db.messages.find_one_and_update(
+				{"id": message.id, "chat": message.chat.id},
+				{"$push": {"edits":	doc} }, sort=[("date",-1)]
+			)
+		except ServerSelectionTimeoutError:
+			if self.spool is None:
+				raise
+			self.spool.update("messages", [({"id": message.id, "chat": message.chat.id}, {"$push": {"edits": doc}})], journal=True)
+
+	async def _store_edit(self, message:Message, doc:dict):
+		"""append edit to `edits` collection and keep latest text and edit count on the message
+
+		Message is only updated by edits newer than its `last_edit`, so that the same edit received (or
+		replayed) twice is not counted twice and an older edit doesn't overwrite the latest text.
+		"""
+		flt = {"id": message.id, "chat": message.chat.id, "$or": [{"last_edit": {"$lt": doc["date"]}}, {"last_edit": {"$exists": 0}}]}
+		update : Dict[str, Any] = {"$set": {"last_edit": doc["date"]}, "$inc": {"edit_count": 1}}
+		if "text" in doc:
+			update["$set"]["text"] = doc["text"]
+		edits = [ {"chat": message.chat.id, "id": message.id, **doc} ]
+		try:
+			prev = await self.db.messages.find_one_and_update(
+				flt, update, sort=[("date",-1)], return_document=ReturnDocument.BEFORE,
+				projection={"_id": 0, "date": 1, "text": 1, "edit_count": 1},
+			)
+		except ServerSelectionTimeoutError:
+			if self.spool is None:
+				raise
+			self.spool.update("messages", [(flt, update)], journal=True)
+			self.spool.insert("edits", edits)
+			return
+		if prev and not prev.get("edit_count"): # first edit, keep original text too
+			edits.insert(0, {"chat": message.chat.id, "id": message.id, "date": prev["date"], "text": prev.get("text"), "original": True})
+		try:
+			await self.db.edits.insert_many(edits, ordered=False)
+		except BulkWriteError as e: # same edit received twice, the unique index already dropped it
+			if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+				raise
+		except ServerSelectionTimeoutError:
+			if self.spool is None:
+				raise
+			self.spool.insert("edits", edits)
 
 	@_log_error_event
 	async def parse_deletion_event(self, message:List[Message]):
-		deletions = extract_delete(message)
+		with self.metrics.serializing():
+			deletions = extract_delete(message)
+		chatless = [ d for d in deletions if d["chat"] is None ]
+		if chatless:
+			try:
+				await self._resolve_chatless_deletions(chatless)
+			except ServerSelectionTimeoutError:
+				if self.spool is None:
+					raise # otherwise keep them chatless, better than losing them
+		by_chat : Dict[int, List[dict]] = {}
 		for deletion in deletions:
-			if await insert_replace(self.db, 'deletions', deletion):
-				self.counter.deletions()
+			if deletion["chat"] is not None:
+				by_chat.setdefault(deletion["chat"], []).append(deletion)
+		for chat, group in by_chat.items():
+			self._advance_watermark(chat, len(group))
+		inserted, *_ = await asyncio.gather(
+			self._insert_deletions(deletions),
+			*( self.update("messages",
+				{"id": {"$in": [ d["id"] for d in group ]}, "chat": chat},
+				{"$set": {"deleted": group[0]["date"]}}, many=True
+			) for chat, group in by_chat.items() )
+		)
+		self.metrics.incr("deletions", inserted)
 
-			flt = {"id": deletion["id"]}
-			if "chat" in deletion:
-				flt["chat"] = deletion["chat"]
-			else:
-				flt["chat"] = { "$ge":0 }
-			await self.db.messages.update_one(flt, {"$set": {"deleted": deletion["date"]}})
+	async def _insert_deletions(self, deletions:List[dict]) -> int:
+		try:
+			res = await self.db.deletions.insert_many(deletions, ordered=False)
+			return len(res.inserted_ids)
+		except BulkWriteError as e: # duplicates are the same deletion received twice, skip them
+			if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+				raise
+			return e.details["nInserted"]
+		except ServerSelectionTimeoutError:
+			if self.spool is None:
+				raise
+			self.spool.insert("deletions", deletions)
+			return len(deletions)
+
+	async def _resolve_chatless_deletions(self, deletions:List[dict]):
+		"""find chat of deletions which didn't come with one
+
+		Telegram omits chat only for private chats and basic groups, where message ids are unique per account.
+		Look up most recent message with each id outside of channels/supergroups and take its chat.
+		"""
+		ids = { d["id"] : d for d in deletions }
+		cursor = self.db.messages.find(
+			{"id": {"$in": list(ids.keys())}, "chat": {"$gt": -1000000000000}}, # channels and supergroups have -100 prefix
+			{"_id": 0, "id": 1, "chat": 1},
+		).sort("date", DESCENDING)
+		async for doc in cursor:
+			if doc["id"] in ids and ids[doc["id"]]["chat"] is None:
+				ids[doc["id"]]["chat"] = doc["chat"]
 
 	@_log_error_event
 	async def parse_status_update_event(self, user:User):
-		if user.status == "offline": # just update last online date
-			await self.db.users.update_one({"id": user.id}, # there are a ton of these, can't diff user every time I get one
-				{"$set": {"last_online_date": datetime.utcfromtimestamp(user.last_online_date)} })
+		if user.status == UserStatus.OFFLINE and user.last_online_date: # just update last online date
+			if self.statuses is not None: # there are a ton of these, coalesce them
+				self.statuses.update(user.id, user.last_online_date)
+			else: # can't diff user every time I get one
+				await self.update("users", {"id": user.id}, {"$set": {"last_online_date": user.last_online_date} })
+			self.cache["users"].apply_set(user.id, {"last_online_date": user.last_online_date})
 
 DRIVER = DatabaseDriver()
 
 @alemiBot.on_ready() # TODO make sure nothing
 async def register_db_connection(client:alemiBot):
 	await DRIVER.configure(client)
+
+@alemiBot.on_stop()
+async def flush_db_buffers(client:alemiBot):
+	await DRIVER.stop()
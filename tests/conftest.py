@@ -0,0 +1,12 @@
+"""Tests import the plugin as package `statsbot`, whatever its folder is called"""
+import os
+import sys
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "statsbot" not in sys.modules:
+	spec = importlib.util.spec_from_file_location("statsbot", os.path.join(ROOT, "__init__.py"),
+		submodule_search_locations=[ROOT])
+	module = importlib.util.module_from_spec(spec)
+	sys.modules["statsbot"] = module
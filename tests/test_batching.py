@@ -0,0 +1,77 @@
+import asyncio
+
+from types import SimpleNamespace
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("motor")
+pytest.importorskip("alemibot")
+pyrogram = pytest.importorskip("pyrogram")
+
+from pyrogram.enums import ChatType
+from pyrogram.types import Message, Chat, User
+from pyrogram.types.messages_and_media.message import Str
+
+from statsbot.driver import DatabaseDriver, COUNTER_KEYS
+from statsbot.util.accumulator import IncrementAccumulator
+from statsbot.util.batching import MessageBatch
+
+class RecordingCollection:
+	def __init__(self):
+		self.calls = []
+
+	def _record(self, name, *args):
+		self.calls.append((name, args))
+
+	async def bulk_write(self, requests, ordered=True):
+		self._record("bulk_write", requests)
+		n = len(requests)
+		return SimpleNamespace(inserted_count=0, matched_count=0, modified_count=0, upserted_count=n, upserted_ids={})
+
+	async def insert_one(self, doc):
+		self._record("insert_one", doc)
+
+	async def insert_many(self, docs, ordered=True):
+		self._record("insert_many", docs)
+		return SimpleNamespace(inserted_ids=[None] * len(docs))
+
+	async def update_one(self, flt, update, upsert=False):
+		self._record("update_one", flt, update)
+		return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+
+	async def replace_one(self, flt, doc, upsert=False):
+		self._record("replace_one", flt, doc)
+		return SimpleNamespace(matched_count=0, upserted_id=1)
+
+class RecordingDatabase:
+	def __init__(self):
+		self.collections = {}
+
+	def __getitem__(self, name):
+		return self.collections.setdefault(name, RecordingCollection())
+
+	def __getattr__(self, name):
+		return self[name]
+
+def test_batched_messages_are_written_in_one_bulk_write():
+	driver = DatabaseDriver()
+	driver.db = RecordingDatabase()
+	driver.upsert = True
+	driver.batch = MessageBatch(size=100, interval=60, upsert=True)
+	driver.increments = IncrementAccumulator(keys=COUNTER_KEYS)
+	chat = Chat(id=-1001234, type=ChatType.SUPERGROUP, title="chat")
+	user = User(id=42, first_name="user", is_bot=False)
+
+	async def run():
+		for i in range(5):
+			await driver.parse_message_event(Message(id=i + 1, chat=chat, from_user=user, date=datetime(2022, 1, 1, 0, i),
+				text=Str(f"message {i}").init(None)))
+		assert len(driver.batch) == 5
+		assert not driver.db.messages.calls # nothing written until flush
+		await driver.flush_batch()
+
+	asyncio.run(run())
+	calls = driver.db.messages.calls
+	assert [ name for name, _args in calls ] == ["bulk_write"]
+	assert len(calls[0][1][0]) == 5
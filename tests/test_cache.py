@@ -0,0 +1,31 @@
+from time import sleep
+
+from statsbot.util.cache import DocumentCache, ResultCache
+
+def test_document_cache_returns_copies():
+	cache = DocumentCache(size=10)
+	cache.put(1, {"_id": "x", "id": 1, "messages": 3})
+	doc = cache.get(1)
+	doc.pop("_id")
+	doc["name"] = "display name"
+	assert cache.get(1) == {"_id": "x", "id": 1, "messages": 3}
+
+def test_document_cache_mirrors_updates():
+	cache = DocumentCache(size=10)
+	cache.put(1, {"id": 1})
+	cache.apply_inc(1, "messages.total", 2)
+	cache.apply_set(1, {"username": "someone"})
+	assert cache.get(1) == {"id": 1, "messages": {"total": 2}, "username": "someone"}
+
+def test_result_cache_drops_entries_once_watermark_moves():
+	cache = ResultCache(budget=1024, ttl=3600)
+	cache.put("graph", 5, b"png")
+	assert cache.get("graph", 5) == b"png"
+	assert cache.get("graph", 6) is None
+	assert cache.get("graph", 5) is None # dropped, not just skipped
+
+def test_result_cache_ttl_is_an_upper_bound():
+	cache = ResultCache(budget=1024, ttl=0.01)
+	cache.put("graph", 5, b"png")
+	sleep(0.02)
+	assert cache.get("graph", 5) is None
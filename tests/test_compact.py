@@ -0,0 +1,31 @@
+from datetime import datetime
+
+import pytest
+
+from statsbot.util.compact import compact_message, expand_message
+
+DATE = datetime(2022, 1, 1, 12, 30)
+
+DOCS = [
+	{"id": 1, "chat": -100, "user": 5, "date": DATE, "text": "plain"},
+	{"id": 2, "chat": -100, "user": 5, "date": DATE, "text": "a < b", "formatted": "a &lt; b"},
+	{"id": 3, "chat": -100, "user": 5, "date": DATE, "text": "bold", "formatted": "<b>bold</b>"},
+	{"id": 4, "chat": -100, "user": 5, "date": DATE, "text": "hi", "formatted": "hi",
+		"forward": {"user": 7, "date": DATE}, "via_bot": 9, "author": "someone", "scheduled": True},
+	{"id": 5, "chat": -100, "date": DATE, "media": "photo", "file": "x.jpg",
+		"inline": [[{"text": "open", "url": "https://example.com"}, {"text": "callback"}]]},
+	{"id": 6, "chat": -100, "user": 5, "date": DATE, "text": "first", "formatted": "first",
+		"edits": [{"date": DATE, "text": "second", "formatted": "second"}, {"date": DATE, "text": "<i>third</i>", "formatted": "<i>third</i>"}]},
+	{"id": 7, "chat": -100, "date": DATE, "empty": True},
+]
+
+@pytest.mark.parametrize("doc", DOCS, ids=lambda d: str(d["id"]))
+def test_compact_round_trip_is_lossless(doc):
+	compact = compact_message(doc)
+	assert expand_message(compact) == doc
+	assert compact_message(compact) == compact # already compact documents are left as they are
+
+def test_redundant_formatted_is_not_stored():
+	assert compact_message(DOCS[1])["fmt"] is True
+	assert compact_message(DOCS[2])["fmt"] == "<b>bold</b>"
+	assert "fmt" not in compact_message(DOCS[0])
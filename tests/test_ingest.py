@@ -0,0 +1,52 @@
+import asyncio
+import random
+
+from types import SimpleNamespace
+
+from statsbot.util.ingest import IngestQueue
+
+def event(chat:int, n:int):
+	return SimpleNamespace(chat=SimpleNamespace(id=chat), id=n)
+
+def test_events_of_a_chat_are_processed_in_order():
+	seen = {}
+
+	async def handler(method, ev, kwargs):
+		await asyncio.sleep(random.random() / 1000)
+		seen.setdefault(ev.chat.id, []).append(ev.id)
+
+	async def run():
+		queue = IngestQueue(handler, size=20, workers=4)
+		queue.start()
+		for n in range(200):
+			await queue.put("parse_message_event", event(n % 7, n), {})
+		await queue.stop()
+
+	asyncio.run(run())
+	assert sum(len(v) for v in seen.values()) == 200
+	for ids in seen.values():
+		assert ids == sorted(ids)
+
+def test_spilled_events_are_replayed_before_new_ones(tmp_path):
+	seen = []
+
+	async def run():
+		gate = asyncio.Event()
+		async def handler(method, ev, kwargs):
+			await gate.wait()
+			seen.append(ev.id)
+
+		queue = IngestQueue(handler, size=2, workers=1, policy="spill", spill_path=str(tmp_path / "ingest.spill"))
+		queue.start()
+		for n in range(10):
+			await queue.put("parse_message_event", event(1, n), {})
+		assert queue.spilled
+		gate.set()
+		for _ in range(50):
+			if len(seen) == 10:
+				break
+			await asyncio.sleep(0.1)
+		await queue.stop()
+
+	asyncio.run(run())
+	assert seen == list(range(10))
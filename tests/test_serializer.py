@@ -0,0 +1,148 @@
+from types import SimpleNamespace
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("alemibot")
+pytest.importorskip("pyrogram")
+
+from pyrogram.enums import ChatType, ChatMemberStatus, MessageEntityType, MessageMediaType
+from pyrogram.types import (
+	Message, Chat, User, ChatMember, ChatMemberUpdated, ChatPrivileges, MessageEntity,
+	InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+)
+from pyrogram.types.messages_and_media.message import Str
+
+from statsbot.util import serializer
+from . import reference_serializer as reference
+
+NOW = datetime(2022, 3, 4, 5, 6, 7)
+LATER = datetime(2022, 3, 4, 6, 0, 0)
+
+chat = Chat(id=-1001234567890, type=ChatType.SUPERGROUP, title="chat")
+channel = Chat(id=-1009876543210, type=ChatType.CHANNEL, title="channel")
+user = User(id=123456789, first_name="some", username="someone")
+other = User(id=987654321, first_name="other")
+bot = User(id=555, first_name="bot", username="somebot", is_bot=True)
+bold = [ MessageEntity(type=MessageEntityType.BOLD, offset=0, length=4) ]
+
+def text(value, entities=None):
+	return Str(value).init(entities)
+
+def message(**kwargs):
+	return Message(**{"id": 10, "chat": chat, "from_user": user, "date": NOW, **kwargs})
+
+MESSAGES = {
+	"plain" : message(text=text("hello")),
+	"no author" : message(from_user=None, text=text("anon")),
+	"sender chat" : message(from_user=None, sender_chat=channel, text=text("as channel")),
+	"no chat" : message(chat=None, text=text("where")),
+	"empty" : message(empty=True, from_user=None),
+	"formatted" : message(text=text("bold <b>", bold), entities=bold),
+	"caption" : message(media=MessageMediaType.PHOTO, caption=text("a photo")),
+	"formatted caption" : message(media=MessageMediaType.PHOTO, caption=text("bold caption", bold), entities=bold),
+	"scheduled" : message(text=text("later"), from_scheduled=True, author_signature="editor"),
+	"reply" : message(text=text("answer"), reply_to_message=message(id=9, text=text("question"))),
+	"forward user" : message(text=text("fwd"), forward_from=other, forward_date=LATER),
+	"forward hidden" : message(text=text("fwd"), forward_sender_name="hidden", forward_date=LATER),
+	"forward channel" : message(text=text("fwd"), forward_from_chat=channel, forward_from_message_id=42, forward_date=LATER),
+	"via bot" : message(text=text("inline result"), via_bot=bot),
+	"inline keyboard" : message(text=text("pick"), reply_markup=InlineKeyboardMarkup([
+		[ InlineKeyboardButton("a", callback_data="a"), InlineKeyboardButton("site", url="https://example.com") ],
+	])),
+	"reply keyboard" : message(text=text("pick"), reply_markup=ReplyKeyboardMarkup([[ KeyboardButton("yes"), KeyboardButton("no") ]])),
+	"keyboard removed" : message(text=text("done"), reply_markup=ReplyKeyboardRemove()),
+	"poll" : message(media=MessageMediaType.POLL, poll=SimpleNamespace(question="?", options=[ SimpleNamespace(text="a"), SimpleNamespace(text="b") ])),
+	"contact" : message(media=MessageMediaType.CONTACT, contact=SimpleNamespace(phone_number="123", first_name="x", last_name=None, user_id=None, vcard=None)),
+	"full contact" : message(media=MessageMediaType.CONTACT, contact=SimpleNamespace(phone_number="123", first_name="x", last_name="y", user_id=7, vcard="VCARD")),
+	"web page" : message(text=text("https://example.com"), media=MessageMediaType.WEB_PAGE, web_page=SimpleNamespace(url="https://example.com", type="article")),
+}
+
+EDITS = {
+	"text" : message(text=text("edited"), edit_date=LATER),
+	"formatted" : message(text=text("bold edit", bold), entities=bold, edit_date=LATER),
+	"caption" : message(media=MessageMediaType.PHOTO, caption=text("new caption"), edit_date=LATER),
+	"markup only" : message(reply_markup=InlineKeyboardMarkup([[ InlineKeyboardButton("b", callback_data="b") ]]), edit_date=LATER),
+	"keyboard removed" : message(text=text("done"), reply_markup=ReplyKeyboardRemove(), edit_date=LATER),
+}
+
+SERVICE = {
+	"join" : message(new_chat_members=[user, other]),
+	"leave" : message(left_chat_member=other),
+	"title" : message(new_chat_title="renamed"),
+	"photo" : message(new_chat_photo=SimpleNamespace(file_unique_id="unique")),
+	"photo deleted" : message(delete_chat_photo=True),
+	"group created" : message(group_chat_created=True),
+	"supergroup created" : message(supergroup_chat_created=True),
+	"channel created" : message(chat=channel, from_user=None, sender_chat=channel, channel_chat_created=True),
+	"migrated to" : message(migrate_to_chat_id=-1001111),
+	"migrated from" : message(migrate_from_chat_id=-2222),
+	"pinned" : message(pinned_message=message(id=3, text=text("pin me")), reply_to_message=message(id=3, text=text("pin me"))),
+	"high score" : message(game_high_score=100, reply_to_message=message(id=4, game=SimpleNamespace(id=77))),
+	"high score without game" : message(game_high_score=100, reply_to_message=message(id=4, text=text("no game"))),
+	"video chat started" : message(video_chat_started=SimpleNamespace()),
+	"video chat ended" : message(video_chat_ended=SimpleNamespace(duration=360)),
+	"video chat invite" : message(video_chat_members_invited=SimpleNamespace(users=[user, other])),
+	"no chat" : message(chat=None, from_user=None, new_chat_title="nowhere"),
+}
+
+admin = ChatPrivileges(can_manage_chat=True, can_delete_messages=True, can_restrict_members=True, is_anonymous=True)
+
+MEMBERS = {
+	"join" : ChatMemberUpdated(chat=chat, from_user=user, date=NOW, old_chat_member=None,
+		new_chat_member=ChatMember(status=ChatMemberStatus.MEMBER, user=user, joined_date=NOW)),
+	"invited" : ChatMemberUpdated(chat=chat, from_user=other, date=NOW, old_chat_member=None,
+		new_chat_member=ChatMember(status=ChatMemberStatus.MEMBER, user=user, joined_date=NOW, invited_by=other),
+		invite_link=SimpleNamespace(invite_link="https://t.me/+abc", date=NOW, is_primary=False, creator=other,
+			expire_date=LATER, member_limit=10, member_count=3)),
+	"primary link" : ChatMemberUpdated(chat=chat, from_user=user, date=NOW, old_chat_member=None,
+		new_chat_member=ChatMember(status=ChatMemberStatus.MEMBER, user=user),
+		invite_link=SimpleNamespace(invite_link="https://t.me/+def", date=NOW, is_primary=True, creator=None,
+			expire_date=None, member_limit=None, member_count=None)),
+	"leave" : ChatMemberUpdated(chat=chat, from_user=user, date=NOW, new_chat_member=None,
+		old_chat_member=ChatMember(status=ChatMemberStatus.MEMBER, user=user)),
+	"promote" : ChatMemberUpdated(chat=chat, from_user=other, date=NOW,
+		old_chat_member=ChatMember(status=ChatMemberStatus.MEMBER, user=user),
+		new_chat_member=ChatMember(status=ChatMemberStatus.ADMINISTRATOR, user=user, promoted_by=other,
+			custom_title="boss", privileges=admin)),
+	"restrict" : ChatMemberUpdated(chat=chat, from_user=other, date=NOW,
+		old_chat_member=ChatMember(status=ChatMemberStatus.MEMBER, user=user),
+		new_chat_member=ChatMember(status=ChatMemberStatus.RESTRICTED, user=user, restricted_by=other,
+			until_date=LATER, is_member=True)),
+	"ban" : ChatMemberUpdated(chat=chat, from_user=other, date=NOW,
+		old_chat_member=ChatMember(status=ChatMemberStatus.MEMBER, user=user),
+		new_chat_member=ChatMember(status=ChatMemberStatus.BANNED, user=user, restricted_by=other, is_member=False)),
+}
+
+def ordered(value):
+	"""nested dicts as lists of items, so that field order is compared too"""
+	if isinstance(value, dict):
+		return [ (k, ordered(v)) for k, v in value.items() ]
+	if isinstance(value, list):
+		return [ ordered(v) for v in value ]
+	return value
+
+@pytest.mark.parametrize("name", MESSAGES)
+def test_extract_message(name):
+	assert ordered(serializer.extract_message(MESSAGES[name])) == ordered(reference.extract_message(MESSAGES[name]))
+	assert serializer.extract_message_key(MESSAGES[name]) == reference.extract_message_key(MESSAGES[name])
+
+@pytest.mark.parametrize("name", EDITS)
+def test_extract_edit_message(name):
+	assert ordered(serializer.extract_edit_message(EDITS[name])) == ordered(reference.extract_edit_message(EDITS[name]))
+
+@pytest.mark.parametrize("name", SERVICE)
+def test_extract_service_message(name):
+	assert ordered(serializer.extract_service_message(SERVICE[name])) == ordered(reference.extract_service_message(SERVICE[name]))
+
+@pytest.mark.parametrize("name", MEMBERS)
+def test_extract_member_update(name):
+	assert ordered(serializer.extract_member_update(MEMBERS[name])) == ordered(reference.extract_member_update(MEMBERS[name]))
+
+@pytest.mark.parametrize("obj", [user, other, bot])
+def test_extract_user(obj):
+	assert ordered(serializer.extract_user(obj)) == ordered(reference.extract_user(obj))
+
+@pytest.mark.parametrize("obj", [chat, channel])
+def test_extract_chat(obj):
+	assert ordered(serializer.extract_chat(obj)) == ordered(reference.extract_chat(obj))
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("bson")
+pytest.importorskip("motor")
+errors = pytest.importorskip("pymongo.errors")
+
+from pymongo import InsertOne, ReplaceOne, UpdateOne, UpdateMany
+
+from statsbot.util.spool import Spool
+
+def _get(doc, path):
+	for key in path.split("."):
+		if not isinstance(doc, dict) or key not in doc:
+			return None
+		doc = doc[key]
+	return doc
+
+def _matches(doc, flt):
+	for field, cond in flt.items():
+		value = _get(doc, field)
+		if isinstance(cond, dict) and "$ne" in cond:
+			if cond["$ne"] == value or (isinstance(value, list) and cond["$ne"] in value):
+				return False
+		elif value != cond:
+			return False
+	return True
+
+def _apply(doc, update):
+	for field, amount in update.get("$inc", {}).items():
+		*path, last = field.split(".")
+		parent = doc
+		for key in path:
+			parent = parent.setdefault(key, {})
+		parent[last] = parent.get(last, 0) + amount
+	for field, value in update.get("$set", {}).items():
+		doc[field] = value
+	for field, value in update.get("$push", {}).items():
+		items = doc.setdefault(field, [])
+		if isinstance(value, dict) and "$each" in value:
+			items += value["$each"]
+			if "$slice" in value:
+				items[:] = items[value["$slice"]:]
+		else:
+			items.append(value)
+
+class FakeCollection:
+	"""just enough of a motor collection for spool replays, with a unique key on `id`"""
+	def __init__(self, fail:int = 0):
+		self.docs = []
+		self.fail = fail
+
+	async def bulk_write(self, requests, ordered=True):
+		if self.fail:
+			self.fail -= 1
+			raise errors.AutoReconnect("connection lost")
+		for index, req in enumerate(requests):
+			if isinstance(req, InsertOne):
+				self.docs.append(dict(req._doc))
+				continue
+			found = [ doc for doc in self.docs if _matches(doc, req._filter) ]
+			if isinstance(req, UpdateOne):
+				found = found[:1]
+			if isinstance(req, ReplaceOne):
+				for doc in found[:1]:
+					doc.clear()
+					doc.update(req._doc)
+			else:
+				for doc in found:
+					_apply(doc, req._doc)
+			if not found and req._upsert:
+				doc = { k: v for k, v in req._filter.items() if not isinstance(v, dict) }
+				if any(d.get("id") == doc.get("id") for d in self.docs):
+					raise errors.BulkWriteError({"writeErrors": [{"index": index, "code": 11000, "errmsg": "duplicate key"}]})
+				if isinstance(req, ReplaceOne):
+					doc = dict(req._doc)
+				else:
+					_apply(doc, req._doc)
+				self.docs.append(doc)
+
+class FakeDatabase:
+	def __init__(self, **collections):
+		self.collections = collections
+
+	def __getitem__(self, name):
+		return self.collections.setdefault(name, FakeCollection())
+
+def test_interrupted_replay_does_not_apply_increments_twice(tmp_path):
+	spool = Spool(str(tmp_path / "spool.db"))
+	spool.update("chats", [({"id": 1}, {"$inc": {"messages.total": 1}})], upsert=True, journal=True)
+	spool.update("users", [({"id": 2}, {"$inc": {"messages": 1}})], upsert=True, journal=True)
+	spool.update("chats", [({"id": 1}, {"$inc": {"messages.total": 1}})], upsert=True, journal=True)
+	db = FakeDatabase(chats=FakeCollection(), users=FakeCollection(fail=1))
+
+	with pytest.raises(errors.AutoReconnect): # chats written, then connection drops before users
+		asyncio.run(spool.replay(db))
+	assert len(spool) == 3
+	assert asyncio.run(spool.replay(db)) == 3
+
+	assert [ doc["messages"]["total"] for doc in db["chats"].docs ] == [2]
+	assert [ doc["messages"] for doc in db["users"].docs ] == [1]
+	assert len(spool) == 0
+	spool.close()
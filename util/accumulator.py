@@ -0,0 +1,96 @@
+import asyncio
+
+from time import time
+from typing import Any, List, Dict, Tuple, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, ServerSelectionTimeoutError
+
+from .batching import FlushStats
+from .spool import Spool
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+def counter_filter(collection:str, key:Any, keys:Dict[str, Tuple[str, ...]]) -> dict:
+	"""filter for counter document `key`: its `id`, or a tuple of values for collections with compound keys"""
+	if collection in keys:
+		return dict(zip(keys[collection], key))
+	return {"id": key}
+
+class IncrementAccumulator:
+	"""Sums counter increments in memory before writing them
+
+	Increments are kept in a dict keyed by (collection, id, field). On flush, all fields of the same
+	document are merged into a single `$inc` and each collection gets one unordered bulk_write.
+	Increments which certainly did not reach the db are put back (or spooled, if a spool is given), so that
+	counts stay exact across flushes.
+	Collections in `keys` have compound keys (increments are then keyed by a tuple of values) and their
+	documents are upserted, since rollups are created by their first increment.
+	"""
+	def __init__(self, interval:float = 5.0, keys:Optional[Dict[str, Tuple[str, ...]]] = None):
+		self.interval = interval
+		self.keys = keys or {}
+		self.stats = FlushStats()
+		self.pending : Dict[Tuple[str, Any, str], int] = {}
+		self.last_flush = time()
+
+	def __len__(self) -> int:
+		return len(self.pending)
+
+	@property
+	def expired(self) -> bool:
+		return bool(self.pending) and time() - self.last_flush >= self.interval
+
+	def increment(self, collection:str, key:Any, field:str, amount:int = 1):
+		k = (collection, key, field)
+		self.pending[k] = self.pending.get(k, 0) + amount
+
+	def _restore(self, collection:str, key:Any, fields:Dict[str, int]):
+		for field, amount in fields.items():
+			self.increment(collection, key, field, amount)
+
+	async def flush(self, db:AsyncIOMotorDatabase, spool:Optional[Spool] = None) -> int:
+		"""write all pending increments, returns number of documents touched"""
+		pending, self.pending = self.pending, {}
+		self.last_flush = time()
+		if not pending:
+			return 0
+		start = time()
+		docs : Dict[str, Dict[Any, Dict[str, int]]] = {}
+		for (coll, key, field), amount in pending.items():
+			docs.setdefault(coll, {}).setdefault(key, {})[field] = amount
+		colls = list(docs.keys())
+		res = await asyncio.gather(
+			*( db[coll].bulk_write(
+				[ UpdateOne(counter_filter(coll, key, self.keys), {"$inc": fields}, upsert=coll in self.keys)
+					for key, fields in docs[coll].items() ],
+				ordered=False
+			) for coll in colls ),
+			return_exceptions=True,
+		)
+		self.stats.record(time() - start)
+		touched = 0
+		for coll, r in zip(colls, res):
+			keys = list(docs[coll].keys())
+			if isinstance(r, BulkWriteError):
+				logger.error("Failed %d counter updates on %s", len(r.details["writeErrors"]), coll)
+				for err in r.details["writeErrors"]:
+					self._restore(coll, keys[err["index"]], docs[coll][keys[err["index"]]])
+				touched += r.details["nMatched"]
+			elif isinstance(r, ServerSelectionTimeoutError) and spool is not None:
+				logger.error("Could not connect to MongoDB, spooling %d counters on %s", len(keys), coll)
+				spool.update(coll, [ (counter_filter(coll, key, self.keys), {"$inc": docs[coll][key]}) for key in keys ],
+					upsert=coll in self.keys, journal=True)
+			elif isinstance(r, ServerSelectionTimeoutError):
+				logger.error("Could not connect to MongoDB, keeping %d counters on %s for next flush", len(keys), coll)
+				for key in keys:
+					self._restore(coll, key, docs[coll][key])
+			elif isinstance(r, BaseException):
+				# we can't know if these were applied, retrying could count them twice
+				logger.error("Dropping %d counter updates on %s : %s", len(keys), coll, str(r))
+			else:
+				touched += r.matched_count + r.upserted_count
+		return touched
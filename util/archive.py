@@ -0,0 +1,142 @@
+import os
+import gzip
+import threading
+import json
+import zlib
+
+from time import time
+from datetime import datetime
+from typing import Any, List, Dict, Tuple, Iterator, Optional
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+INDEX = "index.ndjson"
+
+class RawArchive:
+	"""Append-only compressed archive of raw events, on local disk
+
+	Events are buffered as json lines and written as one gzip member every `interval` seconds (or `size`
+	events), so each member can be decompressed alone. Files are rotated once they grow past `max_bytes`.
+	For each member a line (file, offset, length, count, first and last date) is appended to `index.ndjson`,
+	so that readers can skip straight to the time range they need.
+	"""
+	def __init__(self, directory:str = "plugins/statsbot/archive/", interval:float = 10.0, size:int = 5000,
+			max_bytes:int = 64 * 1024 * 1024, level:int = 6):
+		self.directory = directory
+		self.interval = interval
+		self.size = size
+		self.max_bytes = max_bytes
+		self.level = level
+		self.lines : List[bytes] = []
+		self.first : Optional[datetime] = None
+		self.last : Optional[datetime] = None
+		self.last_flush = time()
+		self.file : Optional[str] = None
+		self.written = 0
+		self.compressed = 0
+		self.lock = threading.Lock()
+		os.makedirs(directory, exist_ok=True)
+
+	def __len__(self) -> int:
+		return len(self.lines)
+
+	def __str__(self) -> str:
+		ratio = self.written / self.compressed if self.compressed else 0
+		return f"{len(self.lines)} buffered | {self.file or '-'} | x{ratio:.1f} compression"
+
+	@property
+	def full(self) -> bool:
+		return len(self.lines) >= self.size
+
+	@property
+	def expired(self) -> bool:
+		return bool(self.lines) and time() - self.last_flush >= self.interval
+
+	def add(self, event:dict, date:Optional[datetime] = None):
+		date = date or datetime.now()
+		self.lines.append(json.dumps(event, default=str, separators=(",", ":")).encode("utf-8") + b"\n")
+		self.first = self.first or date
+		self.last = date
+
+	def _target(self) -> str:
+		path = os.path.join(self.directory, self.file) if self.file else None
+		if not path or os.path.getsize(path) >= self.max_bytes:
+			stamp, n = datetime.now().strftime("raw-%Y%m%d-%H%M%S"), 0
+			self.file = f"{stamp}.ndjson.gz"
+			while os.path.exists(os.path.join(self.directory, self.file)):
+				n += 1
+				self.file = f"{stamp}-{n}.ndjson.gz"
+			path = os.path.join(self.directory, self.file)
+		return path
+
+	def take(self) -> Tuple[List[bytes], Optional[datetime], Optional[datetime]]:
+		"""empty the buffer, returning its lines and their date range"""
+		out = (self.lines, self.first, self.last)
+		self.lines, self.first, self.last = [], None, None
+		self.last_flush = time()
+		return out
+
+	def write(self, lines:List[bytes], first:datetime, last:datetime) -> int:
+		"""compress `lines` as a new gzip member and index it, safe to call from a worker thread"""
+		if not lines:
+			return 0
+		raw = b"".join(lines)
+		member = gzip.compress(raw, compresslevel=self.level)
+		with self.lock:
+			path = self._target()
+			with open(path, "ab") as f:
+				offset = f.tell()
+				f.write(member)
+			with open(os.path.join(self.directory, INDEX), "a") as f:
+				f.write(json.dumps({
+					"file": self.file, "offset": offset, "length": len(member), "count": len(lines),
+					"first": first.isoformat(), "last": last.isoformat(),
+				}) + "\n")
+			self.written += len(raw)
+			self.compressed += len(member)
+		return len(lines)
+
+	def flush(self) -> int:
+		"""write buffered events, returns how many were written"""
+		return self.write(*self.take())
+
+def read_index(directory:str = "plugins/statsbot/archive/") -> List[Dict[str, Any]]:
+	path = os.path.join(directory, INDEX)
+	if not os.path.exists(path):
+		return []
+	with open(path) as f:
+		return [ json.loads(line) for line in f if line.strip() ]
+
+def read_archive(directory:str = "plugins/statsbot/archive/", since:Optional[datetime] = None,
+		until:Optional[datetime] = None, chunk:int = 64 * 1024) -> Iterator[dict]:
+	"""stream archived events, oldest first, only reading members overlapping [since, until]
+
+	Members are decompressed a chunk at a time, so memory use doesn't depend on archive size.
+	Events in a member partially inside the range are all returned, filter on event fields if needed.
+	"""
+	for entry in read_index(directory):
+		if since and datetime.fromisoformat(entry["last"]) < since:
+			continue
+		if until and datetime.fromisoformat(entry["first"]) > until:
+			continue
+		with open(os.path.join(directory, entry["file"]), "rb") as f:
+			f.seek(entry["offset"])
+			left = entry["length"]
+			decomp = zlib.decompressobj(wbits=31) # gzip header
+			pending = b""
+			while left > 0:
+				data = f.read(min(chunk, left))
+				if not data:
+					logger.error("Archive file %s is truncated", entry["file"])
+					break
+				left -= len(data)
+				pending += decomp.decompress(data)
+				*lines, pending = pending.split(b"\n")
+				for line in lines:
+					yield json.loads(line)
+			pending += decomp.flush()
+			for line in pending.split(b"\n"):
+				if line:
+					yield json.loads(line)
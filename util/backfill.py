@@ -0,0 +1,151 @@
+import asyncio
+
+from time import time
+from datetime import datetime
+from typing import Any, List, Dict, Callable, Awaitable, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pyrogram import Client
+from pyrogram.errors import FloodWait
+from pyrogram.types import Message
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+PAGE = 100 # messages per history request, telegram won't return more anyway
+
+class TokenBucket:
+	"""Rate budget shared by all jobs: `rate` requests per second, with bursts up to `burst`"""
+	def __init__(self, rate:float = 1.0, burst:int = 5):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = float(burst)
+		self.last = time()
+		self.lock = asyncio.Lock()
+
+	async def acquire(self):
+		async with self.lock: # first come first served, so no job starves
+			while True:
+				now = time()
+				self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+				self.last = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class BackfillManager:
+	"""Runs backfill jobs, one per chat
+
+	Jobs fetch chat history one page at a time, going back from their checkpoint, and hand each page to
+	`on_page` to be written in bulk. After each page the checkpoint (last message id processed) is stored
+	in the `backfill` collection, so that jobs can be paused, resumed and survive restarts.
+	At most `concurrency` chats are backfilled at once and all history requests share one rate budget.
+	"""
+	def __init__(self, on_page:Callable[[List[Message]], Awaitable[int]],
+			concurrency:int = 2, rate:float = 1.0, burst:int = 5):
+		self.on_page = on_page
+		self.semaphore = asyncio.Semaphore(concurrency)
+		self.budget = TokenBucket(rate, burst)
+		self.tasks : Dict[int, asyncio.Task] = {}
+		self.paused : Dict[int, bool] = {}
+
+	def __str__(self) -> str:
+		return f"{len(self.tasks)} running | {self.budget.rate:g} req/s"
+
+	async def jobs(self, db:AsyncIOMotorDatabase) -> List[dict]:
+		return await db.backfill.find({}, {"_id": 0}).sort("started", -1).to_list(None)
+
+	async def start(self, db:AsyncIOMotorDatabase, client:Client, chat:int, limit:int, offset_id:int = 0,
+			progress:Optional[Callable[[dict], Awaitable[Any]]] = None) -> dict:
+		"""create (or restart) job for `chat` and run it in background"""
+		if chat in self.tasks:
+			raise ValueError(f"Backfill of chat {chat} is already running")
+		job = {
+			"chat": chat, "limit": limit, "offset_id": offset_id, "last_id": offset_id, "done": 0,
+			"state": "queued", "started": datetime.now(), "updated": datetime.now(),
+		}
+		await db.backfill.replace_one({"chat": chat}, job, upsert=True)
+		self._spawn(db, client, job, progress)
+		return job
+
+	async def resume(self, db:AsyncIOMotorDatabase, client:Client, chat:int,
+			progress:Optional[Callable[[dict], Awaitable[Any]]] = None) -> Optional[dict]:
+		job = await db.backfill.find_one({"chat": chat}, {"_id": 0})
+		if not job or job["state"] == "done" or chat in self.tasks:
+			return job
+		await db.backfill.update_one({"chat": chat}, {"$set": {"state": "queued"}})
+		job["state"] = "queued"
+		self._spawn(db, client, job, progress)
+		return job
+
+	async def resume_all(self, db:AsyncIOMotorDatabase, client:Client):
+		"""restart jobs interrupted by a shutdown or a crash"""
+		async for job in db.backfill.find({"state": {"$in": ["queued", "running"]}}, {"_id": 0}):
+			logger.info("Resuming backfill of chat %d from message %d", job["chat"], job["last_id"])
+			self._spawn(db, client, job, None)
+
+	def pause(self, chat:int) -> bool:
+		"""stop job after current page, it can be resumed later"""
+		if chat not in self.tasks:
+			return False
+		self.paused[chat] = True
+		return True
+
+	async def stop(self):
+		for task in self.tasks.values():
+			task.cancel()
+
+	def _spawn(self, db:AsyncIOMotorDatabase, client:Client, job:dict, progress:Optional[Callable[[dict], Awaitable[Any]]]):
+		self.paused.pop(job["chat"], None)
+		chat = job["chat"]
+		task = asyncio.create_task(self._run(db, client, job, progress))
+		self.tasks[chat] = task
+		task.add_done_callback(lambda t: self.tasks.pop(chat) if self.tasks.get(chat) is t else None)
+
+	async def _fetch(self, client:Client, chat:int, limit:int, offset_id:int) -> List[Message]:
+		while True:
+			await self.budget.acquire()
+			try:
+				return [ msg async for msg in client.get_chat_history(chat, limit=limit, offset_id=offset_id) ]
+			except FloodWait as e:
+				logger.warning("Backfill of chat %d hit a FloodWait, waiting %ss", chat, e.value)
+				await asyncio.sleep(e.value)
+
+	async def _run(self, db:AsyncIOMotorDatabase, client:Client, job:dict, progress:Optional[Callable[[dict], Awaitable[Any]]]):
+		chat = job["chat"]
+		async with self.semaphore:
+			job["state"] = "running"
+			job.pop("error", None)
+			try:
+				await db.backfill.update_one({"chat": chat}, {"$set": {"state": "running"}, "$unset": {"error": 1}})
+				while job["done"] < job["limit"]:
+					if self.paused.pop(chat, False):
+						job["state"] = "paused"
+						break
+					page = await self._fetch(client, chat, min(PAGE, job["limit"] - job["done"]), job["last_id"])
+					if not page: # reached beginning of chat
+						break
+					await self.on_page(page)
+					job["done"] += len(page)
+					job["last_id"] = page[-1].id # history goes backwards, last is oldest
+					job["updated"] = datetime.now()
+					await db.backfill.update_one({"chat": chat}, {"$set": {
+						"done": job["done"], "last_id": job["last_id"], "updated": job["updated"],
+					}})
+					if progress:
+						await progress(job)
+				if job["state"] == "running":
+					job["state"] = "done"
+			except asyncio.CancelledError: # bot is stopping, leave it as running so it gets resumed
+				raise
+			except Exception as e:
+				logger.exception("Backfill of chat %d failed", chat)
+				job["state"] = "failed"
+				job["error"] = str(e)
+			await db.backfill.update_one({"chat": chat}, {"$set": {
+				"state": job["state"], "updated": datetime.now(), **({"error": job["error"]} if "error" in job else {})
+			}})
+			if progress:
+				await progress(job)
@@ -0,0 +1,194 @@
+import asyncio
+
+from time import time
+from datetime import datetime
+from typing import Any, List, Dict, Tuple, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError, ServerSelectionTimeoutError
+
+from .cache import DocumentCache
+from .spool import Spool
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+class FlushStats:
+	"""Keeps track of how long flushes take. Values are in seconds"""
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.last = 0.0
+		self.max = 0.0
+
+	def record(self, elapsed:float):
+		self.count += 1
+		self.total += elapsed
+		self.last = elapsed
+		self.max = max(self.max, elapsed)
+
+	@property
+	def avg(self) -> float:
+		return self.total / self.count if self.count else 0.0
+
+	def __str__(self) -> str:
+		return f"{self.count} flushes | last {self.last*1000:.1f}ms | avg {self.avg*1000:.1f}ms | max {self.max*1000:.1f}ms"
+
+class MessageBatch:
+	"""Write-behind buffer for message events
+
+	Message documents and private chat user documents are buffered and written together once `size`
+	events have been collected or `interval` seconds have passed. Each flush does at most one round
+	trip per collection: an unordered insert_many for messages and a single bulk_write for users.
+	Counters are not kept here, see IncrementAccumulator.
+	With `upsert`, messages are written as upserting ReplaceOne ops on their unique key instead, so
+	that duplicates get replaced in the same round trip.
+	"""
+	def __init__(self, size:int = 500, interval:float = 1.0, upsert:bool = False):
+		self.size = size
+		self.interval = interval
+		self.upsert = upsert
+		self.stats = FlushStats()
+		self.messages : List[dict] = []
+		self.users : Dict[int, dict] = {}
+		self.last_flush = time()
+
+	def __len__(self) -> int:
+		return len(self.messages)
+
+	@property
+	def full(self) -> bool:
+		return len(self.messages) >= self.size
+
+	@property
+	def expired(self) -> bool:
+		return bool(self.messages or self.users) \
+			and time() - self.last_flush >= self.interval
+
+	def add_message(self, doc:dict):
+		self.messages.append(doc)
+
+	def add_user(self, doc:dict):
+		self.users[doc["id"]] = doc # only newest version of each user is worth writing
+
+	def swap(self) -> Tuple[List[dict], Dict[int, dict]]:
+		"""take current buffers out, leaving empty ones in place. Must not await so no event gets lost"""
+		out = (self.messages, self.users)
+		self.messages, self.users = [], {}
+		self.last_flush = time()
+		return out
+
+	async def flush(self, db:AsyncIOMotorDatabase, spool:Optional[Spool] = None) -> Tuple[int, int, List[dict]]:
+		"""write buffered events to db
+
+		Returns number of inserted messages, number of new users and a list of message documents
+		which were rejected as duplicates, so that caller can decide how to handle them.
+		If db can't be reached and a spool is given, writes are spooled instead.
+		"""
+		messages, users = self.swap()
+		if not messages and not users:
+			return 0, 0, []
+		start = time()
+		user_updates = [
+			({"id": usr["id"]}, {"$set": usr, "$setOnInsert": {"messages": 0}})
+			for usr in users.values()
+		]
+		res = await asyncio.gather(
+			self._insert_messages(db, messages),
+			db.users.bulk_write([ UpdateOne(flt, upd, upsert=True) for flt, upd in user_updates ], ordered=False) \
+				if user_updates else _noop(),
+			return_exceptions=True,
+		)
+		elapsed = time() - start
+		self.stats.record(elapsed)
+		logger.debug("Flushed %d messages, %d users in %.1fms", len(messages), len(users), elapsed*1000)
+		if spool is not None and isinstance(res[0], ServerSelectionTimeoutError):
+			spool.insert("messages", messages)
+			res[0] = (len(messages), [])
+		if spool is not None and isinstance(res[1], ServerSelectionTimeoutError):
+			spool.update("users", user_updates, upsert=True)
+			res[1] = None
+		for r in res:
+			if isinstance(r, BaseException):
+				raise r
+		inserted, duplicates = res[0]
+		new_users = res[1].upserted_count if res[1] is not None else 0
+		return inserted, new_users, duplicates
+
+	async def _insert_messages(self, db:AsyncIOMotorDatabase, messages:List[dict]) -> Tuple[int, List[dict]]:
+		if not messages:
+			return 0, []
+		if self.upsert:
+			res = await db.messages.bulk_write([
+				ReplaceOne({"chat": m.get("chat"), "id": m.get("id"), "date": m.get("date")}, m, upsert=True)
+				for m in messages
+			], ordered=False)
+			return res.upserted_count, []
+		try:
+			res = await db.messages.insert_many(messages, ordered=False)
+			return len(res.inserted_ids), []
+		except BulkWriteError as e:
+			duplicates = [ messages[err["index"]] for err in e.details["writeErrors"] if err["code"] == 11000 ]
+			if len(duplicates) < len(e.details["writeErrors"]):
+				logger.error("Failed inserting some messages : %s", str(e.details["writeErrors"]))
+			return e.details["nInserted"], duplicates
+
+async def _noop() -> Optional[Any]:
+	return None
+
+class LastOnlineTable:
+	"""Coalesces user status updates
+
+	Only the newest last online date of each user is kept and all of them are written with a single
+	bulk_write every `interval` seconds. If `granularity` (in seconds) is given, updates which moved
+	last online date less than that from the last value written are skipped altogether.
+	"""
+	def __init__(self, interval:float = 30.0, granularity:float = 0.0, size:int = 100000):
+		self.interval = interval
+		self.granularity = granularity
+		self.stats = FlushStats()
+		self.pending : Dict[int, datetime] = {}
+		self.written = DocumentCache(size=size)
+		self.skipped = 0
+		self.last_flush = time()
+
+	def __len__(self) -> int:
+		return len(self.pending)
+
+	@property
+	def expired(self) -> bool:
+		return bool(self.pending) and time() - self.last_flush >= self.interval
+
+	def update(self, uid:int, date:datetime):
+		prev = self.pending.get(uid)
+		if prev is not None:
+			if date > prev:
+				self.pending[uid] = date
+			return
+		if self.granularity:
+			written = self.written.get(uid)
+			if written and (date - written["last_online_date"]).total_seconds() < self.granularity:
+				self.skipped += 1
+				return
+		self.pending[uid] = date
+
+	async def flush(self, db:AsyncIOMotorDatabase, spool:Optional[Spool] = None) -> int:
+		pending, self.pending = self.pending, {}
+		self.last_flush = time()
+		if not pending:
+			return 0
+		start = time()
+		updates = [ ({"id": uid}, {"$set": {"last_online_date": date}}) for uid, date in pending.items() ]
+		try:
+			res = await db.users.bulk_write([ UpdateOne(flt, upd) for flt, upd in updates ], ordered=False)
+		except ServerSelectionTimeoutError:
+			if spool is None:
+				raise
+			spool.update("users", updates)
+			return 0
+		self.stats.record(time() - start)
+		for uid, date in pending.items():
+			self.written.put(uid, {"last_online_date": date})
+		return res.modified_count
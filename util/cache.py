@@ -0,0 +1,155 @@
+import sys
+
+from time import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+def _set_path(doc:dict, path:str, value:Any):
+	"""set a dotted field like mongo would ("messages.total" -> doc["messages"]["total"])"""
+	*parents, last = path.split(".")
+	for key in parents:
+		if not isinstance(doc.get(key), dict):
+			doc[key] = {}
+		doc = doc[key]
+	doc[last] = value
+
+def _get_path(doc:dict, path:str, default:Any = None) -> Any:
+	for key in path.split("."):
+		if not isinstance(doc, dict) or key not in doc:
+			return default
+		doc = doc[key]
+	return doc
+
+class DocumentCache:
+	"""Bounded LRU cache of documents, with optional time to live
+
+	Keeps the most recently used `size` documents, keyed by their id. Writes done to db should be
+	mirrored here with `apply_set` and `apply_inc` so that cached documents stay current. `get` returns a
+	shallow copy, so that callers can change top level fields without touching the cached document.
+	A `ttl` (in seconds) can be given to also drop entries which have been cached for too long.
+	"""
+	def __init__(self, size:int = 10000, ttl:float = 0):
+		self.size = size
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.storage : OrderedDict[Any, Tuple[float, dict]] = OrderedDict()
+
+	def __len__(self) -> int:
+		return len(self.storage)
+
+	def __contains__(self, key:Any) -> bool:
+		return key in self.storage
+
+	@property
+	def hit_rate(self) -> float:
+		total = self.hits + self.misses
+		return self.hits / total if total else 0.0
+
+	def __str__(self) -> str:
+		return f"{len(self.storage)}/{self.size} | {self.hit_rate*100:.1f}% hits"
+
+	def get(self, key:Any) -> Optional[dict]:
+		if key not in self.storage:
+			self.misses += 1
+			return None
+		stored, doc = self.storage[key]
+		if self.ttl and time() - stored > self.ttl:
+			del self.storage[key]
+			self.misses += 1
+			return None
+		self.storage.move_to_end(key)
+		self.hits += 1
+		return dict(doc)
+
+	def put(self, key:Any, doc:dict):
+		self.storage[key] = (time(), doc)
+		self.storage.move_to_end(key)
+		while len(self.storage) > self.size:
+			self.storage.popitem(last=False)
+
+	def drop(self, key:Any):
+		self.storage.pop(key, None)
+
+	def apply_set(self, key:Any, fields:Dict[str, Any]):
+		"""mirror a `$set` update on a cached document, if present"""
+		if key not in self.storage:
+			return
+		doc = self.storage[key][1]
+		for path, value in fields.items():
+			_set_path(doc, path, value)
+
+	def apply_inc(self, key:Any, field:str, amount:int = 1):
+		"""mirror an `$inc` update on a cached document, if present"""
+		if key not in self.storage:
+			return
+		doc = self.storage[key][1]
+		_set_path(doc, field, _get_path(doc, field, 0) + amount)
+
+def _size_of(value:Any) -> int:
+	"""rough size in bytes of a cached result: arrays and buffers by their data, containers by their items"""
+	if hasattr(value, "nbytes"): # numpy arrays
+		return int(value.nbytes)
+	if isinstance(value, (bytes, bytearray, str)):
+		return len(value)
+	if isinstance(value, (list, tuple)):
+		return sys.getsizeof(value) + sum(_size_of(v) for v in value)
+	if isinstance(value, dict):
+		return sys.getsizeof(value) + sum(_size_of(k) + _size_of(v) for k, v in value.items())
+	return sys.getsizeof(value)
+
+class ResultCache:
+	"""LRU cache of command results (computed arrays, rendered images), bounded in bytes
+
+	Each entry is stored with the ingest watermark of the chat it was computed on, and dropped as soon as
+	that watermark moves (something was logged there since) or after `ttl` seconds anyway. Least recently
+	used entries are evicted once total size exceeds `budget` (0 disables).
+	"""
+	def __init__(self, budget:int = 32 * 1024 * 1024, ttl:float = 3600):
+		self.budget = budget
+		self.ttl = ttl
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.storage : OrderedDict[Any, Tuple[float, int, int, Any]] = OrderedDict()
+
+	def __len__(self) -> int:
+		return len(self.storage)
+
+	@property
+	def hit_rate(self) -> float:
+		total = self.hits + self.misses
+		return self.hits / total if total else 0.0
+
+	def __str__(self) -> str:
+		return f"{len(self.storage)} results, {self.size // 1024}/{self.budget // 1024} KiB | {self.hit_rate*100:.1f}% hits"
+
+	def get(self, key:Any, watermark:int) -> Optional[Any]:
+		if key not in self.storage:
+			self.misses += 1
+			return None
+		stored, mark, _size, value = self.storage[key]
+		if mark != watermark or time() - stored > self.ttl:
+			self.drop(key)
+			self.misses += 1
+			return None
+		self.storage.move_to_end(key)
+		self.hits += 1
+		return value
+
+	def put(self, key:Any, watermark:int, value:Any):
+		if not self.budget:
+			return
+		size = _size_of(value)
+		if size > self.budget:
+			return
+		self.drop(key)
+		self.storage[key] = (time(), watermark, size, value)
+		self.size += size
+		while self.size > self.budget:
+			_key, (_stored, _mark, evicted, _value) = self.storage.popitem(last=False)
+			self.size -= evicted
+
+	def drop(self, key:Any):
+		if key in self.storage:
+			self.size -= self.storage.pop(key)[2]
@@ -0,0 +1,71 @@
+import html
+
+from typing import Any, List, Dict, Optional
+
+# Long field -> short field. Fields which are queried (id, chat, user, date, text, media, reply, edits, file) are kept as they are
+COMPACT_KEYS = {
+	"formatted" : "fmt",
+	"forward" : "fwd",
+	"author" : "sig",
+	"via_bot" : "via",
+	"keyboard" : "kb",
+	"inline" : "ikb",
+	"scheduled" : "sch",
+	"empty" : "nil",
+	"poll" : "pl",
+	"contact" : "ct",
+	"web_page" : "wp",
+}
+EXPAND_KEYS = { v: k for k, v in COMPACT_KEYS.items() }
+
+FORWARD_KEYS = { "user": "u", "date": "d" }
+EXPAND_FORWARD_KEYS = { v: k for k, v in FORWARD_KEYS.items() }
+
+def _compact_inline(rows:List[List[dict]]) -> List[List[List[Optional[str]]]]:
+	"""convert_to_dict dump of an inline keyboard -> rows of [text, url] (or just [text])"""
+	return [
+		[ [ btn.get("text"), btn["url"] ] if btn.get("url") else [ btn.get("text") ] for btn in row ]
+		for row in rows
+	]
+
+def _expand_inline(rows:List[List[List[Optional[str]]]]) -> List[List[Dict[str, Any]]]:
+	return [
+		[ {"text": btn[0], "url": btn[1]} if len(btn) > 1 else {"text": btn[0]} for btn in row ]
+		for row in rows
+	]
+
+def _formatted_adds_nothing(doc:Dict[str, Any]) -> bool:
+	text = doc.get("text")
+	return isinstance(doc["formatted"], str) and text is not None and doc["formatted"] == html.escape(text)
+
+def compact_message(doc:Dict[str, Any]) -> Dict[str, Any]:
+	"""convert a message (or edit) document to the compact schema. Documents already compact are left as they are"""
+	out : Dict[str, Any] = {}
+	for key, value in doc.items():
+		if key == "formatted" and _formatted_adds_nothing(doc):
+			value = True # just a marker, expand_message rebuilds it from text
+		elif key == "inline" and isinstance(value, list):
+			value = _compact_inline(value)
+		elif key == "forward" and isinstance(value, dict):
+			value = { FORWARD_KEYS.get(k, k): v for k, v in value.items() }
+		elif key == "edits" and isinstance(value, list):
+			value = [ compact_message(edit) for edit in value ]
+		out[COMPACT_KEYS.get(key, key)] = value
+	return out
+
+def expand_message(doc:Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+	"""read side adapter: convert a compact document back to the full schema. Full documents are left as they are"""
+	if doc is None:
+		return None
+	out : Dict[str, Any] = {}
+	for key, value in doc.items():
+		if key == "fmt" and value is True:
+			value = html.escape(doc.get("text") or "")
+		elif key == "ikb":
+			value = _expand_inline(value)
+		elif key == "fwd":
+			value = { EXPAND_FORWARD_KEYS.get(k, k): v for k, v in value.items() }
+		elif key == "edits" and isinstance(value, list):
+			value = [ expand_message(edit) for edit in value ]
+		out[EXPAND_KEYS.get(key, key)] = value
+	return out
@@ -0,0 +1,110 @@
+import os
+import hashlib
+import traceback
+
+from time import time
+from datetime import datetime
+from typing import Any, List, Dict, Tuple, Callable
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+def fingerprint(ex:BaseException, depth:int = 5) -> Tuple[str, List[str]]:
+	"""hash of exception type and innermost `depth` frames (file and function, not line, so it survives small edits)"""
+	frames = [ f"{os.path.basename(f.filename)}:{f.name}" for f in traceback.extract_tb(ex.__traceback__)[-depth:] ]
+	key = "|".join([f"{type(ex).__module__}.{type(ex).__qualname__}", *frames])
+	return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16], frames
+
+class ExceptionAggregator:
+	"""Groups exceptions by fingerprint instead of storing one document per failure
+
+	Each fingerprint has one document in `exceptions` with a count, first and last seen dates, details of the
+	latest occurrence and up to `samples` sample events (the most recent ones). The first occurrence is written
+	right away, later ones are counted in memory and written at most once every `interval` seconds, each write
+	carrying a single sample: a burst of failures costs one upsert per fingerprint per interval.
+	"""
+	def __init__(self, interval:float = 60.0, samples:int = 10):
+		self.interval = interval
+		self.samples = samples
+		self.pending : Dict[str, Dict[str, Any]] = {}
+		self.last_write : Dict[str, float] = {}
+		self.last_flush = time()
+
+	def __len__(self) -> int:
+		return len(self.pending)
+
+	@property
+	def expired(self) -> bool:
+		return bool(self.pending) and time() - self.last_flush >= self.interval
+
+	def record(self, ex:BaseException, hook:str, event:Any, convert:Callable[[Any], dict]) -> str:
+		"""count an occurrence, returns its fingerprint. Only the latest event is kept, and converted when written"""
+		fp, frames = fingerprint(ex)
+		now = datetime.now()
+		entry = self.pending.get(fp)
+		if entry is None:
+			entry = self.pending[fp] = {"count": 0, "first": now, "sample": None}
+		entry.update({
+			"last": now, "hook": hook, "frames": frames,
+			"type": repr(ex), "text": str(ex), "traceback": "".join(traceback.format_exception(type(ex), ex, ex.__traceback__)),
+		})
+		entry["count"] += 1
+		entry["sample"] = (now, hook, str(ex), event, convert) # latest occurrence, event is converted only when written
+		return fp
+
+	def due(self, fp:str) -> bool:
+		"""if this fingerprint should be written now rather than on next flush"""
+		return time() - self.last_write.get(fp, 0) >= self.interval
+
+	def _update(self, fp:str, entry:Dict[str, Any]) -> UpdateOne:
+		update : Dict[str, Any] = {
+			"$inc": {"count": entry["count"]},
+			"$min": {"first": entry["first"]},
+			"$max": {"last": entry["last"]},
+			"$set": { k: entry[k] for k in ("hook", "frames", "type", "text", "traceback") },
+		}
+		if entry["sample"] is not None:
+			date, hook, text, event, convert = entry["sample"]
+			try:
+				converted = convert(event)
+			except Exception: # don't let a bad event hold back the whole group
+				logger.exception("Could not convert sample event for exception group %s", fp)
+				converted = None
+			sample = {"date": date, "hook": hook, "text": text, "event": converted}
+			update["$push"] = {"samples": {"$each": [sample], "$slice": -self.samples}}
+		return UpdateOne({"fingerprint": fp}, update, upsert=True)
+
+	def _merge(self, fp:str, entry:Dict[str, Any]):
+		"""put back occurrences which could not be written, under any recorded since"""
+		newer = self.pending.get(fp)
+		if newer is None:
+			self.pending[fp] = entry
+			return
+		newer["count"] += entry["count"]
+		newer["first"] = min(newer["first"], entry["first"])
+
+	async def write(self, db:AsyncIOMotorDatabase, *fps:str) -> int:
+		"""upsert pending occurrences of given fingerprints (all if none given), returns documents written"""
+		entries = { fp: self.pending.pop(fp) for fp in (fps or tuple(self.pending.keys())) if fp in self.pending }
+		if not entries:
+			return 0
+		now = time()
+		for fp in entries:
+			self.last_write[fp] = now
+		try:
+			requests = [ self._update(fp, entry) for fp, entry in entries.items() ]
+			await db.exceptions.bulk_write(requests, ordered=False)
+		except Exception:
+			logger.exception("Could not store %d exception groups, keeping them for next flush", len(entries))
+			for fp, entry in entries.items():
+				self._merge(fp, entry)
+			return 0
+		return len(entries)
+
+	async def flush(self, db:AsyncIOMotorDatabase) -> int:
+		self.last_flush = time()
+		return await self.write(db)
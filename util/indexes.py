@@ -0,0 +1,157 @@
+import asyncio
+
+from typing import Any, List, Dict, Tuple, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+IndexKeys = List[Tuple[str, Any]]
+
+class IndexSpec:
+	"""An index the driver needs: where, on which keys and with which options"""
+	def __init__(self, collection:str, name:str, keys:IndexKeys, unique:bool = False,
+			partial:Optional[dict] = None, hint:str = "", extra:Optional[dict] = None):
+		self.collection = collection
+		self.name = name
+		self.keys = keys
+		self.unique = unique
+		self.partial = partial
+		self.hint = hint # logged if building this index fails
+		self.extra = extra or {} # other create_index options
+
+	def options(self) -> Dict[str, Any]:
+		opts : Dict[str, Any] = {"name": self.name}
+		if self.unique:
+			opts["unique"] = True
+		if self.partial:
+			opts["partialFilterExpression"] = self.partial
+		opts.update(self.extra)
+		return opts
+
+DUPLICATES_HINT = "Check util/datafix.py if there are duplicates"
+USERS_HINT = "Not having these indexes will affect performance!"
+
+# Indexes are built in this order, so put the cheap and useful ones first
+INDEXES : List[IndexSpec] = [
+	IndexSpec("messages", "alemibot-chronological", [("date",-1)]),
+	IndexSpec("service", "alemibot-chronological", [("date",-1)]),
+	IndexSpec("deletions", "alemibot-chronological", [("date",-1)]),
+	IndexSpec("members", "alemibot-chronological", [("date",-1)]),
+	# This is not unique but still speeds up a ton
+	IndexSpec("members", "alemibot-member-history", [("chat",1),("user",1),("date",1)]),
+	# This is very useful for counting messages for each member
+	IndexSpec("messages", "alemibot-per-user", [("user",1)]),
+	IndexSpec("service", "alemibot-per-user", [("user",1)]),
+	# Building these may fail, run datafix script with duplicates option
+	IndexSpec("messages", "alemibot-unique-messages", [("chat",1),("id",1),("date",-1)], unique=True, hint=DUPLICATES_HINT),
+	IndexSpec("service", "alemibot-unique-service", [("chat",1),("id",1),("date",-1)], unique=True, hint=DUPLICATES_HINT),
+	IndexSpec("deletions", "alemibot-unique-deletions", [("chat",1),("id",1),("date",-1)], unique=True, hint=DUPLICATES_HINT),
+	IndexSpec("edits", "alemibot-unique-edits", [("chat",1),("id",1),("date",1)], unique=True, hint=DUPLICATES_HINT),
+	IndexSpec("users", "alemibot-unique-users", [("id",1)], unique=True, hint=USERS_HINT),
+	IndexSpec("chats", "alemibot-unique-chats", [("id",1)], unique=True, hint=USERS_HINT),
+	IndexSpec("backfill", "alemibot-unique-backfill", [("chat",1)], unique=True),
+	# Hourly rollups, the unique key is also needed by datafix.py rollups ($merge)
+	IndexSpec("activity", "alemibot-unique-activity", [("chat",1),("user",1),("date",1)], unique=True),
+	IndexSpec("activity", "alemibot-per-user", [("user",1),("date",1)]),
+	# Only exception groups have a fingerprint, replaced duplicates are logged here too
+	IndexSpec("exceptions", "alemibot-unique-exceptions", [("fingerprint",1)], unique=True, partial={"fingerprint": {"$exists": True}}),
+]
+
+# Only built if enabled (text_index = true): it's big and slow to build on large message collections.
+# No language, so that words aren't stemmed and no stop words are dropped, whatever language chats are in
+TEXT_INDEX = IndexSpec("messages", "alemibot-text", [("text","text")], extra={"default_language": "none"},
+	hint="Keyword filters will keep scanning messages")
+
+def has_index(indexes, index):
+	for name in indexes:
+		if indexes[name]["key"] == index:
+			return True
+	return False
+
+class IndexManager:
+	"""Checks and builds the indexes in a manifest
+
+	`check` fetches `index_information` once per collection, concurrently, and marks each index as
+	`ok` or `missing`. An index is considered present if any index on the same keys exists, whatever
+	its name. `build` then creates missing indexes, one at a time within each collection but
+	all collections in parallel, and is meant to run in background: until unique indexes are built,
+	duplicates are not rejected.
+	"""
+	def __init__(self, manifest:List[IndexSpec] = INDEXES):
+		self.manifest = manifest
+		self.state : Dict[Tuple[str, str], str] = { (spec.collection, spec.name): "unknown" for spec in manifest }
+		self.errors : Dict[Tuple[str, str], str] = {}
+		self.task : Optional[asyncio.Task] = None
+
+	def __str__(self) -> str:
+		counts : Dict[str, int] = {}
+		for state in self.state.values():
+			counts[state] = counts.get(state, 0) + 1
+		return " | ".join(f"{v} {k}" for k, v in sorted(counts.items()))
+
+	@property
+	def missing(self) -> List[IndexSpec]:
+		return [ spec for spec in self.manifest if self.state[(spec.collection, spec.name)] in ("missing", "failed", "queued") ]
+
+	async def check(self, db:AsyncIOMotorDatabase):
+		colls = list(dict.fromkeys(spec.collection for spec in self.manifest))
+		infos = await asyncio.gather(*( db[coll].index_information() for coll in colls ))
+		existing = dict(zip(colls, infos))
+		for spec in self.manifest:
+			key = (spec.collection, spec.name)
+			if self.state[key] in ("building", "queued"):
+				continue
+			present = has_index(existing[spec.collection], spec.keys) or spec.name in existing[spec.collection] # text indexes have internal keys
+			if present:
+				self.state[key] = "ok"
+			elif self.state[key] != "failed": # keep failures (and their error) visible until retried
+				self.state[key] = "missing"
+
+	async def _build_collection(self, db:AsyncIOMotorDatabase, specs:List[IndexSpec]):
+		for spec in specs:
+			key = (spec.collection, spec.name)
+			self.state[key] = "building"
+			try:
+				await db[spec.collection].create_index(spec.keys, **spec.options())
+				self.state[key] = "ok"
+				self.errors.pop(key, None)
+				logger.info("Built index %s on %s", spec.name, spec.collection)
+			except Exception as e:
+				self.state[key] = "failed"
+				self.errors[key] = str(e)
+				logger.exception("Error while building index %s on %s. %s", spec.name, spec.collection, spec.hint)
+
+	async def build(self, db:AsyncIOMotorDatabase) -> int:
+		"""create all missing indexes, returns how many were built"""
+		per_coll : Dict[str, List[IndexSpec]] = {}
+		for spec in self.missing:
+			per_coll.setdefault(spec.collection, []).append(spec)
+		if not per_coll:
+			return 0
+		logger.info("Building %d missing indexes (may take a while first time...)", sum(len(v) for v in per_coll.values()))
+		await asyncio.gather(*( self._build_collection(db, specs) for specs in per_coll.values() ))
+		return sum(1 for specs in per_coll.values() for spec in specs if self.state[(spec.collection, spec.name)] == "ok")
+
+	def build_background(self, db:AsyncIOMotorDatabase) -> asyncio.Task:
+		"""queue missing indexes and build them in a background task, unless a build is already running"""
+		if self.task is None or self.task.done():
+			for spec in self.missing: # build() would mark them only once its tasks start
+				self.state[(spec.collection, spec.name)] = "queued"
+			self.task = asyncio.create_task(self.build(db))
+		return self.task
+
+	def stop(self):
+		if self.task is not None:
+			self.task.cancel()
+			self.task = None
+
+	async def ensure(self, db:AsyncIOMotorDatabase):
+		"""check and build missing indexes, never raises"""
+		try:
+			await self.check(db)
+			await self.build(db)
+		except Exception:
+			logger.exception("Error while checking indexes")
@@ -0,0 +1,201 @@
+import os
+import asyncio
+import pickle
+import struct
+
+from time import time
+from typing import Any, List, Dict, Tuple, Callable, Awaitable, Optional
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("block", "drop", "spill")
+
+Handler = Callable[[str, Any, Dict[str, Any]], Awaitable[Any]]
+
+def shard_key(event:Any) -> Any:
+	"""key events are sharded on: chat id when there is one (first event for lists), otherwise event id"""
+	if isinstance(event, list):
+		event = event[0] if event else None
+	chat = getattr(event, "chat", None)
+	if chat is not None:
+		return chat.id
+	return getattr(event, "id", 0)
+
+class IngestQueue:
+	"""Bounded queue between event hooks and the database driver
+
+	Hooks only enqueue events, which are then consumed by `workers` tasks. Each worker has its own queue
+	and events are sharded on their chat, so events for the same chat are always processed in order.
+	When a queue is full, `policy` decides what happens:
+	 * block : hook waits until there's room, like awaiting the driver directly
+	 * drop  : oldest queued event is discarded to make room
+	 * spill : event is pickled to a file on disk and queued back once there's room again
+	Once an event is spilled, all following ones are spilled too until the spill file has been replayed, so
+	that newer events never overtake spilled ones. Events left on disk are replayed on next start, before
+	any new event.
+	"""
+	def __init__(self, handler:Handler, size:int = 1000, workers:int = 4, policy:str = "block",
+			spill_path:str = "plugins/statsbot/spool/ingest.spill", client:Any = None):
+		if policy not in POLICIES:
+			raise ValueError(f"Unknown ingest queue policy '{policy}', must be one of {POLICIES}")
+		self.handler = handler
+		self.size = size
+		self.workers = max(1, workers)
+		self.policy = policy
+		self.spill_path = spill_path
+		self.replay_path = spill_path + ".replay"
+		self.client = client
+		self.queues : List[asyncio.Queue] = [ asyncio.Queue(maxsize=max(1, size // self.workers)) for _ in range(self.workers) ]
+		self.tasks : List[asyncio.Task] = []
+		self.replayer : Optional[asyncio.Task] = None
+		self.spilling = False
+		self.dropped = 0
+		self.spilled = 0
+		self.waited = 0
+		self.wait_total = 0.0
+		self.wait_max = 0.0
+
+	@property
+	def depth(self) -> int:
+		return sum(q.qsize() for q in self.queues)
+
+	@property
+	def wait_avg(self) -> float:
+		return self.wait_total / self.waited if self.waited else 0.0
+
+	def __str__(self) -> str:
+		return f"{self.depth}/{self.size} queued | wait avg {self.wait_avg*1000:.1f}ms max {self.wait_max*1000:.1f}ms" + \
+			(f" | {self.dropped} dropped" if self.dropped else "") + \
+			(f" | {self.spilled} spilled" if self.spilled else "")
+
+	def _shard(self, event:Any) -> asyncio.Queue:
+		return self.queues[hash(shard_key(event)) % self.workers]
+
+	def start(self):
+		for q in self.queues:
+			self.tasks.append(asyncio.create_task(self._work(q)))
+		if self.policy == "spill":
+			# events left on disk by last run go first: spill new ones behind them until replayed
+			self.spilling = os.path.isfile(self.replay_path) or os.path.isfile(self.spill_path)
+			self.replayer = asyncio.create_task(self._replay())
+
+	async def stop(self, timeout:float = 30.0):
+		"""wait for queued events to be processed (up to `timeout` seconds), then stop workers"""
+		if self.replayer is not None: # stop replaying first, what's left on disk will be replayed next time
+			self.replayer.cancel()
+			await asyncio.gather(self.replayer, return_exceptions=True)
+			self.replayer = None
+		try:
+			await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout)
+		except asyncio.TimeoutError:
+			logger.error("Ingest queue did not drain in time, %d events left", self.depth)
+			if self.policy == "spill": # queued events are older than anything on disk, put them in front
+				left = []
+				for q in self.queues:
+					while not q.empty():
+						_, method, event, kwargs = q.get_nowait()
+						left.append((method, event, kwargs))
+				if left:
+					rest = self._read_spill(self.replay_path) if os.path.isfile(self.replay_path) else []
+					self._write_spill(self.replay_path, left + rest, mode="wb")
+		for task in self.tasks:
+			task.cancel()
+		self.tasks = []
+
+	async def put(self, method:str, event:Any, kwargs:Dict[str, Any]):
+		if self.spilling:
+			return self._spill(method, event, kwargs)
+		queue = self._shard(event)
+		item = (time(), method, event, kwargs)
+		if not queue.full() or self.policy == "block":
+			return await queue.put(item)
+		if self.policy == "drop":
+			try:
+				queue.get_nowait()
+				queue.task_done()
+				self.dropped += 1
+			except asyncio.QueueEmpty:
+				pass
+			return queue.put_nowait(item)
+		self.spilling = True
+		self._spill(method, event, kwargs)
+
+	async def _work(self, queue:asyncio.Queue):
+		while True:
+			queued, method, event, kwargs = await queue.get()
+			elapsed = time() - queued
+			self.waited += 1
+			self.wait_total += elapsed
+			self.wait_max = max(self.wait_max, elapsed)
+			try:
+				await self.handler(method, event, kwargs)
+			except Exception:
+				logger.exception("Error while processing queued %s", method)
+			finally:
+				queue.task_done()
+
+	def _spill(self, method:str, event:Any, kwargs:Dict[str, Any]):
+		if self._write_spill(self.spill_path, [(method, event, kwargs)]):
+			self.spilled += 1
+
+	def _write_spill(self, path:str, events:List[Tuple[str, Any, Dict[str, Any]]], mode:str = "ab") -> int:
+		"""append events to a spill file (or overwrite it with mode 'wb'), returns how many were written"""
+		records = []
+		for method, event, kwargs in events:
+			try:
+				data = pickle.dumps((method, event, kwargs))
+			except Exception:
+				logger.exception("Could not spill %s event, dropping it", method)
+				self.dropped += 1
+				continue
+			records.append(struct.pack("<I", len(data)) + data)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, mode) as f:
+			f.write(b"".join(records))
+		return len(records)
+
+	def _read_spill(self, path:str) -> List[Tuple[str, Any, Dict[str, Any]]]:
+		out = []
+		with open(path, "rb") as f:
+			while True:
+				head = f.read(4)
+				if len(head) < 4:
+					break
+				data = f.read(struct.unpack("<I", head)[0])
+				try:
+					out.append(pickle.loads(data))
+				except Exception:
+					logger.exception("Discarding unreadable spilled event")
+		return out
+
+	def _reattach(self, event:Any):
+		"""pyrogram objects don't pickle their client, give it back"""
+		if isinstance(event, list):
+			for e in event:
+				self._reattach(e)
+		elif self.client is not None and hasattr(event, "__dict__"):
+			event._client = self.client
+
+	async def _replay(self):
+		while True:
+			if not os.path.isfile(self.replay_path):
+				if not os.path.isfile(self.spill_path):
+					self.spilling = False # nothing left on disk, new events can go straight to the queues
+					await asyncio.sleep(1)
+					continue
+				if self.depth > self.size // 2:
+					await asyncio.sleep(1)
+					continue
+				os.replace(self.spill_path, self.replay_path)
+			events = self._read_spill(self.replay_path)
+			logger.info("Replaying %d spilled events", len(events))
+			for i, (method, event, kwargs) in enumerate(events):
+				self._reattach(event)
+				try:
+					await self._shard(event).put((time(), method, event, kwargs))
+				except asyncio.CancelledError: # keep what wasn't queued yet for next time
+					self._write_spill(self.replay_path, events[i:], mode="wb")
+					raise
+			os.remove(self.replay_path)
@@ -0,0 +1,111 @@
+import os
+import asyncio
+import mimetypes
+
+from typing import Any, Dict, Set, Callable, Awaitable, Optional
+
+from pyrogram import Client
+from pyrogram.types import Message
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+class MediaDownloader:
+	"""Downloads message media in background
+
+	At most `workers` downloads run at once and media bigger than `max_size` bytes (if set) is skipped.
+	Files are saved as their `file_unique_id`, so media already on disk is never downloaded twice, and
+	messages carrying media that is being downloaded wait for that download instead of starting another.
+	Once a file is available, `on_done` is called with the message and the file path.
+	"""
+	def __init__(self, client:Client, on_done:Callable[[Message, str], Awaitable[Any]],
+			workers:int = 2, max_size:int = 0, directory:str = "plugins/statsbot/data/"):
+		self.client = client
+		self.on_done = on_done
+		self.max_size = max_size
+		self.directory = directory
+		self.semaphore = asyncio.Semaphore(workers)
+		self.tasks : Set[asyncio.Task] = set()
+		self.downloaded = 0
+		self.duplicates = 0
+		self.skipped = 0
+		self.failed = 0
+		self._files : Optional[Dict[str, str]] = None
+		self._inflight : Dict[str, asyncio.Future] = {}
+
+	def __len__(self) -> int:
+		return len(self.tasks)
+
+	def __str__(self) -> str:
+		return f"{len(self.tasks)} running | {self.downloaded} new | {self.duplicates} dupes | {self.skipped} skipped | {self.failed} failed"
+
+	@property
+	def files(self) -> Dict[str, str]:
+		"""file_unique_id -> path of media already on disk, scanned once on first access"""
+		if self._files is None:
+			os.makedirs(self.directory, exist_ok=True)
+			self._files = {
+				os.path.splitext(fname)[0] : os.path.join(self.directory, fname)
+				for fname in os.listdir(self.directory)
+			}
+		return self._files
+
+	def submit(self, message:Message):
+		task = asyncio.create_task(self._download(message))
+		self.tasks.add(task)
+		task.add_done_callback(self.tasks.discard)
+
+	async def stop(self):
+		for task in self.tasks:
+			task.cancel()
+
+	async def _download(self, message:Message):
+		media = getattr(message, message.media.value, None) if message.media else None
+		unique_id = getattr(media, "file_unique_id", None)
+		if not unique_id: # polls, locations, web pages... nothing to download
+			return
+		size = getattr(media, "file_size", None) or 0
+		if self.max_size and size > self.max_size:
+			self.skipped += 1
+			return
+		path = self.files.get(unique_id)
+		if path:
+			self.duplicates += 1
+		elif unique_id in self._inflight: # same media is being downloaded for another message
+			self.duplicates += 1
+			path = await asyncio.shield(self._inflight[unique_id])
+			if not path:
+				return
+		else:
+			future = self._inflight[unique_id] = asyncio.get_running_loop().create_future()
+			try:
+				path = await self._fetch(message, media, unique_id)
+			finally:
+				del self._inflight[unique_id]
+				if not future.done():
+					future.set_result(path)
+			if not path:
+				return
+		try:
+			await self.on_done(message, path)
+		except Exception:
+			logger.exception("Could not attach file %s to message", path)
+
+	async def _fetch(self, message:Message, media:Any, unique_id:str) -> Optional[str]:
+		"""download media to disk, returns its path or None if the download failed"""
+		ext = os.path.splitext(getattr(media, "file_name", None) or "")[1] \
+			or mimetypes.guess_extension(getattr(media, "mime_type", None) or "") or ""
+		try:
+			async with self.semaphore:
+				path = await self.client.download_media(message, file_name=os.path.join(self.directory, unique_id + ext))
+		except Exception:
+			logger.exception("Could not download media %s", unique_id)
+			self.failed += 1
+			return None
+		if not path:
+			self.failed += 1
+			return None
+		self.files[unique_id] = path
+		self.downloaded += 1
+		return path
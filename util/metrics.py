@@ -0,0 +1,142 @@
+import os
+import bisect
+
+from time import time
+from datetime import datetime
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, List, Dict, Tuple, Deque, Iterator
+
+# Latency histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# Time spent serializing by the event currently being processed, so that hooks can tell it apart from db time
+SERIALIZE_TIME : ContextVar[float] = ContextVar("SERIALIZE_TIME", default=0.0)
+
+class Histogram:
+	"""Latency histogram with fixed buckets"""
+	def __init__(self):
+		self.counts = [0] * len(BUCKETS)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value:float):
+		self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	def quantile(self, q:float) -> float:
+		"""estimate q-th quantile as the upper bound of the bucket it falls in"""
+		if not self.count:
+			return 0.0
+		target = q * self.count
+		acc = 0
+		for bound, count in zip(BUCKETS, self.counts):
+			acc += count
+			if acc >= target:
+				return bound if bound != float("inf") else BUCKETS[-2]
+		return BUCKETS[-2]
+
+class RateWindow:
+	"""Counts events per second over the last 15 minutes"""
+	SPAN = 900
+
+	def __init__(self):
+		self.slots : Deque[List[int]] = deque() # [second, count]
+
+	def mark(self, amount:int = 1):
+		now = int(time())
+		if self.slots and self.slots[-1][0] == now:
+			self.slots[-1][1] += amount
+		else:
+			self.slots.append([now, amount])
+		while self.slots and self.slots[0][0] <= now - self.SPAN:
+			self.slots.popleft()
+
+	def rate(self, seconds:int) -> float:
+		"""average events per second in the last `seconds` seconds"""
+		since = int(time()) - seconds
+		return sum(c for s, c in self.slots if s > since) / seconds
+
+class MetricsRegistry:
+	"""Ingest instrumentation
+
+	Keeps total counters (with 1/5/15 minutes sliding window rates), error counts and latency
+	histograms for each hook, split by phase (serialize vs db). Counters are read with [] access.
+	"""
+	def __init__(self):
+		self.start = datetime.now()
+		self.counters : Dict[str, int] = {}
+		self.rates : Dict[str, RateWindow] = {}
+		self.errors : Dict[str, int] = {}
+		self.latency : Dict[Tuple[str, str], Histogram] = {}
+
+	def __getitem__(self, name:str) -> int:
+		return self.counters.get(name, 0)
+
+	def __contains__(self, name:str) -> bool:
+		return name in self.counters
+
+	def incr(self, name:str, amount:int = 1):
+		self.counters[name] = self.counters.get(name, 0) + amount
+		if name not in self.rates:
+			self.rates[name] = RateWindow()
+		self.rates[name].mark(amount)
+
+	def error(self, name:str):
+		self.errors[name] = self.errors.get(name, 0) + 1
+
+	def rate(self, name:str, seconds:int) -> float:
+		return self.rates[name].rate(seconds) if name in self.rates else 0.0
+
+	def observe(self, hook:str, phase:str, value:float):
+		key = (hook, phase)
+		if key not in self.latency:
+			self.latency[key] = Histogram()
+		self.latency[key].observe(value)
+
+	@contextmanager
+	def serializing(self) -> Iterator[None]:
+		"""time a serialization step, counted for current event"""
+		start = time()
+		try:
+			yield
+		finally:
+			SERIALIZE_TIME.set(SERIALIZE_TIME.get() + time() - start)
+
+	@property
+	def hooks(self) -> List[str]:
+		return sorted(set(hook for hook, _ in self.latency.keys()))
+
+	def prometheus(self, prefix:str = "statsbot") -> str:
+		"""render all metrics in Prometheus text exposition format"""
+		out = [
+			f"# TYPE {prefix}_events_total counter",
+			*( f'{prefix}_events_total{{name="{name}"}} {value}' for name, value in self.counters.items() ),
+			f"# TYPE {prefix}_events_rate gauge",
+		]
+		for name in self.counters:
+			for window in (60, 300, 900):
+				out.append(f'{prefix}_events_rate{{name="{name}",window="{window}"}} {self.rate(name, window):.4f}')
+		out.append(f"# TYPE {prefix}_errors_total counter")
+		out += [ f'{prefix}_errors_total{{hook="{name}"}} {value}' for name, value in self.errors.items() ]
+		out.append(f"# TYPE {prefix}_latency_seconds histogram")
+		for (hook, phase), hist in self.latency.items():
+			labels = f'hook="{hook}",phase="{phase}"'
+			acc = 0
+			for bound, count in zip(BUCKETS, hist.counts):
+				acc += count
+				le = "+Inf" if bound == float("inf") else str(bound)
+				out.append(f'{prefix}_latency_seconds_bucket{{{labels},le="{le}"}} {acc}')
+			out.append(f"{prefix}_latency_seconds_sum{{{labels}}} {hist.sum:.6f}")
+			out.append(f"{prefix}_latency_seconds_count{{{labels}}} {hist.count}")
+		return "\n".join(out) + "\n"
+
+	def write_textfile(self, path:str):
+		"""write metrics to `path` atomically, for node_exporter textfile collector or similar"""
+		os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+		tmp = path + ".tmp"
+		with open(tmp, "w") as f:
+			f.write(self.prometheus())
+		os.replace(tmp, path)
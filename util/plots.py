@@ -0,0 +1,141 @@
+"""Plot rendering, meant to run in worker processes: functions take plain arrays and return PNG bytes"""
+import io
+import asyncio
+
+from datetime import date, timedelta
+from multiprocessing import get_context, get_all_start_methods
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, List, Callable, Optional
+
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _context():
+	"""forkserver context, with numpy and matplotlib preloaded so that workers start fast
+
+	Forking the bot itself isn't safe (event loop, sockets, threads). Workers still import `__main__` if the
+	bot was started from a script (not with `python -m`), which must then guard its entry point with
+	`if __name__ == "__main__":`. Where forkserver isn't available (Windows), fall back to spawn.
+	"""
+	if "forkserver" not in get_all_start_methods():
+		return get_context("spawn")
+	ctx = get_context("forkserver")
+	ctx.set_forkserver_preload(["numpy", "matplotlib"])
+	return ctx
+
+def _init_worker():
+	import matplotlib
+	matplotlib.use("Agg") # no display in workers, and Agg doesn't need one
+
+def _png(fig, dpi:int) -> bytes:
+	import matplotlib.pyplot as plt
+	try:
+		buf = io.BytesIO()
+		fig.savefig(buf, dpi=dpi)
+		return buf.getvalue()
+	finally:
+		plt.close(fig) # pyplot keeps a reference to every figure until closed
+
+def render_density(vals:np.ndarray, now:date, sunday:bool, title:str, dpi:int) -> bytes:
+	import matplotlib.pyplot as plt
+	import matplotlib.dates as mdates
+	length = len(vals)
+	dates = [ now - timedelta(i) for i in range(length) ]
+
+	fig, ax = plt.subplots()
+
+	ax.plot(dates, vals)
+	# Major ticks every 7 days.
+	ax.xaxis.set_major_locator(mdates.WeekdayLocator(byweekday=(6) if sunday else (0)))
+	# Minor ticks every month.
+	ax.xaxis.set_minor_locator(mdates.DayLocator())
+	# Set formatter for dates on X axis depending on length
+	if length <= 7:
+		ax.xaxis.set_minor_formatter(mdates.DateFormatter('%a'))
+		ax.xaxis.set_major_formatter(mdates.DateFormatter('%a %-d'))
+	elif length <= 20:
+		ax.xaxis.set_major_formatter(mdates.DateFormatter('%a %-d'))
+	elif length <= 90:
+		ax.xaxis.set_major_formatter(mdates.DateFormatter('%-d %h'))
+	else:
+		ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+
+	ax.set_title(title)
+	# Turn on grid
+	ax.grid(True)
+
+	fig.autofmt_xdate()
+	return _png(fig, dpi)
+
+def render_heatmap(vals:np.ndarray, week_numbers:List[str], week_days:List[str], title:str, dpi:int) -> bytes:
+	import matplotlib.pyplot as plt
+	fig, ax = plt.subplots()
+	ax.imshow(vals)
+
+	# Add ticks to heatmap
+	ax.set_xticks(np.arange(len(week_days)))
+	ax.set_yticks(np.arange(len(week_numbers)))
+	ax.set_xticklabels(week_days)
+	ax.set_yticklabels(week_numbers)
+
+	# Rotate the tick labels and set their alignment.
+	plt.setp(ax.get_xticklabels(), rotation=45, ha="right", rotation_mode="anchor")
+
+	# Loop over data dimensions and create text annotations.
+	for i in range(len(week_numbers)):
+		for j in range(len(week_days)):
+			ax.text(j, i, vals[i, j], ha="center", va="center", color="w")
+
+	ax.set_title(title)
+	fig.tight_layout()
+	return _png(fig, dpi)
+
+def render_timeshift(vals:np.ndarray, title:str, dpi:int) -> bytes:
+	import matplotlib.pyplot as plt
+	labels = [ f"{i:02d}" for i in range(len(vals)) ]
+	fig, ax = plt.subplots()
+	ax.bar(labels, vals)
+	ax.set_title(title)
+	return _png(fig, dpi)
+
+class PlotRenderer:
+	"""Renders plots in a pool of `workers` processes, so that matplotlib never blocks the event loop
+
+	Workers use the Agg backend and are started (from a forkserver, see `_context`) on first render.
+	At most `workers` renders are submitted at once: other requests wait on a semaphore, without piling
+	up arrays in the pool queue.
+	"""
+	def __init__(self, workers:int = 2):
+		self.workers = workers
+		self.semaphore = asyncio.Semaphore(workers)
+		self.pool : Optional[ProcessPoolExecutor] = None
+		self.busy = 0
+		self.rendered = 0
+
+	def __str__(self) -> str:
+		return f"{self.busy}/{self.workers} busy | {self.rendered} rendered"
+
+	async def render(self, func:Callable[..., bytes], *args:Any) -> bytes:
+		async with self.semaphore:
+			if self.pool is None:
+				self.pool = ProcessPoolExecutor(self.workers, mp_context=_context(), initializer=_init_worker)
+			self.busy += 1
+			try:
+				png = await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+			except BrokenProcessPool: # a worker died, start a new pool on next render
+				logger.error("Plot worker died, restarting pool")
+				self.pool = None
+				raise
+			finally:
+				self.busy -= 1
+			self.rendered += 1
+			return png
+
+	def stop(self):
+		if self.pool is not None:
+			self.pool.shutdown(wait=False, cancel_futures=True)
+			self.pool = None
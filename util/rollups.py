@@ -0,0 +1,25 @@
+from datetime import datetime
+from typing import Any, List, Dict, Tuple, Optional
+
+ACTIVITY_KEYS = ("chat", "user", "date")
+HOUR_MS = 60 * 60 * 1000
+
+def activity_key(msg:dict) -> Tuple[Any, int, datetime]:
+	"""key of the hourly `activity` rollup a message document counts towards
+
+	Messages without author are counted with user 0: MongoDB can't $merge on null keys.
+	"""
+	return msg.get("chat"), msg.get("user") or 0, msg["date"].replace(minute=0, second=0, microsecond=0)
+
+def rollup_pipeline(flt:Optional[dict] = None) -> List[Dict[str, Any]]:
+	"""aggregation rebuilding `activity` from `messages` (matching `flt`), replacing rollups it covers"""
+	hour = {"$toDate": {"$subtract": [{"$toLong": "$date"}, {"$mod": [{"$toLong": "$date"}, HOUR_MS]}]}}
+	return [
+		{"$match": {"date": {"$type": "date"}, **(flt or {})}},
+		{"$group": {
+			"_id": {"chat": "$chat", "user": {"$ifNull": ["$user", 0]}, "date": hour},
+			"count": {"$sum": 1},
+		}},
+		{"$project": {"_id": 0, "chat": "$_id.chat", "user": "$_id.user", "date": "$_id.date", "count": 1}},
+		{"$merge": {"into": "activity", "on": list(ACTIVITY_KEYS), "whenMatched": "replace", "whenNotMatched": "insert"}},
+	]
@@ -2,6 +2,8 @@
 This is a utility tool to fix stuff in your database. Move it to your bot root folder and run.
 Right now this tool can:
 * Convert all dates from int to datetime
+* Convert messages to the compact schema (`compact`)
+* Rebuild hourly activity rollups from logged messages (`rollups [days]`, all history if no days given)
 """
 if __name__ == "__main__":
 	import sys
@@ -115,6 +117,35 @@ if __name__ == "__main__":
 				if "messages" not in doc:
 					DRIVER.sync_db.chats.update_one({"id":doc["id"]}, {"$set":{"messages":{}}}, upsert=True)
 				DRIVER.sync_db.chats.update_one({"id":doc["id"]}, {"$set":{"messages.total":count}}, upsert=True)
+	elif sys.argv[1] in ("compact", "compact_messages"):
+		from pymongo import ReplaceOne
+		from plugins.statsbot.util.compact import compact_message
+		BATCH = 1000
+		total = DRIVER.sync_db.messages.count_documents({})
+
+		curr = 0
+		ops = []
+		for doc in DRIVER.sync_db.messages.find({}):
+			curr += 1
+			progress(curr, total)
+			compact = compact_message(doc)
+			if compact != doc:
+				ops.append(ReplaceOne({"_id": doc["_id"]}, compact))
+			if len(ops) >= BATCH:
+				DRIVER.sync_db.messages.bulk_write(ops, ordered=False)
+				ops = []
+		if ops:
+			DRIVER.sync_db.messages.bulk_write(ops, ordered=False)
+	elif sys.argv[1] in ("rollups", "activity"):
+		from datetime import timedelta
+		from plugins.statsbot.util.rollups import rollup_pipeline
+		flt = {}
+		if len(sys.argv) > 2: # start from an hour boundary, so partial rollups aren't replaced with partial counts
+			flt["date"] = {"$gte": (datetime.now() - timedelta(days=int(sys.argv[2]))).replace(minute=0, second=0, microsecond=0)}
+		DRIVER.sync_db.activity.create_index([("chat",1),("user",1),("date",1)], name="alemibot-unique-activity", unique=True)
+		start = time()
+		list(DRIVER.sync_db.messages.aggregate(rollup_pipeline(flt), allowDiskUse=True))
+		print(f"Rebuilt {DRIVER.sync_db.activity.estimated_document_count()} rollups in {time() - start:.1f}s", end="")
 	else:
 		raise ValueError("No command given")
 	print()
@@ -0,0 +1,278 @@
+"""
+This is an end to end ingest benchmark. Move it to your bot root folder and run.
+It generates synthetic pyrogram events (messages, edits, deletions, service messages, member updates and
+user statuses) and pushes them through the hook.py handlers, then reports throughput, p50/p99 latency for
+each event type and db round trips per event.
+Events are generated from a seed, so runs with the same arguments are comparable.
+By default writes go to an in-memory stand-in for MongoDB, which only counts round trips (and optionally
+waits a fixed latency for each): it measures driver overhead and round trips, not MongoDB.
+Pass `--mongo` to write to the MongoDB configured in `--config` instead (use a throwaway db!).
+Driver options can be set from a config file (`--config`) or one by one (`--set batch_ingest=true`).
+With batching or the ingest queue enabled, hook latency only covers buffering: total time includes the final flush.
+"""
+if __name__ == "__main__":
+	import sys
+	import json
+	import random
+	import asyncio
+	import argparse
+	import configparser
+	from time import perf_counter
+	from types import SimpleNamespace
+	from datetime import datetime, timedelta
+
+	from pymongo import monitoring
+	from pyrogram.enums import ChatType, ChatMemberStatus, UserStatus, MessageServiceType
+	from pyrogram.types import Message, Chat, User, ChatMember, ChatMemberUpdated
+	from pyrogram.types.messages_and_media.message import Str
+
+	import plugins.statsbot.driver as driver
+	from plugins.statsbot.driver import DRIVER
+	from plugins.statsbot import hook
+
+	parser = argparse.ArgumentParser(description="statsbot ingest benchmark")
+	parser.add_argument("-n", "--events", type=int, default=20000, help="events to generate")
+	parser.add_argument("--chats", type=int, default=50, help="number of chats")
+	parser.add_argument("--users", type=int, default=2000, help="number of users")
+	parser.add_argument("--private", type=float, default=0.1, help="fraction of chats which are private")
+	parser.add_argument("--text-mean", type=float, default=60, help="mean message length (lognormal)")
+	parser.add_argument("--edit-rate", type=float, default=0.05, help="fraction of events which are edits")
+	parser.add_argument("--delete-rate", type=float, default=0.02, help="fraction of events which are deletions")
+	parser.add_argument("--service-rate", type=float, default=0.01, help="fraction of events which are service messages")
+	parser.add_argument("--member-rate", type=float, default=0.01, help="fraction of events which are member updates")
+	parser.add_argument("--status-rate", type=float, default=0.2, help="fraction of events which are user statuses")
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds waited by the in-memory db on each round trip")
+	parser.add_argument("--seed", type=int, default=42)
+	parser.add_argument("--config", help="ini file with a [database] section")
+	parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="override a [database] option")
+	parser.add_argument("--mongo", action="store_true", help="write to MongoDB instead of the in-memory stand-in")
+	parser.add_argument("--json", action="store_true", help="print results as json")
+	args = parser.parse_args()
+
+	class RoundTrips(monitoring.CommandListener):
+		def __init__(self):
+			self.count = 0
+		def started(self, event):
+			self.count += 1
+		def succeeded(self, event):
+			pass
+		def failed(self, event):
+			pass
+
+	TRIPS = RoundTrips()
+
+	class MemoryCursor:
+		def __init__(self, docs):
+			self.docs = docs
+		def sort(self, *args, **kwargs):
+			return self
+		def limit(self, n):
+			self.docs = self.docs[:n]
+			return self
+		def __aiter__(self):
+			return self._iter()
+		async def _iter(self):
+			await MemoryCollection.trip()
+			for doc in self.docs:
+				yield doc
+		async def to_list(self, length=None):
+			await MemoryCollection.trip()
+			return self.docs
+
+	class MemoryCollection:
+		"""Stand-in for a Motor collection. Documents are only kept by `id`, enough for cache misses and upserts"""
+		def __init__(self):
+			self.by_id = {}
+
+		@staticmethod
+		async def trip():
+			TRIPS.count += 1
+			await asyncio.sleep(args.latency)
+
+		def _keep(self, doc):
+			if isinstance(doc.get("id"), int):
+				self.by_id[doc["id"]] = doc
+
+		def _lookup(self, flt):
+			key = flt.get("id") if flt else None
+			return self.by_id.get(key) if isinstance(key, int) else None
+
+		async def insert_one(self, doc):
+			await self.trip()
+			self._keep(doc)
+			return SimpleNamespace(inserted_id=None)
+		async def insert_many(self, docs, ordered=True):
+			await self.trip()
+			for doc in docs:
+				self._keep(doc)
+			return SimpleNamespace(inserted_ids=[None] * len(docs))
+		async def replace_one(self, flt, doc, upsert=False):
+			await self.trip()
+			prev = self._lookup(flt)
+			self._keep(doc)
+			return SimpleNamespace(matched_count=int(prev is not None), upserted_id=None if prev else 1)
+		async def update_one(self, flt, update, upsert=False):
+			await self.trip()
+			found = self._lookup(flt) is not None
+			return SimpleNamespace(matched_count=int(found), modified_count=int(found), upserted_id=None)
+		async def update_many(self, flt, update, upsert=False):
+			return await self.update_one(flt, update, upsert)
+		async def find_one(self, flt=None, *args, **kwargs):
+			await self.trip()
+			return self._lookup(flt)
+		async def find_one_and_update(self, flt, update, *args, **kwargs):
+			await self.trip()
+			return self._lookup(flt)
+		async def find_one_and_replace(self, flt, doc, *args, **kwargs):
+			await self.trip()
+			prev = self._lookup(flt)
+			self._keep(doc)
+			return prev
+		def find(self, flt=None, *args, **kwargs):
+			return MemoryCursor([])
+		async def bulk_write(self, requests, ordered=True):
+			await self.trip()
+			n = len(requests)
+			return SimpleNamespace(inserted_count=n, matched_count=n, modified_count=n, upserted_count=0)
+		async def count_documents(self, flt):
+			await self.trip()
+			return 0
+		async def index_information(self):
+			await self.trip()
+			return {}
+		async def create_index(self, keys, **kwargs):
+			await self.trip()
+			return kwargs.get("name")
+
+	class MemoryDatabase:
+		def __init__(self):
+			self.collections = {}
+		def __getitem__(self, name):
+			if name not in self.collections:
+				self.collections[name] = MemoryCollection()
+			return self.collections[name]
+		def __getattr__(self, name):
+			return self[name]
+		async def list_collection_names(self):
+			return list(self.collections.keys())
+		async def create_collection(self, name, **kwargs):
+			return self[name]
+
+	class MemoryClient:
+		def __init__(self, *args, **kwargs):
+			self.dbs = {}
+		def __getitem__(self, name):
+			return self.dbs.setdefault(name, MemoryDatabase())
+
+	config = configparser.ConfigParser()
+	if args.config:
+		config.read(args.config)
+	if not config.has_section("database"):
+		config.add_section("database")
+	for opt in args.set:
+		key, value = opt.split("=", 1)
+		config.set("database", key, value)
+	config.set("database", "log_media", "false")
+	if args.mongo:
+		monitoring.register(TRIPS)
+	else:
+		driver.AsyncIOMotorClient = MemoryClient
+
+	APP = SimpleNamespace(config=config) # hooks only need a client for media and chat lookups, which are off here
+
+	# Generate events
+	rng = random.Random(args.seed)
+	START = datetime(2022, 1, 1)
+	chats = [
+		Chat(id=1000 + i, type=ChatType.PRIVATE, first_name=f"user{i}") if rng.random() < args.private
+		else Chat(id=-1001000000000 - i, type=ChatType.SUPERGROUP, title=f"chat{i}")
+		for i in range(args.chats)
+	]
+	users = [ User(id=1000 + i, first_name=f"user{i}", username=f"user{i}", is_bot=False) for i in range(args.users) ]
+	sent = [] # (chat, id) of messages generated so far, targets for edits and deletions
+	next_id = {}
+	EVENTS = [] # (kind, hook, event)
+
+	def text(length):
+		return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz     ") for _ in range(length))
+
+	for n in range(args.events):
+		date = START + timedelta(seconds=n)
+		chat = rng.choice(chats)
+		user = users[chat.id - 1000] if chat.type == ChatType.PRIVATE and chat.id - 1000 < len(users) else rng.choice(users)
+		roll = rng.random()
+		if roll < args.status_rate:
+			EVENTS.append(("status", hook.log_user_status,
+				User(id=user.id, first_name=user.first_name, status=UserStatus.OFFLINE, last_online_date=date)))
+			continue
+		roll -= args.status_rate
+		if roll < args.edit_rate and sent:
+			c, m_id = rng.choice(sent)
+			EVENTS.append(("edit", hook.log_edit_hook,
+				Message(id=m_id, chat=c, from_user=user, date=date, edit_date=date, text=Str(text(20)).init(None))))
+			continue
+		roll -= args.edit_rate
+		if roll < args.delete_rate and sent:
+			c, m_id = sent.pop(rng.randrange(len(sent)))
+			EVENTS.append(("deletion", hook.log_deleted_hook,
+				[ Message(id=m_id, chat=None if c.type == ChatType.PRIVATE else c) ]))
+			continue
+		roll -= args.delete_rate
+		next_id[chat.id] = next_id.get(chat.id, 0) + 1
+		if roll < args.service_rate:
+			EVENTS.append(("service", hook.log_service_message_hook,
+				Message(id=next_id[chat.id], chat=chat, from_user=user, date=date, new_chat_members=[user], service=MessageServiceType.NEW_CHAT_MEMBERS)))
+			continue
+		roll -= args.service_rate
+		if roll < args.member_rate and chat.type != ChatType.PRIVATE:
+			EVENTS.append(("member", hook.log_chat_member_updates,
+				ChatMemberUpdated(chat=chat, from_user=user, date=date, old_chat_member=None,
+					new_chat_member=ChatMember(status=ChatMemberStatus.MEMBER, user=user, joined_date=date))))
+			continue
+		length = max(1, int(rng.lognormvariate(0, 1) * args.text_mean / 1.65)) # lognormal(0, 1) has mean ~1.65
+		EVENTS.append(("message", hook.log_message_hook,
+			Message(id=next_id[chat.id], chat=chat, from_user=user, date=date, text=Str(text(length)).init(None))))
+		sent.append((chat, next_id[chat.id]))
+
+	async def main():
+		await DRIVER.configure(APP)
+		await asyncio.sleep(0.1) # let background index check settle
+		TRIPS.count = 0
+		latencies = {}
+		start = perf_counter()
+		for kind, handler, event in EVENTS:
+			t = perf_counter()
+			await handler(APP, event)
+			latencies.setdefault(kind, []).append(perf_counter() - t)
+		ingest = perf_counter() - start
+		await DRIVER.stop() # flush anything buffered, it's part of the cost
+		total = perf_counter() - start
+
+		def pct(values, q):
+			values = sorted(values)
+			return values[min(len(values) - 1, int(q * len(values)))] * 1e3
+
+		return {
+			"events" : len(EVENTS),
+			"seed" : args.seed,
+			"options" : dict(config.items("database")),
+			"backend" : "mongo" if args.mongo else "memory",
+			"seconds" : total,
+			"events_per_second" : len(EVENTS) / total,
+			"hook_seconds" : ingest,
+			"round_trips" : TRIPS.count,
+			"round_trips_per_event" : TRIPS.count / len(EVENTS),
+			"latency_ms" : {
+				kind : {"count": len(v), "p50": pct(v, 0.5), "p99": pct(v, 0.99)}
+				for kind, v in sorted(latencies.items())
+			},
+		}
+
+	res = asyncio.run(main())
+	if args.json:
+		print(json.dumps(res, indent=2))
+		sys.exit(0)
+	print(f"{res['events']} events ({res['backend']}, seed {res['seed']}) in {res['seconds']:.2f}s : {res['events_per_second']:.0f} events/s")
+	print(f"{res['round_trips']} round trips, {res['round_trips_per_event']:.2f} per event")
+	for kind, lat in res["latency_ms"].items():
+		print(f"  {kind:<10} {lat['count']:>7}  p50 {lat['p50']:8.3f}ms  p99 {lat['p99']:8.3f}ms")
@@ -0,0 +1,63 @@
+"""
+This is a microbenchmark for event serialization. Move it to your bot root folder and run.
+It builds synthetic pyrogram objects (plain and formatted text, forwards, inline keyboards, service messages,
+admin promotions) and times extract_message, extract_service_message and extract_member_update on them.
+Optionally pass the number of rounds (default 20000).
+"""
+if __name__ == "__main__":
+	import sys
+	from time import perf_counter
+	from datetime import datetime
+
+	from pyrogram.enums import ChatType, ChatMemberStatus, MessageEntityType
+	from pyrogram.types import (
+		Message, Chat, User, ChatMember, ChatMemberUpdated, ChatPrivileges, MessageEntity,
+		InlineKeyboardMarkup, InlineKeyboardButton
+	)
+	from pyrogram.types.messages_and_media.message import Str
+
+	from plugins.statsbot.util.serializer import extract_message, extract_service_message, extract_member_update
+
+	ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	NOW = datetime.now()
+
+	chat = Chat(id=-1001234567890, type=ChatType.SUPERGROUP, title="benchmark")
+	user = User(id=123456789, first_name="bench", username="bench")
+	other = User(id=987654321, first_name="mark")
+	bold = [ MessageEntity(type=MessageEntityType.BOLD, offset=0, length=5) ]
+
+	MESSAGES = {
+		"plain" : Message(id=1, chat=chat, from_user=user, date=NOW, text=Str("hello world").init(None)),
+		"formatted" : Message(id=2, chat=chat, from_user=user, date=NOW, text=Str("hello world").init(bold), entities=bold),
+		"forward" : Message(id=3, chat=chat, from_user=user, date=NOW, text=Str("fwd").init(None),
+			forward_from=other, forward_date=NOW, forward_from_message_id=42),
+		"keyboard" : Message(id=4, chat=chat, from_user=user, date=NOW, text=Str("pick one").init(None),
+			reply_markup=InlineKeyboardMarkup([[ InlineKeyboardButton(str(i), callback_data=str(i)) for i in range(4) ]])),
+	}
+	SERVICE = {
+		"join" : Message(id=5, chat=chat, from_user=user, date=NOW, new_chat_members=[user, other]),
+		"title" : Message(id=6, chat=chat, from_user=user, date=NOW, new_chat_title="renamed"),
+	}
+	MEMBERS = {
+		"join" : ChatMemberUpdated(chat=chat, from_user=user, date=NOW, old_chat_member=None,
+			new_chat_member=ChatMember(status=ChatMemberStatus.MEMBER, user=user, joined_date=NOW)),
+		"promote" : ChatMemberUpdated(chat=chat, from_user=other, date=NOW,
+			old_chat_member=ChatMember(status=ChatMemberStatus.MEMBER, user=user),
+			new_chat_member=ChatMember(status=ChatMemberStatus.ADMINISTRATOR, user=user, promoted_by=other,
+				privileges=ChatPrivileges(can_manage_chat=True, can_delete_messages=True, can_restrict_members=True))),
+	}
+
+	def bench(name, func, obj):
+		func(obj) # warm up lazily built tables
+		start = perf_counter()
+		for _ in range(ROUNDS):
+			func(obj)
+		elapsed = perf_counter() - start
+		print(f"{name:<40} {elapsed / ROUNDS * 1e6:8.2f} us/event")
+
+	for name, msg in MESSAGES.items():
+		bench(f"extract_message [{name}]", extract_message, msg)
+	for name, msg in SERVICE.items():
+		bench(f"extract_service_message [{name}]", extract_service_message, msg)
+	for name, upd in MEMBERS.items():
+		bench(f"extract_member_update [{name}]", extract_member_update, upd)
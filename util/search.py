@@ -0,0 +1,26 @@
+import re
+
+from typing import Any, Dict
+
+PLAIN = re.compile(r"[^\W_]+( [^\W_]+)*") # words separated by single spaces, no regex syntax nor punctuation
+
+def is_plain(pattern:str) -> bool:
+	return PLAIN.fullmatch(pattern) is not None
+
+def keyword_filter(pattern:str, indexed:bool) -> Dict[str, Any]:
+	"""filter on messages whose text matches `pattern`
+
+	If the text index is available and `pattern` is only plain words, candidates are found through it with a
+	phrase search, and `$regex` is kept to check exact (case sensitive) matches on those only. Plain words
+	then only match whole words: "cat" won't match "concatenate" anymore. Real regexes still scan.
+	"""
+	if indexed and is_plain(pattern):
+		return {"$text": {"$search": f"\"{pattern}\""}, "text": {"$regex": pattern}}
+	return {"text": {"$regex": pattern}}
+
+def rewrite_text_filter(query:Dict[str, Any], indexed:bool) -> Dict[str, Any]:
+	"""use the text index for a `{"text": {"$regex": ...}}` condition in a user given query, if possible"""
+	cond = query.get("text")
+	if "$text" in query or not isinstance(cond, dict) or set(cond.keys()) != {"$regex"} or not isinstance(cond["$regex"], str):
+		return query
+	return {**query, **keyword_filter(cond["$regex"], indexed)}
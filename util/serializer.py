@@ -1,7 +1,7 @@
 from datetime import datetime
 from collections.abc import Iterable
 
-from typing import Union, List, Dict, Any
+from typing import Union, List, Dict, Tuple, Any, Callable
 from pyrogram.methods.chats import join_chat
 
 from pyrogram.types import (
@@ -29,132 +29,159 @@ def diff(old:Union[dict,str,int], new:Union[dict,str,int]):
 			out[key] = diff(old[key], new[key])
 	return out
 
-def extract_message(msg:Message):
-	doc : Dict[str, Any] = {
+def _put_text(doc:Dict[str, Any], msg:Message, text:str):
+	doc["text"] = text
+	if msg.entities:
+		doc["formatted"] = text.html
+
+def _put_caption(doc:Dict[str, Any], msg:Message, caption:str):
+	if "text" not in doc: # text wins over caption
+		_put_text(doc, msg, caption)
+
+def _put_forward(doc:Dict[str, Any], msg:Message, date:datetime):
+	doc["forward"] = {
+		"user": msg.forward_from.id if msg.forward_from else msg.forward_sender_name,
+		"date": date,
+	}
+	if msg.forward_from_message_id:
+		doc["id"] = msg.forward_from_message_id
+	if msg.forward_from_chat:
+		doc["chat"] = msg.forward_from_chat.id
+
+# reply markup type -> (field, converter)
+MARKUP_FIELDS : Dict[type, Tuple[str, Callable[[Any], Any]]] = {
+	ReplyKeyboardMarkup : ("keyboard", lambda m: m.keyboard),
+	InlineKeyboardMarkup : ("inline", lambda m: convert_to_dict(m.inline_keyboard)), # ewww do it slimmer!
+	ReplyKeyboardRemove : ("keyboard", lambda m: []),
+}
+
+def _put_markup(doc:Dict[str, Any], msg:Message, markup:Any):
+	field = MARKUP_FIELDS.get(type(markup))
+	if field:
+		doc[field[0]] = field[1](markup)
+
+CONTACT_FIELDS = ( # (attribute, key), after phone
+	("first_name", "first_name"),
+	("last_name", "last_name"),
+	("user_id", "user_id"),
+	("vcard", "vcard"),
+)
+
+def _put_contact(doc:Dict[str, Any], msg:Message, contact:Any):
+	doc["contact"] = {"phone": contact.phone_number}
+	for attr, key in CONTACT_FIELDS:
+		value = getattr(contact, attr)
+		if value:
+			doc["contact"][key] = value
+
+FieldWriter = Callable[[Dict[str, Any], Message, Any], None]
+
+def _field(key:str, convert:Callable[[Any], Any] = lambda v: v) -> FieldWriter:
+	"""writer storing attribute value (converted) under `key`"""
+	def put(doc:Dict[str, Any], msg:Message, value:Any):
+		doc[key] = convert(value)
+	return put
+
+# Optional message fields, in document order: (attribute, writer). Writers are only called if attribute is truthy
+MESSAGE_FIELDS : List[Tuple[str, FieldWriter]] = [
+	("empty", _field("empty", lambda v: True)),
+	("media", _field("media", str)), # TODO maybe get enum value? idk enums are new
+	("text", _put_text),
+	("caption", _put_caption),
+	("from_scheduled", _field("scheduled", lambda v: True)),
+	("author_signature", _field("author")),
+	("reply_to_message", _field("reply", lambda v: v.id)),
+	("forward_date", _put_forward),
+	("via_bot", _field("via_bot", lambda v: v.username)),
+	("reply_markup", _put_markup),
+	("poll", _field("poll", lambda v: {"question": v.question, "options": [ opt.text for opt in v.options ]})),
+	("contact", _put_contact),
+	("web_page", _field("web_page", lambda v: {"url": v.url, "type": v.type})),
+]
+
+EDIT_FIELDS : List[Tuple[str, FieldWriter]] = [
+	("text", _put_text),
+	("caption", _put_caption),
+	("reply_markup", _put_markup),
+]
+
+def _message_header(msg:Message) -> Dict[str, Any]:
+	return {
 		"id" : msg.id,
 		"user" : msg.from_user.id if msg.from_user else \
 			msg.sender_chat.id if msg.sender_chat else None,
 		"chat" : msg.chat.id if msg.chat else None,
 		"date" : msg.date,
 	}
-	if msg.empty:
-		doc["empty"] = True
-	if msg.media: # TODO maybe get enum value? idk enums are new
-		doc["media"] = str(msg.media)
-	if msg.text or msg.caption:
-		doc["text"] = msg.text or msg.caption
-		if msg.entities:
-			if msg.text:  # could be a oneliner but mypy gets angry
-				doc["formatted"] = msg.text.html
-			elif msg.caption:
-				doc["formatted"] = msg.caption.html
-	if msg.from_scheduled:
-		doc["scheduled"] = True
-	if msg.author_signature:
-		doc["author"] = msg.author_signature
-	if msg.reply_to_message:
-		doc["reply"] = msg.reply_to_message.id
+
+def extract_message(msg:Message):
+	doc = _message_header(msg)
+	for attr, put in MESSAGE_FIELDS:
+		value = getattr(msg, attr)
+		if value:
+			put(doc, msg, value)
+	return doc
+
+def extract_message_key(msg:Message):
+	"""unique key fields (chat, id, date) of the document extract_message would make"""
+	key : Dict[str, Any] = {
+		"chat" : msg.chat.id if msg.chat else None,
+		"id" : msg.id,
+		"date" : msg.date,
+	}
 	if msg.forward_date:
-		doc["forward"] = {
-			"user": msg.forward_from.id if msg.forward_from else msg.forward_sender_name,
-			"date": msg.forward_date,
-		}
 		if msg.forward_from_message_id:
-			doc["id"] = msg.forward_from_message_id
+			key["id"] = msg.forward_from_message_id
 		if msg.forward_from_chat:
-			doc["chat"] = msg.forward_from_chat.id
-	if msg.via_bot:
-		doc["via_bot"] = msg.via_bot.username
-	if msg.reply_markup:
-		if isinstance(msg.reply_markup, ReplyKeyboardMarkup):
-			doc["keyboard"] = msg.reply_markup.keyboard
-		elif isinstance(msg.reply_markup, InlineKeyboardMarkup):
-			doc["inline"] = convert_to_dict(msg.reply_markup.inline_keyboard) # ewww do it slimmer!
-		elif isinstance(msg.reply_markup, ReplyKeyboardRemove):
-			doc["keyboard"] = []
-	if msg.poll:
-		doc["poll"] = {
-			"question" : msg.poll.question,
-			"options" : [ opt.text for opt in msg.poll.options ]
-		}
-	if msg.contact:
-		doc["contact"] = {"phone": msg.contact.phone_number}
-		if msg.contact.first_name:
-			doc["contact"]["first_name"] = msg.contact.first_name
-		if msg.contact.last_name:
-			doc["contact"]["last_name"] = msg.contact.last_name
-		if msg.contact.user_id:
-			doc["contact"]["user_id"] = msg.contact.user_id
-		if msg.contact.vcard:
-			doc["contact"]["vcard"] = msg.contact.vcard
-	if msg.web_page:
-		doc["web_page"] = {
-			"url": msg.web_page.url,
-			"type": msg.web_page.type,
-		}
-	return doc
+			key["chat"] = msg.forward_from_chat.id
+	return key
 
 def extract_edit_message(msg:Message):
 	doc : Dict[str, Any] = { "date": msg.edit_date }
-	if msg.text or msg.caption:
-		doc["text"] = msg.text or msg.caption
-		if msg.entities:
-			if msg.text:  # could be a oneliner but mypy gets angry
-				doc["formatted"] = msg.text.html
-			elif msg.caption:
-				doc["formatted"] = msg.caption.html
-	if msg.reply_markup:
-		if isinstance(msg.reply_markup, ReplyKeyboardMarkup):
-			doc["keyboard"] = msg.reply_markup.keyboard
-		elif isinstance(msg.reply_markup, InlineKeyboardMarkup):
-			doc["inline"] = convert_to_dict(msg.reply_markup.inline_keyboard) # TODO do it slimmer!
-		elif isinstance(msg.reply_markup, ReplyKeyboardRemove):
-			doc["keyboard"] = []
+	for attr, put in EDIT_FIELDS:
+		value = getattr(msg, attr)
+		if value:
+			put(doc, msg, value)
 	return doc
 
-def extract_service_message(msg:Message):
-	doc : Dict[str, Any] = {
-		"id" : msg.id,
-		"user" : msg.from_user.id if msg.from_user else \
-			msg.sender_chat.id if msg.sender_chat else None,
-		"chat" : msg.chat.id if msg.chat else None,
-		"date" : msg.date,
+_SKIP = object()
+
+def _game_high_score(msg:Message, score:int) -> Any:
+	if not msg.reply_to_message or not msg.reply_to_message.game:
+		return _SKIP
+	return {
+		"game": msg.reply_to_message.game.id,
+		"score": score,
 	}
-	if msg.reply_to_message:
-		doc["reply"] = msg.reply_to_message.id
-	if msg.new_chat_members:
-		doc["new_chat_members"] = [ u.id for u in msg.new_chat_members ]
-	if msg.left_chat_member:
-		doc["left_chat_member"] = msg.left_chat_member.id
-	if msg.new_chat_title:
-		doc["new_chat_title"] = msg.new_chat_title
-	if msg.new_chat_photo:
-		doc["new_chat_photo"] = msg.new_chat_photo.file_unique_id
-	if msg.delete_chat_photo:
-		doc["delete_chat_photo"] = msg.delete_chat_photo
-	if msg.group_chat_created:
-		doc["group_chat_created"] = msg.group_chat_created
-	if msg.supergroup_chat_created:
-		doc["supergroup_chat_created"] = msg.supergroup_chat_created
-	if msg.channel_chat_created:
-		doc["channel_chat_created"] = msg.channel_chat_created
-	if msg.migrate_to_chat_id:
-		doc["migrate_to_chat_id"] = msg.migrate_to_chat_id
-	if msg.migrate_from_chat_id:
-		doc["migrate_from_chat_id"] = msg.migrate_from_chat_id
-	if msg.pinned_message:
-		doc["pinned_message"] = msg.pinned_message.id
-	if msg.game_high_score and msg.reply_to_message and msg.reply_to_message.game:
-		doc["game_high_score"] = {
-			"game": msg.reply_to_message.game.id,
-			"score": msg.game_high_score,
-		}
-	if msg.video_chat_started:
-		doc["video_chat_started"] = True
-	if msg.video_chat_ended:
-		doc["video_chat_ended"] = msg.video_chat_ended.duration
-	if msg.video_chat_members_invited:
-		doc["video_chat_members_invited"] = [ u.id for u in msg.video_chat_members_invited.users ]
+
+# Service message fields, in document order: (attribute, key, converter). Only truthy attributes are converted
+SERVICE_FIELDS : List[Tuple[str, str, Callable[[Message, Any], Any]]] = [
+	("reply_to_message", "reply", lambda msg, v: v.id),
+	("new_chat_members", "new_chat_members", lambda msg, v: [ u.id for u in v ]),
+	("left_chat_member", "left_chat_member", lambda msg, v: v.id),
+	("new_chat_title", "new_chat_title", lambda msg, v: v),
+	("new_chat_photo", "new_chat_photo", lambda msg, v: v.file_unique_id),
+	("delete_chat_photo", "delete_chat_photo", lambda msg, v: v),
+	("group_chat_created", "group_chat_created", lambda msg, v: v),
+	("supergroup_chat_created", "supergroup_chat_created", lambda msg, v: v),
+	("channel_chat_created", "channel_chat_created", lambda msg, v: v),
+	("migrate_to_chat_id", "migrate_to_chat_id", lambda msg, v: v),
+	("migrate_from_chat_id", "migrate_from_chat_id", lambda msg, v: v),
+	("pinned_message", "pinned_message", lambda msg, v: v.id),
+	("game_high_score", "game_high_score", _game_high_score),
+	("video_chat_started", "video_chat_started", lambda msg, v: True),
+	("video_chat_ended", "video_chat_ended", lambda msg, v: v.duration),
+	("video_chat_members_invited", "video_chat_members_invited", lambda msg, v: [ u.id for u in v.users ]),
+]
+
+def extract_service_message(msg:Message):
+	doc = _message_header(msg)
+	for attr, key, convert in SERVICE_FIELDS:
+		value = getattr(msg, attr)
+		if value:
+			out = convert(msg, value)
+			if out is not _SKIP:
+				doc[key] = out
 	return doc
 
 def extract_user(user:User):
@@ -231,6 +258,18 @@ def extract_delete(deletions:Union[Message, List[Message]]):
 		})
 	return out
 
+# privileges type -> public attribute names, sorted like dir() would. Built on first object of each type
+PRIVILEGE_FIELDS : Dict[type, Tuple[str, ...]] = {}
+
+def _privilege_fields(privileges:Any) -> Tuple[str, ...]:
+	cls = type(privileges)
+	if cls not in PRIVILEGE_FIELDS:
+		PRIVILEGE_FIELDS[cls] = tuple(
+			perm for perm in dir(privileges)
+			if not perm.startswith('_') and not callable(getattr(privileges, perm, None))
+		)
+	return PRIVILEGE_FIELDS[cls]
+
 def extract_chat_member(member:ChatMember):
 	obj : Dict[str, Any] = {
 		"user": member.user.id if member.user else None,
@@ -249,18 +288,26 @@ def extract_chat_member(member:ChatMember):
 		obj["restricted_by"] = member.restricted_by.id
 	if member.is_member is not None:
 		obj["is_member"] = member.is_member
-	if member.privileges and member.privileges.is_anonymous:
-		obj["anonymous"] = member.privileges.is_anonymous
-	for perm in dir(member.privileges): # TODO there's probably a better way
-		if perm.startswith('_'):
-			continue
-		if hasattr(member.privileges, perm) \
-		and isinstance(getattr(member.privileges, perm), bool):
-			if "perms" not in obj:
-				obj["perms"] = {}
-			obj["perms"][perm] = getattr(member.privileges, perm)
+	privileges = member.privileges
+	if privileges:
+		if privileges.is_anonymous:
+			obj["anonymous"] = privileges.is_anonymous
+		perms = {}
+		for perm in _privilege_fields(privileges):
+			value = getattr(privileges, perm, None)
+			if isinstance(value, bool):
+				perms[perm] = value
+		if perms:
+			obj["perms"] = perms
 	return obj
 
+INVITE_FIELDS = ( # optional invite link fields: (attribute, key, converter)
+	("creator", "creator", lambda v: v.id),
+	("expire_date", "expires", lambda v: v),
+	("member_limit", "use_limit", lambda v: v),
+	("member_count", "use_count", lambda v: v),
+)
+
 def extract_member_update(update:ChatMemberUpdated):
 	m = update.new_chat_member or update.old_chat_member
 	obj : Dict[str, Any] = {
@@ -275,14 +322,10 @@ def extract_member_update(update:ChatMemberUpdated):
 			"created": update.invite_link.date,
 			"primary": update.invite_link.is_primary,
 		}
-		if update.invite_link.creator:
-			obj["invite"]["creator"] = update.invite_link.creator.id
-		if update.invite_link.expire_date:
-			obj["invite"]["expires"] = update.invite_link.expire_date
-		if update.invite_link.member_limit:
-			obj["invite"]["use_limit"] = update.invite_link.member_limit
-		if update.invite_link.member_count:
-			obj["invite"]["use_count"] = update.invite_link.member_count
+		for attr, key, convert in INVITE_FIELDS:
+			value = getattr(update.invite_link, attr)
+			if value:
+				obj["invite"][key] = convert(value)
 	if update.old_chat_member and not update.new_chat_member:
 		obj["left"] = extract_chat_member(update.old_chat_member)
 	elif update.new_chat_member and not update.old_chat_member:
@@ -0,0 +1,113 @@
+import os
+import sqlite3
+
+from uuid import uuid4
+from typing import Any, List, Dict, Tuple, Optional
+
+import bson
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import InsertOne, ReplaceOne, UpdateOne, UpdateMany
+from pymongo.errors import BulkWriteError
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SpooledOp = Tuple[int, str, str, Dict[str, Any]]
+
+class Spool:
+	"""Local write-ahead spool for writes which could not reach MongoDB
+
+	Operations are kept in a SQLite file as BSON documents, so that they survive restarts, and are
+	replayed in bulk with `replay` once MongoDB is reachable again. Replays are idempotent:
+	 * inserts are upserted against `unique_keys` (when the collection has one)
+	 * updates carrying an `opid` record it in the `_spooled` array of the documents they change, in the same
+	   update, and only match documents which don't have it yet: counter increments are applied exactly once,
+	   even if a replay is interrupted halfway and started again. Only the last `limit` opids are kept, as a
+	   replay never goes back further than that
+	"""
+	def __init__(self, path:str = "plugins/statsbot/spool/spool.db", unique_keys:Optional[Dict[str, Tuple[str, ...]]] = None):
+		self.path = path
+		self.unique_keys = unique_keys or {}
+		self.replayed = 0
+		os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+		self.conn = sqlite3.connect(path)
+		self.conn.execute("CREATE TABLE IF NOT EXISTS ops (seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT, coll TEXT, payload BLOB)")
+		self.conn.commit()
+
+	def __len__(self) -> int:
+		return self.conn.execute("SELECT COUNT(*) FROM ops").fetchone()[0]
+
+	def __str__(self) -> str:
+		return f"{len(self)} spooled | {self.replayed} replayed"
+
+	def close(self):
+		self.conn.close()
+
+	def _append(self, ops:List[Tuple[str, str, Dict[str, Any]]]):
+		self.conn.executemany(
+			"INSERT INTO ops (op, coll, payload) VALUES (?, ?, ?)",
+			[ (op, coll, bson.encode(payload)) for op, coll, payload in ops ]
+		)
+		self.conn.commit()
+
+	def insert(self, collection:str, docs:List[dict]):
+		"""spool documents to insert"""
+		self._append([ ("insert", collection, {"doc": { k: v for k, v in doc.items() if k != "_id" }}) for doc in docs ])
+
+	def update(self, collection:str, updates:List[Tuple[dict, dict]], upsert:bool = False, many:bool = False, journal:bool = False):
+		"""spool (filter, update) pairs. Non idempotent updates (like `$inc`) must be journaled"""
+		self._append([
+			("update", collection, {
+				"filter": flt, "update": upd, "upsert": upsert, "many": many,
+				"opid": str(uuid4()) if journal else None,
+			}) for flt, upd in updates
+		])
+
+	def read(self, limit:int = 1000) -> List[SpooledOp]:
+		return [
+			(seq, op, coll, bson.decode(payload))
+			for seq, op, coll, payload in self.conn.execute("SELECT seq, op, coll, payload FROM ops ORDER BY seq LIMIT ?", (limit,))
+		]
+
+	def discard(self, upto:int):
+		self.conn.execute("DELETE FROM ops WHERE seq <= ?", (upto,))
+		self.conn.commit()
+
+	async def replay(self, db:AsyncIOMotorDatabase, limit:int = 1000) -> int:
+		"""push up to `limit` spooled operations to db, in order. Returns how many were replayed"""
+		ops = self.read(limit)
+		if not ops:
+			return 0
+		# group ops by collection, keeping their order within each collection
+		requests : Dict[str, List[Any]] = {}
+		for _, op, coll, payload in ops:
+			if op == "insert":
+				doc = payload["doc"]
+				if coll in self.unique_keys:
+					requests.setdefault(coll, []).append(
+						ReplaceOne({ k: doc.get(k) for k in self.unique_keys[coll] }, doc, upsert=True))
+				else:
+					requests.setdefault(coll, []).append(InsertOne(doc))
+			elif op == "update":
+				flt, update = payload["filter"], payload["update"]
+				if payload["opid"]:
+					flt = {**flt, "_spooled": {"$ne": payload["opid"]}}
+					update = {**update, "$push": {**update.get("$push", {}), "_spooled": {"$each": [payload["opid"]], "$slice": -limit}}}
+				cls = UpdateMany if payload["many"] else UpdateOne
+				requests.setdefault(coll, []).append(cls(flt, update, upsert=payload["upsert"]))
+		for coll, reqs in requests.items():
+			while reqs:
+				try:
+					await db[coll].bulk_write(reqs, ordered=True)
+					break
+				except BulkWriteError as e: # don't get stuck on a bad document, log it and go on
+					err = e.details["writeErrors"][0]
+					if err["code"] != 11000 or not isinstance(reqs[err["index"]], (UpdateOne, UpdateMany)):
+						logger.error("Failed replaying op on %s : %s", coll, err.get("errmsg"))
+					# else an upsert found its document already carrying the opid: applied by an interrupted replay
+					reqs = reqs[err["index"]+1:]
+		self.discard(ops[-1][0])
+		self.replayed += len(ops)
+		return len(ops)
@@ -0,0 +1,118 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Any, List, Dict, Tuple, Optional, Iterable
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import DESCENDING
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+def _get_path(doc:Dict[str, Any], path:str) -> Any:
+	for key in path.split("."):
+		if not isinstance(doc, dict) or key not in doc:
+			return None
+		doc = doc[key]
+	return doc
+
+class StorageBackend(ABC):
+	"""Operations commands need from a database
+
+	Filters are MongoDB style queries, but only a subset is guaranteed to work on every backend:
+	equality and `$gt`, `$gte`, `$lt`, `$lte`, `$ne`, `$in`, `$exists`, `$regex` on (dotted) fields, and top level `$or`.
+	"""
+	@abstractmethod
+	async def insert(self, collection:str, docs:List[dict]):
+		...
+
+	@abstractmethod
+	async def increment(self, collection:str, key:Any, field:str, amount:int = 1):
+		"""add `amount` to `field` of document with given `id`, creating it if missing"""
+		...
+
+	@abstractmethod
+	async def count(self, collection:str, flt:dict) -> int:
+		...
+
+	@abstractmethod
+	async def find_one(self, collection:str, flt:dict, sort:Optional[List[Tuple[str, int]]] = None) -> Optional[dict]:
+		...
+
+	@abstractmethod
+	async def distinct(self, collection:str, field:str, flt:dict) -> List[Any]:
+		...
+
+	@abstractmethod
+	async def top(self, collection:str, field:str, flt:Optional[dict] = None, limit:Optional[int] = None,
+			fields:Iterable[str] = ("id",)) -> List[Tuple[dict, Any]]:
+		"""documents with highest `field`, as (document with only `fields`, value) pairs, highest first"""
+		...
+
+	@abstractmethod
+	async def bucket_counts(self, collection:str, flt:dict, width:timedelta, offset:timedelta = timedelta(0),
+			limit:Optional[int] = None, total:Optional[str] = None) -> Dict[datetime, int]:
+		"""count documents per `date` bucket (dates shifted by `offset`), only considering the `limit` most recent
+
+		With `total`, that field is summed instead (for rollups, which already hold counts).
+		"""
+		...
+
+class MongoBackend(StorageBackend):
+	"""Current MongoDB storage, through Motor"""
+	def __init__(self, db:AsyncIOMotorDatabase):
+		self.db = db
+
+	async def insert(self, collection:str, docs:List[dict]):
+		await self.db[collection].insert_many(docs, ordered=False)
+
+	async def increment(self, collection:str, key:Any, field:str, amount:int = 1):
+		await self.db[collection].update_one({"id": key}, {"$inc": {field: amount}}, upsert=True)
+
+	async def count(self, collection:str, flt:dict) -> int:
+		return await self.db[collection].count_documents(flt)
+
+	async def find_one(self, collection:str, flt:dict, sort:Optional[List[Tuple[str, int]]] = None) -> Optional[dict]:
+		return await self.db[collection].find_one(flt, sort=sort)
+
+	async def distinct(self, collection:str, field:str, flt:dict) -> List[Any]:
+		return await self.db[collection].distinct(field, flt)
+
+	async def top(self, collection:str, field:str, flt:Optional[dict] = None, limit:Optional[int] = None,
+			fields:Iterable[str] = ("id",)) -> List[Tuple[dict, Any]]:
+		query = {field: {"$exists": 1}, **(flt or {})}
+		projection = {"_id": 0, field: 1, **{ f: 1 for f in fields }}
+		cursor = self.db[collection].find(query, projection, allow_disk_use=True).sort(field, DESCENDING)
+		if limit:
+			cursor = cursor.limit(limit)
+		return [ (doc, _get_path(doc, field)) async for doc in cursor ]
+
+	async def bucket_counts(self, collection:str, flt:dict, width:timedelta, offset:timedelta = timedelta(0),
+			limit:Optional[int] = None, total:Optional[str] = None) -> Dict[datetime, int]:
+		"""buckets are computed by the server, only one count per bucket is transferred
+
+		Dates are bucketed with integer math on milliseconds since epoch ($dateTrunc would need MongoDB 5
+		and doesn't take arbitrary widths and offsets): bucket index is floor((date + offset) / width).
+		"""
+		pipeline : List[Dict[str, Any]] = [
+			{"$match": flt},
+			{"$project": {"_id": 0, "date": 1, **({total: 1} if total else {})}}, # don't carry text and edits through $sort
+		]
+		if limit:
+			pipeline += [ {"$sort": {"date": DESCENDING}}, {"$limit": limit} ]
+		pipeline += [
+			{"$match": {"date": {"$type": "date"}}},
+			{"$group": {
+				"_id": {"$floor": {"$divide": [
+					{"$add": [{"$toLong": "$date"}, int(offset.total_seconds() * 1000)]},
+					int(width.total_seconds() * 1000),
+				]}},
+				"n": {"$sum": f"${total}" if total else 1},
+			}},
+		]
+		out : Dict[datetime, int] = {}
+		async for doc in self.db[collection].aggregate(pipeline, allowDiskUse=True):
+			out[EPOCH + width * int(doc["_id"])] = doc["n"]
+		return out